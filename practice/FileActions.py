@@ -1,5 +1,8 @@
 from enum import Enum
 
+# Suffix of files that a transfer is still writing. The inbox checker leaves these alone.
+PARTIAL_SUFFIX = ".fspart"
+
 class FileAction(Enum):
     SEND_FILE = "send_file"
     RENAME_FILE = "rename_file"
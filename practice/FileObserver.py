@@ -3,109 +3,282 @@ from watchdog.events import FileSystemEventHandler, FileMovedEvent
 import time
 from pathlib import Path
 from tracker_utils import save_tracked_paths
-from ssh_utils import file_event_queue
+from ssh_utils import file_event_queue, get_index_destinations
 import traceback
-from FileActions import FileAction
+from FileActions import FileAction, PARTIAL_SUFFIX
 import settings_util
-import shutil
+from file_indexer_hasher import get_live_index, get_index_key, build_file_entry, update_index_entries
+from PathTrie import PathTrie
+from InboxApplier import InboxApplier
+from startup_reconciler import start_reconciliation
+import hash_engine
+import delta_sync
+import delete_tombstones
 import threading
 from queue import Queue, Empty
+from collections import OrderedDict
 
 # Time to wait to verify file is stable (not being written anymore)
 STABLE_WAIT = 1
+# Threads moving stable files out of the inbox at the same time
+INBOX_APPLY_WORKERS = 8
+# Fingerprints of applied files kept for echo checks, least recently used ones are dropped beyond this
+MAX_APPLIED_FINGERPRINTS = 10000
 
 inbox_queue = Queue()
-file_skip_dict = dict() # dictionary of files for the observer to skip (must be skipped when receiving) [filepath] -> timestamp
-TIME_TO_HANDLE_FILE = 2 # seconds it takes from last change to handle a file if it is inside of the skip dictionary
+# Files applied from the inbox, so their events are not sent back: [destination path] -> (size, mtime_ns, hash, algorithm)
+applied_fingerprints = OrderedDict()
+applied_fingerprints_lock = threading.Lock()
+INBOX_OWNER = object() # marks the inbox folder in the path trie
 
 class ChangeHandler(FileSystemEventHandler):
   def __init__(self, tracked_paths):
-    self.tracked_paths = tracked_paths
     self.inbox_path = Path(settings_util.settings['local_inbox']).resolve()
+    self.tombstone_ttl = settings_util.get_setting('tombstone_ttl', delete_tombstones.DEFAULT_TOMBSTONE_TTL)
+    self.update_tracked_paths(tracked_paths)
+
+  def update_tracked_paths(self, tracked_paths):
+    """Sets the tracked folders and rebuilds the trie used to find which one owns a path."""
+    path_trie = PathTrie({tracked_path: tracked_path for tracked_path in tracked_paths})
+    path_trie.insert(str(self.inbox_path), INBOX_OWNER)
+    self.tracked_paths = tracked_paths
+    self.path_trie = path_trie
 
   def on_modified(self, event):
 
+    # A directory "modified" event only means one of its entries changed, which gets its own event.
+    # Queueing the directory would re-send its whole subtree.
+    if event.is_directory and event.event_type == "modified":
+      return
+
+    self.handle_change(event.src_path, event.is_directory)
+
+  def handle_change(self, src_path : str, is_directory : bool = False):
+    """Queues a created or modified path, in a tracked folder or the inbox."""
+    owner = self.path_trie.find(src_path)
+    if owner is None:
+      return # Not inside a tracked folder
+
+    if src_path.endswith(PARTIAL_SUFFIX):
+      return # Still being written by a transfer or the inbox applier, it is renamed into place when done
+
     # If the file is in the inbox folder
-    if event.src_path.startswith(str(self.inbox_path)):
-      absolute_path = Path(event.src_path)
+    if owner is INBOX_OWNER:
+      if delete_tombstones.is_tombstone(src_path, self.inbox_path):
+        return # Left by a peer's delete, not a received file
+      if is_directory:
+        return # Created ahead of the uploads into it; only the files are applied, each once it is complete
+      absolute_path = Path(src_path)
       inbox_queue.put((absolute_path, time.time(), FileAction.SEND_FILE)) # make sure the file gets handled by the inbox checker
       return
     
-    path = Path(event.src_path)
-    
-    # If the file was moved from the inbox folder, check how long ago 
-    if path in file_skip_dict.keys():
-      current_time = time.time()
-      old_time = file_skip_dict[path] # last update time
-      if current_time - old_time >= 2:
-        # Enough time has passed where we can send the file to remote
-        del file_skip_dict[path]
-      else:
-        return # dont handle the file
-
-    for tracked_path, folder_info in self.tracked_paths.items():
-      folder_path = Path(tracked_path)
-      # Check if the changed file is inside a tracked folder
-      if folder_path in path.parents or folder_path == path:
-        print(f"\nChange detected in: {path}")
-
-        try:
-          # Queue and send the changed file
-          file_event_queue.put((path, folder_info['linked_paths'], tracked_path, FileAction.SEND_FILE, None))
-          print(f"Sent {path} for updating")
-        except Exception as e:
-          print(f"Error sending {path}: {e}")
-          traceback.print_exc()
-          
-        break
+    path = Path(src_path)
+    tracked_path = owner
+    # Created again, so deleting it later is a real change
+    delete_tombstones.clear_tombstones(path, tracked_path, self.inbox_path)
+
+    # Events caused by applying a received file would send it straight back to where it came from
+    if is_applied_echo(path):
+      return
+
+    folder_info = self.tracked_paths[tracked_path]
+    print(f"\nChange detected in: {path}")
+
+    try:
+      # Queue and send the changed file
+      file_event_queue.put((path, folder_info['linked_paths'], tracked_path, FileAction.SEND_FILE, None))
+      print(f"Sent {path} for updating")
+    except Exception as e:
+      print(f"Error sending {path}: {e}")
+      traceback.print_exc()
+
+  def find_tracked_path(self, path : str) -> tuple:
+    """Returns the tracked folder containing the path and its info, or (None, None)."""
+    owner = self.path_trie.find(path)
+    if owner is None or owner is INBOX_OWNER:
+      return None, None
+    return owner, self.tracked_paths[owner]
 
   def on_created(self, event):
     self.on_modified(event)  # You can treat creation same as modification
 
   def on_deleted(self, event):
-    self.on_modified(event)  # You can treat deletion same as modification
+    self.remove_from_index(event.src_path, event.is_directory)
+    # A path a peer just deleted here must not have its deletion sent back to the peer
+    tracked_path, _ = self.find_tracked_path(event.src_path)
+    if tracked_path is not None and delete_tombstones.is_applied_delete(Path(event.src_path), tracked_path, self.inbox_path, self.tombstone_ttl):
+      return
+    self.queue_delete(event.src_path)
+
+  def queue_delete(self, src_path : str):
+    """Queues the removal of a deleted path's remote copies."""
+    path = Path(src_path)
+    with applied_fingerprints_lock:
+      applied_fingerprints.pop(path, None)
+
+    tracked_path, folder_info = self.find_tracked_path(src_path)
+    if tracked_path is None or path == Path(tracked_path) or src_path.endswith(PARTIAL_SUFFIX):
+      return
+    file_event_queue.put((path, folder_info['linked_paths'], tracked_path, FileAction.DELETE_FILE, None))
+
+  def remove_from_index(self, src_path : str, is_directory : bool):
+    # Drop the deleted file (or directory) from the live index in place.
+    # Created and modified files get their entries from the sender once they are delivered.
+    tracked_path, _ = self.find_tracked_path(src_path)
+    path = Path(src_path)
+    if tracked_path is not None and path != Path(tracked_path):
+      relative = path.relative_to(tracked_path).as_posix()
+      index = get_live_index(get_index_key(tracked_path))
+      if is_directory:
+        index.remove_tree(relative)
+      else:
+        index.update({}, [relative])
 
   def on_moved(self, event):
-    if isinstance(event, FileMovedEvent):
-      pass
+    # Transfers and the inbox applier finish by renaming their partial file into place
+    if event.src_path.endswith(PARTIAL_SUFFIX):
+      if not event.is_directory:
+        self.handle_change(event.dest_path)
+      return
+
+    # The moves of a moved directory's contents are implied by the directory's own move
+    if getattr(event, "is_synthetic", False):
+      return
+
+    if isinstance(event, FileMovedEvent) and self.path_trie.find(event.dest_path) is INBOX_OWNER and not event.dest_path.endswith(PARTIAL_SUFFIX):
+      inbox_queue.put((Path(event.dest_path), time.time(), FileAction.SEND_FILE))
+
+    src_tracked, _ = self.find_tracked_path(event.src_path)
+    dest_tracked, dest_info = self.find_tracked_path(event.dest_path)
+
+    if src_tracked is not None and src_tracked == dest_tracked and Path(event.src_path) != Path(src_tracked):
+      # Within one tracked folder the remote copy is renamed instead of uploaded again.
+      # The index entries move along, so the sender still knows what the remote holds.
+      index = get_live_index(get_index_key(src_tracked))
+      index.move(Path(event.src_path).relative_to(src_tracked).as_posix(), Path(event.dest_path).relative_to(dest_tracked).as_posix())
+      if delete_tombstones.is_applied_rename(Path(event.src_path), Path(event.dest_path), self.inbox_path, self.tombstone_ttl):
+        return # A peer's own rename of its copy, which it does not need back
+      print(f"\nMove detected: {event.src_path} -> {event.dest_path}")
+      file_event_queue.put((Path(event.dest_path), dest_info['linked_paths'], dest_tracked, FileAction.RENAME_FILE, event.src_path))
+      return
+
+    # Moves into, out of or between tracked folders are a removal and an addition
+    if src_tracked is not None:
+      self.remove_from_index(event.src_path, event.is_directory)
+      self.queue_delete(event.src_path)
+    if dest_tracked is not None:
+      self.handle_change(event.dest_path)
 
 threading_stop_event = threading.Event()
 
+def record_applied_file(src_path : Path, dest_path : Path):
+  """Fingerprints a received file just before it is moved to dest_path. Moving keeps its size and mtime."""
+  stat = src_path.stat()
+  algorithm = hash_engine.get_algorithm()
+  fingerprint = (stat.st_size, stat.st_mtime_ns, hash_engine.hash_file(src_path, algorithm), algorithm)
+  with applied_fingerprints_lock:
+    applied_fingerprints[dest_path] = fingerprint
+    applied_fingerprints.move_to_end(dest_path)
+    while len(applied_fingerprints) > MAX_APPLIED_FINGERPRINTS:
+      applied_fingerprints.popitem(last=False)
+
+def record_applied_entries(applied : list, path_trie : PathTrie, tracked_paths : dict):
+  """
+  Records index entries for files applied from the inbox, as delivered to their folder's linked paths.
+  The inbox does not say which peer sent a file, and an applied file is not passed on to the other
+  peers either, so every linked path is taken to hold it. Renames and the catch-up at startup then
+  treat it like a file this side sent, instead of sending it back whole.
+  """
+  updates = {} # [index key] -> {[relative path] -> entry}
+  for dest_path in applied:
+    tracked_path = path_trie.find(str(dest_path))
+    with applied_fingerprints_lock:
+      fingerprint = applied_fingerprints.get(dest_path)
+    if tracked_path is None or fingerprint is None:
+      continue
+    size, mtime_ns, file_hash, _ = fingerprint
+    try:
+      stat = dest_path.stat()
+      if stat.st_size != size or stat.st_mtime_ns != mtime_ns:
+        continue # Changed again already, its own event sends it
+      # The fingerprint's hash was made with the configured algorithm, so only large files are read again, for their signatures
+      entry = build_file_entry(dest_path, delta_sync.get_signature_block_size(dest_path), file_hash, stat)
+    except OSError:
+      continue
+    remotes = get_index_destinations(tracked_paths[tracked_path]['linked_paths'])
+    relative = dest_path.relative_to(tracked_path).as_posix()
+    updates.setdefault(get_index_key(tracked_path), {})[relative] = {**entry, "remotes": sorted(remotes)}
+
+  for index_key, entries in updates.items():
+    update_index_entries(index_key, entries)
+
+def is_applied_echo(path : Path) -> bool:
+  """
+  Checks whether the file still holds exactly the content applied from the inbox.
+
+  An unchanged size and mtime is a match without reading the file; a changed mtime with the
+  same size is settled by hashing. Any real edit drops the fingerprint, so it is sent as usual.
+  Files that are never touched again age out of the bounded map.
+  """
+  with applied_fingerprints_lock:
+    fingerprint = applied_fingerprints.get(path)
+  if fingerprint is None:
+    return False
+
+  size, mtime_ns, file_hash, algorithm = fingerprint
+  try:
+    stat = path.stat()
+    if stat.st_size == size and (stat.st_mtime_ns == mtime_ns or hash_engine.hash_file(path, algorithm) == file_hash):
+      with applied_fingerprints_lock:
+        if path in applied_fingerprints:
+          applied_fingerprints[path] = (size, stat.st_mtime_ns, file_hash, algorithm)
+          applied_fingerprints.move_to_end(path)
+      return True
+  except OSError:
+    pass # Deleted since, which is a real change
+
+  with applied_fingerprints_lock:
+    applied_fingerprints.pop(path, None)
+  return False
+
 def check_inbox_worker(tracked_paths):
-  """Checks the file skip dictionary to see if there are any files in the inbox. If so, then handle them"""
+  """
+  Moves received files from the inbox to their destinations once they are stable.
+
+  Files still being written are checked again later instead of blocking the others.
+  Every pass applies all stable files at once and saves the tracked paths once.
+  """
+  applier = InboxApplier(
+    Path(settings_util.settings['local_inbox']),
+    stable_wait=settings_util.get_setting('inbox_stable_wait', STABLE_WAIT),
+    workers=settings_util.get_setting('inbox_apply_workers', INBOX_APPLY_WORKERS),
+    before_apply=record_applied_file
+  )
+
+  path_trie = PathTrie({tracked_path: tracked_path for tracked_path in tracked_paths})
+  tombstone_ttl = settings_util.get_setting('tombstone_ttl', delete_tombstones.DEFAULT_TOMBSTONE_TTL)
+  last_sweep = time.monotonic()
+
   while not threading_stop_event.is_set():
+    if time.monotonic() - last_sweep > tombstone_ttl:
+      delete_tombstones.sweep_tombstones(applier.inbox_path, tombstone_ttl)
+      last_sweep = time.monotonic()
+
     try:
-      src_path, last_update_time, action = inbox_queue.get(timeout=1)
-
-      # Ensures enough time has passed to handle the file
-      current_time = time.time()
-      if current_time - last_update_time <= STABLE_WAIT:
-        return
-      
-      if action == FileAction.SEND_FILE:
-        # ensure the path is inside the inbox
-        try:
-          rel_path = src_path.relative_to(settings_util.settings['local_inbox'])
-        except ValueError:
-          print(f"Path {src_path} is not inside the inbox base.")
-          return
-        
-        dest_path = Path("/") / rel_path
-        # Ensure destination directory exists
-        dest_path.parent.mkdir(parents=True, exist_ok=True)
-
-        try:
-          file_skip_dict[rel_path] = current_time
-          shutil.move(str(src_path), str(dest_path))
-          print(f"Moved {src_path} -> {dest_path}")
-        except Exception as e:
-          print(f"Failed to move file: {e}")
-          traceback.print_exc(e)
+      # Wake up for new events or when the next file is due for a stability check
+      src_path, last_update_time, action = inbox_queue.get(timeout=applier.next_check_in(1))
+      while True:
+        if action == FileAction.SEND_FILE:
+          applier.add(src_path, last_update_time)
+        src_path, last_update_time, action = inbox_queue.get_nowait()
     except Empty:
-      continue
-    threading_stop_event.set()
-    save_tracked_paths(tracked_paths)
-    time.sleep(.1)
+      pass
+
+    applied = applier.apply(applier.take_stable())
+    if applied:
+      print(f"Applied {len(applied)} files from the inbox.")
+      record_applied_entries(applied, path_trie, tracked_paths)
+      save_tracked_paths(tracked_paths)
 
 def start_monitoring(tracked_paths):
   event_handler = ChangeHandler(tracked_paths)
@@ -117,10 +290,12 @@ def start_monitoring(tracked_paths):
   inbox_path = settings_util.settings['local_inbox']
   observer.schedule(event_handler, inbox_path, recursive=True)
 
-  check_inbox_thread = threading.Thread(target=check_inbox_worker, args=(tracked_paths),daemon=True)
+  check_inbox_thread = threading.Thread(target=check_inbox_worker, args=(tracked_paths,),daemon=True)
   check_inbox_thread.start()
 
   observer.start()
+  # Changes made while the program was down, now that new ones are caught by the observer
+  start_reconciliation(tracked_paths)
 
   print("Monitoring started. Press Ctrl+C to stop.")
   try:
@@ -0,0 +1,63 @@
+import random
+import threading
+import time
+
+class HostCircuitBreaker:
+  """
+  Stops connection attempts to hosts that keep failing.
+
+  After failure_threshold consecutive connection failures to a (user, host) key the breaker
+  opens: callers should park that host's work instead of connecting. A background thread
+  then probes the host with exponentially growing, jittered intervals and closes the breaker
+  (calling on_recover(key)) once a probe succeeds.
+  """
+  def __init__(self, probe, on_recover, failure_threshold=3, probe_interval=5, max_probe_interval=300):
+    self.probe = probe
+    self.on_recover = on_recover
+    self.failure_threshold = failure_threshold
+    self.probe_interval = probe_interval
+    self.max_probe_interval = max_probe_interval
+    self.failures = {} # [key] -> consecutive failures
+    self.open_keys = set()
+    self.lock = threading.Lock()
+
+  def configure(self, failure_threshold, probe_interval, max_probe_interval):
+    with self.lock:
+      self.failure_threshold = failure_threshold
+      self.probe_interval = probe_interval
+      self.max_probe_interval = max_probe_interval
+
+  def is_open(self, key) -> bool:
+    with self.lock:
+      return key in self.open_keys
+
+  def record_success(self, key):
+    with self.lock:
+      self.failures.pop(key, None)
+
+  def record_failure(self, key):
+    with self.lock:
+      self.failures[key] = self.failures.get(key, 0) + 1
+      if key in self.open_keys or self.failures[key] < self.failure_threshold:
+        return
+      self.open_keys.add(key)
+    print(f"{key[0]}@{key[1]} failed {self.failure_threshold} times in a row, parking its transfers until it is reachable again.")
+    threading.Thread(target=self._probe_worker, args=(key,), daemon=True).start()
+
+  def _probe_worker(self, key):
+    interval = self.probe_interval
+    while True:
+      time.sleep(interval * random.uniform(0.8, 1.2))
+      try:
+        reachable = self.probe(key)
+      except Exception:
+        reachable = False
+      if reachable:
+        break
+      interval = min(interval * 2, self.max_probe_interval)
+
+    with self.lock:
+      self.open_keys.discard(key)
+      self.failures.pop(key, None)
+    print(f"{key[0]}@{key[1]} is reachable again, resuming its transfers.")
+    self.on_recover(key)
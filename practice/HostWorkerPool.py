@@ -0,0 +1,68 @@
+import contextvars
+import threading
+import queue
+from concurrent.futures import Future
+
+class HostWorkerPool:
+  """
+  Runs jobs on per-host worker threads.
+
+  Every (user, host) key gets its own job queue and worker, so a slow host only
+  delays its own jobs. A semaphore per group of jobs caps how many of the group run
+  at the same time, so one group's long jobs never take every slot from another's.
+  Each job runs in a copy of the context it was submitted from.
+  """
+  def __init__(self, max_concurrency=4, idle_timeout=60):
+    self.max_concurrency = max_concurrency
+    self.idle_timeout = idle_timeout
+    self.semaphores = {} # [group] -> BoundedSemaphore(max_concurrency)
+    self.queues = {}
+    self.workers = {}
+    self.lock = threading.Lock()
+
+  def set_max_concurrency(self, max_concurrency):
+    """Changes the per group concurrency cap. Meant to be called before any jobs are submitted."""
+    with self.lock:
+      self.max_concurrency = max_concurrency
+      self.semaphores = {}
+
+  def get_semaphore(self, group) -> threading.BoundedSemaphore:
+    with self.lock:
+      if group not in self.semaphores:
+        self.semaphores[group] = threading.BoundedSemaphore(self.max_concurrency)
+      return self.semaphores[group]
+
+  def submit(self, key, fn, *args, group=None) -> Future:
+    """Queues fn(*args) on the worker for the key and returns a future for its result. It counts against the group's cap."""
+    future = Future()
+    semaphore = self.get_semaphore(group)
+    with self.lock:
+      if key not in self.queues:
+        self.queues[key] = queue.Queue()
+        worker = threading.Thread(target=self._worker, args=(key, self.queues[key]), daemon=True)
+        self.workers[key] = worker
+        worker.start()
+      self.queues[key].put((future, fn, args, semaphore, contextvars.copy_context()))
+    return future
+
+  def _worker(self, key, job_queue):
+    while True:
+      try:
+        future, fn, args, semaphore, context = job_queue.get(timeout=self.idle_timeout)
+      except queue.Empty:
+        with self.lock:
+          # Only retire if nothing was queued while we waited for the lock
+          if job_queue.empty():
+            del self.queues[key]
+            del self.workers[key]
+            return
+        continue
+
+      if not future.set_running_or_notify_cancel():
+        continue
+
+      with semaphore:
+        try:
+          future.set_result(context.run(fn, *args))
+        except Exception as e:
+          future.set_exception(e)
@@ -0,0 +1,110 @@
+import heapq
+import itertools
+import os
+import shutil
+import stat
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from FileActions import PARTIAL_SUFFIX
+
+class InboxApplier:
+  """
+  Moves received files from the inbox to their destinations once they stop changing.
+
+  Only regular files are applied. A file is stable when two stats stable_wait apart see
+  the same size and modification time. Files that are still changing go back on a heap
+  ordered by when to look again, so one busy file never holds up the rest. Stable files
+  are applied in parallel, with os.replace when the inbox and the destination share a
+  filesystem.
+  """
+  def __init__(self, inbox_path : Path, stable_wait=1, workers=8, before_apply=None):
+    self.inbox_path = Path(inbox_path)
+    self.stable_wait = stable_wait
+    self.workers = workers
+    self.before_apply = before_apply # Optional callable, (source, destination) -> None, called just before a file is moved
+    self.heap = [] # (time to check, sequence, path)
+    self.sequence = itertools.count()
+    self.last_seen = {} # [path] -> (size, mtime_ns) at the last check
+    self.queued = set()
+
+  def add(self, path : Path, event_time : float):
+    """Schedules a check of a file that changed at event_time. Repeated events only push back its stability."""
+    self.last_seen.pop(path, None)
+    if path in self.queued:
+      return
+    self.queued.add(path)
+    heapq.heappush(self.heap, (event_time + self.stable_wait, next(self.sequence), path))
+
+  def next_check_in(self, default : float) -> float:
+    """Seconds until the next file is due for a check."""
+    if not self.heap:
+      return default
+    return max(0, min(default, self.heap[0][0] - time.time()))
+
+  def take_stable(self) -> list:
+    """Checks every due file. Returns the stable ones and requeues the ones still changing."""
+    now = time.time()
+    stable = []
+    while self.heap and self.heap[0][0] <= now:
+      _, _, path = heapq.heappop(self.heap)
+      try:
+        path_stat = path.stat()
+      except FileNotFoundError:
+        path_stat = None
+      if path_stat is None or not stat.S_ISREG(path_stat.st_mode):
+        # Gone, or a directory: moving a directory would take uploads still running inside it along
+        self.queued.discard(path)
+        self.last_seen.pop(path, None)
+        continue
+
+      signature = (path_stat.st_size, path_stat.st_mtime_ns)
+      if self.last_seen.get(path) == signature:
+        self.queued.discard(path)
+        del self.last_seen[path]
+        stable.append(path)
+      else:
+        self.last_seen[path] = signature
+        heapq.heappush(self.heap, (now + self.stable_wait, next(self.sequence), path))
+    return stable
+
+  def apply(self, paths : list) -> list:
+    """Moves the files to their destinations in parallel. Returns the destinations of the files moved."""
+    if not paths:
+      return []
+    if len(paths) == 1 or self.workers <= 1:
+      results = [self.apply_file(path) for path in paths]
+    else:
+      with ThreadPoolExecutor(max_workers=self.workers) as executor:
+        results = list(executor.map(self.apply_file, paths))
+    return [dest_path for dest_path in results if dest_path is not None]
+
+  def get_destination(self, src_path : Path) -> Path:
+    # The inbox mirrors the destination's absolute path
+    return Path("/") / src_path.relative_to(self.inbox_path)
+
+  def apply_file(self, src_path : Path):
+    try:
+      dest_path = self.get_destination(src_path)
+    except ValueError:
+      print(f"Path {src_path} is not inside the inbox base.")
+      return None
+
+    try:
+      dest_path.parent.mkdir(parents=True, exist_ok=True)
+      if self.before_apply:
+        self.before_apply(src_path, dest_path)
+
+      if os.stat(src_path).st_dev == os.stat(dest_path.parent).st_dev:
+        os.replace(src_path, dest_path)
+      else:
+        # Copy next to the destination under a partial name first, so it only ever appears complete
+        partial_path = dest_path.with_name(dest_path.name + PARTIAL_SUFFIX)
+        shutil.copy2(src_path, partial_path)
+        os.replace(partial_path, dest_path)
+        os.remove(src_path)
+      print(f"Moved {src_path} -> {dest_path}")
+      return dest_path
+    except Exception as e:
+      print(f"Failed to move {src_path} to {dest_path}: {e}")
+      return None
@@ -0,0 +1,220 @@
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+from MerkleTree import MerkleTree
+
+# Compact once the change log has this many records and at least a quarter as many as the index has entries
+COMPACT_MIN_RECORDS = 1000
+
+class LiveIndex:
+  """
+  A tracked folder's file index kept in memory and updated in place.
+
+  Entries are keyed by path relative to the tracked folder. Changes are appended to a
+  log next to the JSON snapshot, so a one-file change costs one log line instead of
+  rewriting the whole index. The log is folded into the snapshot once it grows.
+
+  A Merkle tree of the entries is kept alongside and saved with each snapshot.
+  """
+  def __init__(self, snapshot_file : Path, log_file : Path, tree_file : Path):
+    self.snapshot_file = snapshot_file
+    self.log_file = log_file
+    self.tree_file = tree_file
+    self.entries = {}
+    self.tree = None
+    self.by_hash = None # [hash] -> relative paths with that content, built on first use
+    self.log_records = 0
+    self.lock = threading.RLock()
+    self.load()
+
+  def load(self):
+    """Loads the snapshot and its tree, then replays the change log on top of both."""
+    with self.lock:
+      self.entries = {}
+      self.tree = None
+      self.by_hash = None
+      if self.snapshot_file.exists():
+        with open(self.snapshot_file, 'rb') as f:
+          snapshot = f.read()
+        self.entries = json.loads(snapshot)
+        self.tree = self._load_tree(hashlib.sha256(snapshot).hexdigest())
+
+      self.log_records = 0
+      if self.log_file.exists():
+        with open(self.log_file, 'r') as f:
+          for line in f:
+            try:
+              record = json.loads(line)
+            except json.JSONDecodeError:
+              break # Partially written last line from a crash
+            self._apply(record)
+            self.log_records += 1
+
+      if self.tree is None:
+        self.tree = MerkleTree.from_entries(self.entries)
+
+  def _load_tree(self, snapshot_digest : str):
+    """Loads the saved tree if it was written with this exact snapshot, otherwise returns None."""
+    if not self.tree_file.exists():
+      return None
+    try:
+      with open(self.tree_file, 'r') as f:
+        data = json.load(f)
+    except json.JSONDecodeError:
+      return None
+    if data.get("index_digest") != snapshot_digest:
+      return None
+    return MerkleTree.from_dict(data)
+
+  def root_hash(self) -> str:
+    with self.lock:
+      return self.tree.root_hash()
+
+  def get(self, relative_path : str, default=None):
+    with self.lock:
+      return self.entries.get(relative_path, default)
+
+  def __contains__(self, relative_path):
+    with self.lock:
+      return relative_path in self.entries
+
+  def __len__(self):
+    with self.lock:
+      return len(self.entries)
+
+  def items(self):
+    """Returns a copy of the entries, safe to iterate while the index changes."""
+    with self.lock:
+      return list(self.entries.items())
+
+  def find_by_hash(self, file_hash : str) -> list:
+    """Relative paths of the entries whose content has the given hash."""
+    with self.lock:
+      if self.by_hash is None:
+        self.by_hash = {}
+        for path, entry in self.entries.items():
+          self._add_hash(path, entry)
+      return list(self.by_hash.get(file_hash, ()))
+
+  def diff(self, tree : MerkleTree) -> list:
+    """Relative paths of the files that differ between the index and another tree, e.g. one from a fresh scan."""
+    with self.lock:
+      return self.tree.diff(tree)
+
+  def update(self, entries : dict, removed = ()):
+    """Sets the entries ([relative_path] -> entry) and removes the given paths."""
+    records = [{"op": "set", "path": path, "entry": entry} for path, entry in entries.items()]
+    records += [{"op": "del", "path": path} for path in removed]
+    self._commit(records)
+
+  def remove_tree(self, relative_path : str):
+    """Removes a file entry, or every entry below a directory."""
+    self._commit([{"op": "del_tree", "path": relative_path}])
+
+  def move(self, old_path : str, new_path : str):
+    """Moves a file entry, or every entry below a directory, to a new relative path."""
+    self._commit([{"op": "move", "path": old_path, "to": new_path}])
+
+  def replace_all(self, entries : dict):
+    """Replaces the whole index, e.g. after a full rebuild, and writes a fresh snapshot."""
+    with self.lock:
+      self.entries = dict(entries)
+      self.tree = MerkleTree.from_entries(self.entries)
+      self.by_hash = None
+      self.compact()
+
+  def compact(self):
+    """Writes the entries to a new snapshot and truncates the change log."""
+    with self.lock:
+      self.snapshot_file.parent.mkdir(parents=True, exist_ok=True)
+      snapshot = json.dumps(self.entries, indent=2).encode()
+      self._write_file(self.snapshot_file, snapshot)
+
+      # Tagged with the snapshot's digest so a tree from a different snapshot is never trusted
+      tree_data = {"index_digest": hashlib.sha256(snapshot).hexdigest(), **self.tree.to_dict()}
+      self._write_file(self.tree_file, json.dumps(tree_data).encode())
+
+      self.log_file.unlink(missing_ok=True)
+      self.log_records = 0
+
+  @staticmethod
+  def _write_file(path : Path, data : bytes):
+    temp_file = path.with_suffix(".tmp")
+    with open(temp_file, 'wb') as f:
+      f.write(data)
+    os.replace(temp_file, path)
+
+  def _commit(self, records : list):
+    if not records:
+      return
+    with self.lock:
+      for record in records:
+        self._apply(record)
+
+      self.log_file.parent.mkdir(parents=True, exist_ok=True)
+      with open(self.log_file, 'a') as f:
+        f.write("".join(json.dumps(record) + "\n" for record in records))
+      self.log_records += len(records)
+
+      if self.log_records >= max(COMPACT_MIN_RECORDS, len(self.entries) // 4):
+        self.compact()
+
+  def _apply(self, record : dict):
+    op = record["op"]
+    path = record["path"]
+    if op == "set":
+      self._set_entry(path, record["entry"])
+      if self.tree is not None:
+        self.tree.update_file(path, record["entry"])
+    elif op == "del":
+      if self._pop_entry(path) is not None and self.tree is not None:
+        self.tree.remove(path)
+    elif op == "del_tree":
+      self._pop_entry(path)
+      if self.tree is not None:
+        # The tree knows the directory's files, so only that subtree is visited
+        for key in self.tree.list_files(path):
+          self._pop_entry(key)
+        self.tree.remove(path)
+      else:
+        prefix = path.rstrip("/") + "/"
+        for key in [key for key in self.entries if key.startswith(prefix)]:
+          self._pop_entry(key)
+    elif op == "move":
+      new_path = record["to"]
+      if self.tree is not None:
+        old_keys = [path] if path in self.entries else self.tree.list_files(path)
+      else:
+        prefix = path.rstrip("/") + "/"
+        old_keys = [key for key in self.entries if key == path or key.startswith(prefix)]
+      moved = {new_path + key[len(path):]: self._pop_entry(key) for key in old_keys if key in self.entries}
+      for key, entry in moved.items():
+        self._set_entry(key, entry)
+      if self.tree is not None:
+        self.tree.remove(path)
+        for key, entry in moved.items():
+          self.tree.update_file(key, entry)
+
+  def _set_entry(self, path : str, entry : dict):
+    self._remove_hash(path, self.entries.get(path))
+    self.entries[path] = entry
+    self._add_hash(path, entry)
+
+  def _pop_entry(self, path : str):
+    entry = self.entries.pop(path, None)
+    self._remove_hash(path, entry)
+    return entry
+
+  def _add_hash(self, path : str, entry : dict):
+    if self.by_hash is not None and entry and entry.get("hash"):
+      self.by_hash.setdefault(entry["hash"], set()).add(path)
+
+  def _remove_hash(self, path : str, entry : dict):
+    if self.by_hash is not None and entry and entry.get("hash"):
+      paths = self.by_hash.get(entry["hash"])
+      if paths is not None:
+        paths.discard(path)
+        if not paths:
+          del self.by_hash[entry["hash"]]
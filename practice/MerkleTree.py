@@ -0,0 +1,163 @@
+import hashlib
+import posixpath
+
+# Entry fields that make up a file's leaf hash. Metadata only by default, so a tree built
+# from a stat scan compares equal to one built from an index of the same files.
+METADATA_LEAF_KEYS = ("size", "modified_time")
+# For trees from different machines, where modification times do not carry over
+CONTENT_LEAF_KEYS = ("size", "hash")
+
+class MerkleTree:
+  """
+  Per-directory hash tree over the files of a tracked folder.
+
+  A directory's hash is derived from its children's names and hashes, so changing one
+  file only recomputes the hashes of its ancestor directories, and two trees can be
+  compared by descending only into subdirectories whose hashes differ.
+  Paths are relative to the tracked folder, the root directory is "".
+  """
+  def __init__(self, leaf_keys=METADATA_LEAF_KEYS):
+    self.leaf_keys = tuple(leaf_keys)
+    self.dirs = {"": {}} # [directory] -> {[child name] -> (is_dir, hash)}
+    self.dir_hashes = {"": self._hash_children({})}
+
+  @classmethod
+  def from_entries(cls, entries : dict, leaf_keys=METADATA_LEAF_KEYS):
+    """Builds a tree from index style entries ([relative_path] -> entry), hashing each directory once."""
+    tree = cls(leaf_keys)
+    for relative_path, entry in entries.items():
+      parent, name = posixpath.split(relative_path)
+      tree._ensure_dir(parent)
+      tree.dirs[parent][name] = (False, tree.hash_leaf(name, entry))
+
+    # Deepest directories first so every child hash is final before its parent is hashed
+    for directory in sorted(tree.dirs, key=lambda d: d.count("/") + (d != ""), reverse=True):
+      tree._store_dir_hash(directory)
+    return tree
+
+  @classmethod
+  def from_dict(cls, data : dict):
+    tree = cls(data["leaf_keys"])
+    tree.dirs = {directory: {name: tuple(child) for name, child in children.items()} for directory, children in data["dirs"].items()}
+    tree.dir_hashes = dict(data["dir_hashes"])
+    return tree
+
+  def to_dict(self) -> dict:
+    return {"leaf_keys": list(self.leaf_keys), "dirs": self.dirs, "dir_hashes": self.dir_hashes}
+
+  def root_hash(self) -> str:
+    return self.dir_hashes[""]
+
+  def get_hash(self, relative_path : str):
+    """Hash of a directory or file in the tree, or None if it is not in the tree."""
+    if relative_path in self.dir_hashes:
+      return self.dir_hashes[relative_path]
+    parent, name = posixpath.split(relative_path)
+    child = self.dirs.get(parent, {}).get(name)
+    return child[1] if child else None
+
+  def hash_leaf(self, name : str, entry : dict) -> str:
+    fields = [name] + [str(entry.get(key)) for key in self.leaf_keys]
+    return hashlib.sha256("\0".join(fields).encode()).hexdigest()
+
+  def update_file(self, relative_path : str, entry : dict):
+    """Sets a file's leaf and recomputes its ancestor chain."""
+    parent, name = posixpath.split(relative_path)
+    self._ensure_dir(parent)
+    self.dirs[parent][name] = (False, self.hash_leaf(name, entry))
+    self._rehash_chain(parent)
+
+  def remove(self, relative_path : str):
+    """Removes a file or a whole directory and recomputes the ancestor chain."""
+    parent, name = posixpath.split(relative_path)
+    if relative_path in self.dirs:
+      prefix = relative_path + "/"
+      for directory in [d for d in self.dirs if d == relative_path or d.startswith(prefix)]:
+        del self.dirs[directory]
+        del self.dir_hashes[directory]
+    if parent not in self.dirs or self.dirs[parent].pop(name, None) is None:
+      return
+
+    # Directories only exist to hold files, so drop ones left empty
+    while parent and not self.dirs[parent]:
+      del self.dirs[parent]
+      del self.dir_hashes[parent]
+      parent, name = posixpath.split(parent)
+      self.dirs[parent].pop(name, None)
+    self._rehash_chain(parent)
+
+  def diff(self, other, directory : str = "") -> list:
+    """
+    Returns the relative paths of files that differ between the trees (changed, added or removed).
+    Only subdirectories whose hashes differ are visited.
+    """
+    if self.dir_hashes.get(directory) == other.dir_hashes.get(directory):
+      return []
+
+    changed = []
+    mine = self.dirs.get(directory, {})
+    theirs = other.dirs.get(directory, {})
+    for name in sorted(mine.keys() | theirs.keys()):
+      child_mine = mine.get(name)
+      child_theirs = theirs.get(name)
+      if child_mine == child_theirs:
+        continue
+
+      child_path = posixpath.join(directory, name) if directory else name
+      mine_is_dir = child_mine is not None and child_mine[0]
+      theirs_is_dir = child_theirs is not None and child_theirs[0]
+      if mine_is_dir and theirs_is_dir:
+        changed.extend(self.diff(other, child_path))
+        continue
+
+      # A file on at least one side; every file under a directory on the other side differs too
+      if (child_mine is not None and not mine_is_dir) or (child_theirs is not None and not theirs_is_dir):
+        changed.append(child_path)
+      if mine_is_dir:
+        changed.extend(self.list_files(child_path))
+      if theirs_is_dir:
+        changed.extend(other.list_files(child_path))
+    return changed
+
+  def list_files(self, directory : str = "") -> list:
+    """Relative paths of every file below a directory."""
+    files = []
+    for name, (is_dir, _) in self.dirs.get(directory, {}).items():
+      child_path = posixpath.join(directory, name) if directory else name
+      if is_dir:
+        files.extend(self.list_files(child_path))
+      else:
+        files.append(child_path)
+    return files
+
+  def _ensure_dir(self, directory : str):
+    """Adds a directory and any missing ancestors. Their hashes are set by the caller's rehash."""
+    if directory in self.dirs:
+      return
+    parent, name = posixpath.split(directory)
+    self._ensure_dir(parent)
+    self.dirs[directory] = {}
+    self.dir_hashes[directory] = None
+    self.dirs[parent][name] = (True, None)
+
+  def _rehash_chain(self, directory : str):
+    while True:
+      self._store_dir_hash(directory)
+      if directory == "":
+        return
+      directory = posixpath.dirname(directory)
+
+  def _store_dir_hash(self, directory : str):
+    dir_hash = self._hash_children(self.dirs[directory])
+    self.dir_hashes[directory] = dir_hash
+    if directory:
+      parent, name = posixpath.split(directory)
+      self.dirs[parent][name] = (True, dir_hash)
+
+  @staticmethod
+  def _hash_children(children : dict) -> str:
+    hasher = hashlib.sha256()
+    for name in sorted(children):
+      is_dir, child_hash = children[name]
+      hasher.update(f"{'d' if is_dir else 'f'}:{name}:{child_hash}\n".encode())
+    return hasher.hexdigest()
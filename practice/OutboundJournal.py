@@ -0,0 +1,132 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+# Compact once the log has this many records and at least twice as many as there are pending actions
+COMPACT_MIN_RECORDS = 1000
+COMPACT_INTERVAL = 30
+
+class OutboundJournal:
+  """
+  Append-only on-disk record of queued transfers, so pending work survives a restart.
+
+  Each queued action is recorded per destination and acked once delivered. Records are
+  buffered in memory and written with one append and fsync per flush, which the sender
+  does once per batch. A background thread rewrites the log with only the pending actions
+  once acked records make up most of it.
+  """
+  def __init__(self, log_file : Path, compact_interval=COMPACT_INTERVAL):
+    self.log_file = log_file
+    self.compact_interval = compact_interval
+    self.pending = {} # [(action, path)] -> {"tracked_path", "remote_dirs": {[remote_url] -> remote_info}, "old_path"}
+    self.buffer = []
+    self.log_records = 0
+    self.lock = threading.RLock()
+    self.compactor = None
+
+  def load(self):
+    """Replays the log into the pending actions."""
+    with self.lock:
+      self.pending = {}
+      self.log_records = 0
+      if not self.log_file.exists():
+        return
+      with open(self.log_file, 'r') as f:
+        for line in f:
+          try:
+            record = json.loads(line)
+          except json.JSONDecodeError:
+            break # Partially written last line from a crash
+          self._apply(record)
+          self.log_records += 1
+
+  def pending_actions(self) -> list:
+    """Returns (path, remote_dirs, tracked_path, action, old_path) for every action not yet delivered."""
+    with self.lock:
+      return [
+        (path, dict(info["remote_dirs"]), info["tracked_path"], action, info.get("old_path"))
+        for (action, path), info in self.pending.items()
+      ]
+
+  def record_queued(self, action : str, path : str, remote_dirs : dict, tracked_path : str, old_path : str = None):
+    self._add_record({"op": "queue", "action": action, "path": path, "remote_dirs": remote_dirs,
+                      "tracked_path": tracked_path, "old_path": old_path})
+
+  def record_delivered(self, action : str, path : str, remote_urls = None):
+    """Acks the action for the given destinations, or for all of them when remote_urls is None."""
+    with self.lock:
+      if (action, path) not in self.pending:
+        return
+      self._add_record({"op": "ack", "action": action, "path": path,
+                        "remote_urls": None if remote_urls is None else list(remote_urls)})
+
+  def flush(self):
+    """Writes the buffered records with one append and fsync."""
+    with self.lock:
+      if not self.buffer:
+        return
+      self.log_file.parent.mkdir(parents=True, exist_ok=True)
+      with open(self.log_file, 'a') as f:
+        f.write("".join(json.dumps(record) + "\n" for record in self.buffer))
+        f.flush()
+        os.fsync(f.fileno())
+      self.log_records += len(self.buffer)
+      self.buffer = []
+
+  def start_compactor(self):
+    if self.compactor is not None:
+      return
+    self.compactor = threading.Thread(target=self._compact_worker, daemon=True)
+    self.compactor.start()
+
+  def compact(self):
+    """Rewrites the log with one record per pending action."""
+    with self.lock:
+      self.flush()
+      records = [
+        {"op": "queue", "action": action, "path": path, **info}
+        for (action, path), info in self.pending.items()
+      ]
+      temp_file = self.log_file.with_suffix(".tmp")
+      with open(temp_file, 'w') as f:
+        f.write("".join(json.dumps(record) + "\n" for record in records))
+        f.flush()
+        os.fsync(f.fileno())
+      os.replace(temp_file, self.log_file)
+      self.log_records = len(records)
+
+  def _compact_worker(self):
+    while True:
+      time.sleep(self.compact_interval)
+      try:
+        with self.lock:
+          if self.log_records >= max(COMPACT_MIN_RECORDS, 2 * len(self.pending)):
+            self.compact()
+      except OSError as e:
+        print(f"Error compacting {self.log_file}: {e}")
+
+  def _add_record(self, record : dict):
+    with self.lock:
+      self._apply(record)
+      self.buffer.append(record)
+
+  def _apply(self, record : dict):
+    key = (record["action"], record["path"])
+    if record["op"] == "queue":
+      info = self.pending.setdefault(key, {"remote_dirs": {}})
+      info["tracked_path"] = record["tracked_path"]
+      info["old_path"] = record.get("old_path")
+      info["remote_dirs"].update(record["remote_dirs"])
+    elif record["op"] == "ack":
+      info = self.pending.get(key)
+      if info is None:
+        return
+      if record["remote_urls"] is None:
+        del self.pending[key]
+        return
+      for remote_url in record["remote_urls"]:
+        info["remote_dirs"].pop(remote_url, None)
+      if not info["remote_dirs"]:
+        del self.pending[key]
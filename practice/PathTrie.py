@@ -0,0 +1,42 @@
+import os
+
+class PathTrie:
+  """
+  Maps directory paths to values, keyed by path component.
+
+  find() returns the value of the deepest stored path that contains the given path,
+  walking one dictionary level per component without building Path objects.
+  """
+  def __init__(self, paths : dict = None):
+    self.root = {} # [component] -> node, where a node is {"children": {...}, "value": ...}
+    for path, value in (paths or {}).items():
+      self.insert(path, value)
+
+  @staticmethod
+  def split(path : str) -> list:
+    if os.sep != "/":
+      path = path.replace(os.sep, "/")
+    return [component for component in path.split("/") if component]
+
+  def insert(self, path : str, value):
+    children = self.root
+    node = None
+    for component in self.split(path):
+      node = children.setdefault(component, {"children": {}, "value": None, "has_value": False})
+      children = node["children"]
+    if node is not None:
+      node["value"] = value
+      node["has_value"] = True
+
+  def find(self, path : str, default=None):
+    """Returns the value of the deepest stored path equal to or containing path."""
+    found = default
+    children = self.root
+    for component in self.split(path):
+      node = children.get(component)
+      if node is None:
+        break
+      if node["has_value"]:
+        found = node["value"]
+      children = node["children"]
+    return found
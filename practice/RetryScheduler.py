@@ -0,0 +1,96 @@
+import random
+import threading
+import time
+
+class RetryScheduler:
+  """
+  Re-queues failed transfers after a jittered exponential backoff.
+
+  Entries are kept per (action, file, remote_url), so one failing destination does not
+  delay the others. Entries of hosts for which is_parked(host_key) is true are held until
+  release_host is called. Due entries are handed to
+  on_due(action, file, tracked_path, remote_dirs, old_path), grouped per action and file.
+  """
+  def __init__(self, on_due, is_parked, base_delay=2, max_delay=300):
+    self.on_due = on_due
+    self.is_parked = is_parked
+    self.base_delay = base_delay
+    self.max_delay = max_delay
+    self.entries = {} # [(action, file, remote_url)] -> {"tracked_path", "remote_info", "host_key", "old_path", "attempts", "due" (None once handed out)}
+    self.condition = threading.Condition()
+    self.thread = None
+
+  def configure(self, base_delay, max_delay):
+    with self.condition:
+      self.base_delay = base_delay
+      self.max_delay = max_delay
+
+  def start(self):
+    if self.thread is None:
+      self.thread = threading.Thread(target=self._worker, daemon=True)
+      self.thread.start()
+
+  def schedule(self, action, file : str, tracked_path : str, remote_url : str, remote_info : dict, host_key : tuple, old_path : str = None, count_attempt=True):
+    """Schedules a retry. Attempts that did not reach the host (count_attempt=False) do not grow the backoff."""
+    with self.condition:
+      entry = self.entries.get((action, file, remote_url))
+      attempts = entry["attempts"] if entry else 0
+      if count_attempt:
+        attempts += 1
+      # Full jitter keeps retries of many files to the same host from arriving in lockstep
+      delay = min(self.max_delay, self.base_delay * 2 ** max(attempts - 1, 0)) * random.uniform(0.5, 1)
+      self.entries[(action, file, remote_url)] = {
+        "tracked_path": tracked_path,
+        "remote_info": remote_info,
+        "host_key": host_key,
+        "old_path": old_path,
+        "attempts": attempts,
+        "due": time.monotonic() + delay
+      }
+      self.condition.notify()
+    if count_attempt:
+      print(f"Retrying {file} -> {remote_url} in {delay:.1f}s (attempt {attempts})")
+
+  def forget(self, action, file : str, remote_urls):
+    """Drops the retries of destinations the action was delivered to."""
+    with self.condition:
+      for remote_url in remote_urls:
+        self.entries.pop((action, file, remote_url), None)
+
+  def release_host(self, host_key : tuple):
+    """Makes every held entry of the host due now."""
+    now = time.monotonic()
+    with self.condition:
+      for entry in self.entries.values():
+        if entry["host_key"] == host_key and entry["due"] is not None:
+          entry["due"] = now
+      self.condition.notify()
+
+  def __len__(self):
+    with self.condition:
+      return len(self.entries)
+
+  def _worker(self):
+    while True:
+      with self.condition:
+        due = {} # [(action, file)] -> (tracked_path, old_path, {[remote_url] -> remote_info})
+        next_due = None
+        now = time.monotonic()
+        for key, entry in list(self.entries.items()):
+          if entry["due"] is None or self.is_parked(entry["host_key"]):
+            continue
+          if entry["due"] <= now:
+            action, file, remote_url = key
+            due.setdefault((action, file), (entry["tracked_path"], entry["old_path"], {}))[2][remote_url] = entry["remote_info"]
+            # Kept until the next send succeeds (forget) or fails again (schedule), but not due again meanwhile
+            entry["due"] = None
+          elif next_due is None or entry["due"] < next_due:
+            next_due = entry["due"]
+
+        if not due:
+          # Parked hosts are released through release_host, which notifies
+          self.condition.wait(None if next_due is None else next_due - now)
+          continue
+
+      for (action, file), (tracked_path, old_path, remote_dirs) in due.items():
+        self.on_due(action, file, tracked_path, remote_dirs, old_path)
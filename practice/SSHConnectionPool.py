@@ -2,71 +2,246 @@ import time
 import paramiko
 import threading
 
+class PooledConnection:
+  def __init__(self, ssh, now):
+    self.ssh = ssh
+    self.last_used = now
+    self.in_use = 0 # Number of checkouts not checked in yet
+
+  def is_alive(self):
+    transport = self.ssh.get_transport()
+    return transport is not None and transport.is_active()
+
 class SSHConnectionPool:
-  def __init__(self, timeout=180, max_connections=10):
+  """
+  Pool of SSH connections keyed by (user, host).
+
+  Connecting only holds that key's lock, so a slow handshake to one host does not block
+  the others. A key can hold up to max_per_host connections: checkout prefers an idle one,
+  opens another below the cap and shares the least busy one at the cap. The total is capped
+  at max_connections by closing the least recently used idle connections.
+  Idle reaping and keepalive checks run on a background thread started with start().
+  """
+  def __init__(self, timeout=180, max_connections=10, connect_timeout=15, max_per_host=2, health_check_interval=30, connect_options=None):
     self.timeout = timeout
     self.max_connections = max_connections
-    self.connections = {}
-    self.lock = threading.RLock() # Use RLock to allow re-entrant locking
+    self.connect_timeout = connect_timeout # Seconds before a connect to an unreachable host gives up
+    self.max_per_host = max_per_host
+    self.health_check_interval = health_check_interval
+    self.connect_options = connect_options # Optional callable, host -> extra keyword arguments for SSHClient.connect
+    self.connections = {} # [(user, host)] -> [PooledConnection]
+    self.remote_dirs = {} # [(user, host)] -> set of remote directories known to exist on that host
+    self.key_locks = {} # [(user, host)] -> lock held while connecting to that host
+    self.lock = threading.Lock() # Guards the dictionaries only, never held while connecting
+    self.maintenance_thread = None
 
-  def get_connection(self, user, host, ssh_key_path):
+  def checkout(self, user, host, ssh_key_path):
+    """
+    Returns a live connection to the host, connecting if needed, or None if it cannot connect.
+    Every connection returned must be handed back with checkin.
+    """
+    key = (user, host)
+    with self._get_key_lock(key):
+      with self.lock:
+        conn = self._find_connection(key)
+        if conn is not None:
+          conn.in_use += 1
+          conn.last_used = time.time()
+          return conn.ssh
+
+      ssh = self._connect(user, host, ssh_key_path)
+      if ssh is None:
+        return None
+
+      conn = PooledConnection(ssh, time.time())
+      conn.in_use = 1
+      with self.lock:
+        self.connections.setdefault(key, []).append(conn)
+        self._evict_lru()
+      return ssh
+
+  def checkin(self, user, host, ssh):
     with self.lock:
-      # print("Acquiring SSH connection...")
-      now = time.time()
-      # print(f"Current time: {now}")
-      # print("Cleaning up old connections...")
-      self.cleanup(now)
-      # print("Cleaned up old connections.")
+      for conn in self.connections.get((user, host), []):
+        if conn.ssh is ssh:
+          conn.in_use = max(0, conn.in_use - 1)
+          conn.last_used = time.time()
+          return
+
+  def _find_connection(self, key):
+    """Drops dead connections of the key and picks one to use, or None if a new one should be opened."""
+    conns = self.connections.get(key, [])
+    live = []
+    for conn in conns:
+      if conn.is_alive():
+        live.append(conn)
+      else:
+        print(f"Transport dead for {key[0]}@{key[1]}, reconnecting...")
+        conn.ssh.close()
+    if len(live) != len(conns):
+      self._set_connections(key, live)
+
+    idle = [conn for conn in live if conn.in_use == 0]
+    if idle:
+      print(f"Reusing existing connection to {key[1]} as {key[0]}.")
+      return max(idle, key=lambda conn: conn.last_used)
+    if live and len(live) >= self.max_per_host:
+      return min(live, key=lambda conn: conn.in_use)
+    return None
+
+  def _set_connections(self, key, conns):
+    if conns:
+      self.connections[key] = conns
+    else:
+      # The cached directories may be stale once no connection has seen the host for a while
+      self.connections.pop(key, None)
+      self.remote_dirs.pop(key, None)
+
+  def _connect(self, user, host, ssh_key_path):
+    hostname, port = self.parse_host_port(host)
+    options = self.connect_options(host) if self.connect_options else {}
+    try:
+      ssh = paramiko.SSHClient()
+      ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+      print(f"Connecting to {host} as {user}...")
+      ssh.connect(
+        hostname=hostname,
+        port=port,
+        username=user,
+        key_filename=ssh_key_path,
+        timeout=self.connect_timeout,
+        **options
+      )
+      transport = ssh.get_transport()
+      if not transport or not transport.is_active():
+          raise Exception("SSH connection failed (transport is not active)")
+      transport.set_keepalive(30)
+      return ssh
+    except Exception as e:
+      print(f"Failed to connect to {host} as {user}: {e}")
+      return None
+
+  @staticmethod
+  def parse_host_port(host, default_port=22):
+    """Splits a host url such as 192.168.1.20:2222 into (hostname, port)."""
+    hostname, sep, port = host.rpartition(":")
+    if sep and port.isdigit() and ":" not in hostname:
+      return hostname, int(port)
+    return host, default_port
+
+  def _get_key_lock(self, key):
+    with self.lock:
+      return self.key_locks.setdefault(key, threading.Lock())
+
+  def _evict_lru(self):
+    """Closes the least recently used idle connections while the pool is over its cap."""
+    total = sum(len(conns) for conns in self.connections.values())
+    if total <= self.max_connections:
+      return
+    idle = sorted(
+      ((conn.last_used, key, conn) for key, conns in self.connections.items() for conn in conns if conn.in_use == 0),
+      key=lambda item: item[0]
+    )
+    for _, key, conn in idle[:total - self.max_connections]:
+      print(f"Connection pool is full, closing the idle connection to {key[1]} as {key[0]}.")
+      conn.ssh.close()
+      self._set_connections(key, [c for c in self.connections[key] if c is not conn])
+
+  def warm_up(self, targets, ssh_key_path):
+    """Connects to every (user, host) in targets concurrently so the first batch does not wait on handshakes."""
+    threads = []
+    for user, host in set(targets):
+      thread = threading.Thread(target=self._open_idle, args=(user, host, ssh_key_path), daemon=True)
+      thread.start()
+      threads.append(thread)
+    return threads
 
+  def _open_idle(self, user, host, ssh_key_path):
+    """Connects and hands the connection straight back, leaving it idle in the pool for the first checkout."""
+    ssh = self.checkout(user, host, ssh_key_path)
+    if ssh is not None:
+      self.checkin(user, host, ssh)
 
-      key = (user, host)
+  def start(self):
+    """Starts the background thread that reaps idle connections and checks the health of the rest."""
+    if self.maintenance_thread is None:
+      self.maintenance_thread = threading.Thread(target=self._maintenance_worker, daemon=True)
+      self.maintenance_thread.start()
+
+  def _maintenance_worker(self):
+    while True:
+      time.sleep(self.health_check_interval)
       try:
+        self.cleanup()
+        self.check_health()
+      except Exception as e:
+        print(f"Error while maintaining SSH connections: {e}")
 
-        if key in self.connections:
-          ssh, _ = self.connections[key]
-          if ssh.get_transport() is None or not ssh.get_transport().is_active():
-            print(f"Transport dead for {user}@{host}, reconnecting...")
-            ssh.close()
-            del self.connections[key]  # Remove stale connection
-          else:
-            self.connections[key] = (ssh, now)
-            print(f"Reusing existing connection to {host} as {user}.")
-            return ssh
-        else:
-          ssh = paramiko.SSHClient()
-          ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-          print(f"Connecting to {host} as {user}...")
-          ssh.connect(
-            hostname=host,
-            username=user,
-            key_filename=ssh_key_path
-          )
-          transport = ssh.get_transport()
-          if not transport or not transport.is_active():
-              raise Exception("SSH connection failed (transport is not active)")
-          transport.set_keepalive(30)
-          self.connections[key] = (ssh, now)
-          return ssh
+  def check_health(self):
+    """Sends a keepalive on every idle connection and drops the ones that no longer answer."""
+    with self.lock:
+      idle = [(key, conn) for key, conns in self.connections.items() for conn in conns if conn.in_use == 0]
+
+    dead = []
+    for key, conn in idle:
+      try:
+        if not conn.is_alive():
+          raise EOFError("transport closed")
+        conn.ssh.get_transport().send_ignore()
+      except Exception:
+        dead.append((key, conn))
+
+    with self.lock:
+      for key, conn in dead:
+        print(f"Connection to {key[1]} as {key[0]} failed its health check, closing it.")
+        conn.ssh.close()
+        self._set_connections(key, [c for c in self.connections.get(key, []) if c is not conn])
+
+  def open_sftp_channels(self, ssh, count):
+    """
+    Opens up to count SFTP sessions on the connection's transport.
+
+    Each session is its own channel, so they can run requests concurrently.
+    Stops early if the server refuses more sessions (e.g. sshd MaxSessions) as long as one is open.
+    """
+    sftp_clients = []
+    for _ in range(max(1, count)):
+      try:
+        sftp_clients.append(ssh.open_sftp())
       except Exception as e:
-        print(f"Failed to connect to {host} as {user}: {e}")
-        return None
-      
+        if not sftp_clients:
+          raise
+        print(f"Could only open {len(sftp_clients)} of {count} SFTP channels: {e}")
+        break
+    return sftp_clients
+
+  def get_remote_dir_cache(self, user, host) -> set:
+    """
+    Returns the set of remote directories known to exist for the host.
+    It is dropped whenever the host's last connection is closed.
+    """
+    with self.lock:
+      return self.remote_dirs.setdefault((user, host), set())
+
   def cleanup(self, now=None):
+    """Closes connections that have been idle for longer than the timeout."""
     if now is None:
       now = time.time()
-    to_close = []
     with self.lock:
-      # Close connections that have been idle for longer than the timeout
-      for key, (ssh, last_used) in list(self.connections.items()):
-        if now - last_used > self.timeout:
-          ssh.close()
-          to_close.append(key)
-      for key in to_close:
-        del self.connections[key]
+      for key, conns in list(self.connections.items()):
+        keep = []
+        for conn in conns:
+          if conn.in_use == 0 and now - conn.last_used > self.timeout:
+            conn.ssh.close()
+          else:
+            keep.append(conn)
+        self._set_connections(key, keep)
 
   def close_all(self):
     with self.lock:
       # Close all connections
-      for ssh, _ in self.connections.values():
-        ssh.close()
+      for conns in self.connections.values():
+        for conn in conns:
+          conn.ssh.close()
       self.connections.clear()
+      self.remote_dirs.clear()
@@ -0,0 +1,95 @@
+import threading
+from pathlib import Path
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+
+class SendLanes:
+  """
+  Splits sends into an interactive lane and a bulk lane.
+
+  Small files, and files edited moments ago up to a larger size, stay in the interactive
+  lane, which is the sender's own batch. The rest is handed to the bulk lane, which sends
+  on its own thread, host workers and connections. A large upload then never holds up the
+  next batch of small edits, and the bulk lane still makes progress between them.
+  Files the bulk lane has taken stay in flight until its batch is settled, so deletes
+  and renames of them can be held back until then.
+  """
+  def __init__(self):
+    self.pending = {} # [file] -> {"remote_dirs", "tracked_path"} handed over and not taken yet
+    self.in_flight = set() # Files taken by the bulk lane whose batch is not settled yet
+    self.condition = threading.Condition()
+
+  @staticmethod
+  def classify(size : int, age : float, policy : dict) -> str:
+    """
+    Picks the lane of a file from its size and seconds since its last modification.
+    policy holds "lane" (forces a lane when set), "interactive_max_size", "recent_max_size" and "recent_seconds".
+    """
+    if policy["lane"] in (INTERACTIVE, BULK):
+      return policy["lane"]
+    if size <= policy["interactive_max_size"]:
+      return INTERACTIVE
+    if age <= policy["recent_seconds"] and size <= policy["recent_max_size"]:
+      return INTERACTIVE
+    return BULK
+
+  @staticmethod
+  def share_channels(channel_count : int, lane : str, weights : dict) -> int:
+    """The lane's share of a host's SFTP channels, by lane weight. The interactive lane, whose batches are short, keeps them all."""
+    if lane != BULK:
+      return channel_count
+    total = weights[INTERACTIVE] + weights[BULK]
+    return max(1, round(channel_count * weights[BULK] / total)) if total > 0 else channel_count
+
+  def hand_off(self, file : str, info : dict):
+    """Queues a file for the bulk lane, merging its destinations with any already waiting."""
+    with self.condition:
+      queued = self.pending.get(file)
+      self.pending[file] = {
+        "remote_dirs": {**queued["remote_dirs"], **info["remote_dirs"]} if queued else info["remote_dirs"],
+        "tracked_path": info["tracked_path"]
+      }
+      self.condition.notify_all()
+
+  def claim(self, file : str) -> tuple:
+    """
+    Lets the interactive lane send a file. Returns (False, None) while the bulk lane is sending it,
+    otherwise (True, the info of its waiting bulk item, now dropped, or None).
+    """
+    with self.condition:
+      if file in self.in_flight:
+        return False, None
+      return True, self.pending.pop(file, None)
+
+  def take(self) -> dict:
+    """Waits until files were handed over and returns all of them. They are in flight until finish is called."""
+    with self.condition:
+      while not self.pending:
+        self.condition.wait()
+      pending, self.pending = self.pending, {}
+      self.in_flight.update(pending)
+      return pending
+
+  def finish(self, files):
+    """Marks a taken batch as settled."""
+    with self.condition:
+      self.in_flight.difference_update(files)
+      self.condition.notify_all()
+
+  @staticmethod
+  def is_below(file : str, paths : set) -> bool:
+    """Whether the file is one of the paths or inside one of them."""
+    return file in paths or any(str(parent) in paths for parent in Path(file).parents)
+
+  def cancel(self, paths : set) -> dict:
+    """Drops the pending files at or below paths and returns them ([file] -> info)."""
+    with self.condition:
+      cancelled = {file: info for file, info in self.pending.items() if self.is_below(file, paths)}
+      for file in cancelled:
+        del self.pending[file]
+      return cancelled
+
+  def is_sending(self, paths : set) -> bool:
+    with self.condition:
+      return any(self.is_below(file, paths) for file in self.in_flight)
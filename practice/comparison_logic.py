@@ -1,12 +1,17 @@
-from tracker_utils import compute_folder_hash
+from tracker_utils import build_folder_tree
 from pathlib import Path
 from file_indexer_hasher import generate_file_hash
+from MerkleTree import MerkleTree
 
 
 def compare_folder_hash(folder : Path, old_hash: str = None) -> tuple:
-  new_hash = compute_folder_hash(folder)
+  new_hash = build_folder_tree(folder).root_hash()
   return old_hash != new_hash, new_hash
 
-def compare_file_hash(file_path: Path, old_hash: str = None) -> tuple:
-  new_hash = generate_file_hash(file_path)
+def compare_folder_trees(old_tree : MerkleTree, new_tree : MerkleTree) -> list:
+  """Returns the files that differ between two trees, descending only into subtrees whose hashes differ."""
+  return old_tree.diff(new_tree)
+
+def compare_file_hash(file_path: Path, old_hash: str = None, algorithm: str = None) -> tuple:
+  new_hash = generate_file_hash(file_path, algorithm)
   return old_hash != new_hash, new_hash
@@ -0,0 +1,246 @@
+import json
+import shlex
+from collections import namedtuple
+import paramiko
+import settings_util
+import transfer_stats
+import tracker_utils
+import file_indexer_hasher
+import delta_sync
+from FileActions import PARTIAL_SUFFIX
+
+# 'copy' copies content the remote already holds instead of sending it, 'link' hardlinks it
+# (both remote paths then share one inode, so an in-place edit shows in both), 'off' always sends
+DEFAULT_DEDUP_MODE = "copy"
+# Smaller files cost less to send than to look up and copy
+DEFAULT_DEDUP_MIN_SIZE = 64 * 1024
+# Remote copies tried per file before it is sent after all
+MAX_DEDUP_SOURCES = 3
+
+# Reads a JSON request from stdin and prints {"copied": [bool per copy], "stored": count}.
+# Each copy tries its sources in order, checking the size (and the hash unless "verify" is off),
+# and places the first match at its target through a partial file. Each store entry copies
+# the first existing source of the right size into the hash store, if the hash is not there yet.
+# Files are never linked to or from the store, so an in-place edit of a delivered file cannot change it.
+REMOTE_DEDUP_SCRIPT = r'''
+import hashlib, json, os, shutil, sys
+request = json.load(sys.stdin)
+
+def matches(path, size, algorithm, expected):
+  if os.path.getsize(path) != size:
+    return False
+  if not request["verify"]:
+    return True
+  hasher = hashlib.new(algorithm)
+  with open(path, "rb") as f:
+    for chunk in iter(lambda: f.read(1 << 20), b""):
+      hasher.update(chunk)
+  return hasher.hexdigest() == expected
+
+def in_store(path):
+  return bool(request["store_root"]) and path.startswith(request["store_root"] + "/")
+
+def place(source, target, link, allow_copy):
+  os.makedirs(os.path.dirname(target), exist_ok=True)
+  partial = target + "''' + PARTIAL_SUFFIX + r'''"
+  if os.path.lexists(partial):
+    os.remove(partial)
+  try:
+    if not link:
+      raise OSError("copy requested")
+    os.link(source, partial)
+  except OSError:
+    if not allow_copy:
+      raise
+    shutil.copyfile(source, partial)
+  os.replace(partial, target)
+
+copied = []
+for copy in request["copies"]:
+  done = False
+  for source in copy["sources"]:
+    try:
+      if matches(source, copy["size"], copy["algorithm"], copy["hash"]):
+        place(source, copy["target"], request["mode"] == "link" and not in_store(source), True)
+        done = True
+        break
+    except OSError:
+      pass
+  copied.append(done)
+
+stored = 0
+for entry in request["store"]:
+  if os.path.exists(entry["target"]):
+    continue
+  for source in entry["sources"]:
+    try:
+      if os.path.getsize(source) == entry["size"]:
+        place(source, entry["target"], False, True)
+        stored += 1
+        break
+    except OSError:
+      pass
+print(json.dumps({"copied": copied, "stored": stored}))
+'''
+
+# One file of a batch to be placed from content the remote already holds: (SendItem, hash, algorithm, remote source paths)
+DedupJob = namedtuple("DedupJob", ["item", "file_hash", "algorithm", "sources"])
+
+def get_mode(host : str) -> str:
+  return settings_util.get_host_setting(host, 'dedup_mode', DEFAULT_DEDUP_MODE)
+
+def get_min_size(host : str) -> int:
+  return settings_util.get_host_setting(host, 'dedup_min_size', DEFAULT_DEDUP_MIN_SIZE)
+
+def get_store_path(host : str, file_hash : str, algorithm : str):
+  """
+  Path of the content in the host's hash store ('dedup_store' under the host in config.yaml), or None without a store.
+  The store holds copies, since a hardlink would share the inode of the live remote file.
+  """
+  store = settings_util.get_host_setting(host, 'dedup_store')
+  if not store:
+    return None
+  return f"{store.rstrip('/')}/{algorithm}/{file_hash[:2]}/{file_hash}"
+
+def get_linked_roots(user : str, host : str) -> list:
+  """(tracked folder, remote folder, destination as index entries record it) of every linked path on the host."""
+  roots = []
+  for tracked_path, info in tracker_utils.load_tracked_paths().items():
+    for remote_info in (info.get("linked_paths") or {}).values():
+      if (remote_info["user"], remote_info["host_url"]) == (user, host):
+        remote_root = f"{remote_info['base_path']}/{remote_info['remote_path']}"
+        roots.append((tracked_path, remote_root, file_indexer_hasher.format_destination(user, host, remote_root)))
+  return roots
+
+def find_remote_sources(item, file_hash : str, algorithm : str, roots : list, host : str) -> list:
+  """
+  Remote paths that should hold the content already: the hash store, then files the indexes
+  record as delivered to that remote folder with the same hash, starting with the item's own tracked folder.
+  """
+  sources = []
+  store_path = get_store_path(host, file_hash, algorithm)
+  if store_path:
+    sources.append(store_path)
+
+  for tracked_path, remote_root, destination in sorted(roots, key=lambda root: root[0] != item.tracked_path):
+    index = file_indexer_hasher.get_live_index(file_indexer_hasher.get_index_key(tracked_path))
+    for relative in index.find_by_hash(file_hash):
+      if (tracked_path, relative) == (item.tracked_path, item.relative):
+        continue
+      entry = index.get(relative)
+      if entry and file_indexer_hasher.get_entry_algorithm(entry) == algorithm and file_indexer_hasher.is_delivered_to(entry, destination):
+        sources.append(delta_sync.get_basis_path(remote_root, relative))
+        if len(sources) >= MAX_DEDUP_SOURCES:
+          return sources
+  return sources
+
+def plan_dedup(user : str, host : str, items : list) -> tuple:
+  """
+  Splits a host's items by where their content can come from.
+
+  Returns (jobs for content the remote already holds, items to send, jobs for duplicates of
+  items to send in this batch). The latter are copied from those once they have been sent.
+  Hashes are computed once per batch and reused when the delivered files are recorded.
+  """
+  if get_mode(host) == "off":
+    return [], items, []
+
+  min_size = get_min_size(host)
+  roots = get_linked_roots(user, host)
+  jobs = []
+  to_send = []
+  followers = []
+  primaries = {} # [hash] -> first item of the batch with that content
+  for item in items:
+    if item.size < min_size:
+      to_send.append(item)
+      continue
+    try:
+      entry = file_indexer_hasher.get_pending_entry(item.local_file, delta_sync.get_signature_block_size(item.local_file))
+    except OSError:
+      to_send.append(item)
+      continue
+
+    transfer_stats.count("dedup_checked")
+    file_hash, algorithm = entry["hash"], entry["algorithm"]
+    sources = find_remote_sources(item, file_hash, algorithm, roots, host)
+    if sources:
+      jobs.append(DedupJob(item, file_hash, algorithm, sources))
+    elif file_hash in primaries:
+      primary = primaries[file_hash]
+      # The inbox copy until the remote moves it into place, the final path after that
+      primary_sources = [primary.remote_file_path, delta_sync.get_basis_path(primary.remote_path, primary.relative)]
+      followers.append(DedupJob(item, file_hash, algorithm, primary_sources))
+    else:
+      primaries[file_hash] = item
+      to_send.append(item)
+  return jobs, to_send, followers
+
+def get_store_entries(host : str, items : list) -> list:
+  """Hash store entries for delivered items, so later copies of their content can be found without the indexes."""
+  if get_mode(host) == "off" or not settings_util.get_host_setting(host, 'dedup_store'):
+    return []
+  entries = []
+  for item in items:
+    if item.size < get_min_size(host):
+      continue
+    try:
+      entry = file_indexer_hasher.get_pending_entry(item.local_file, delta_sync.get_signature_block_size(item.local_file))
+    except OSError:
+      continue
+    target = get_store_path(host, entry["hash"], entry["algorithm"])
+    sources = [item.remote_file_path, delta_sync.get_basis_path(item.remote_path, item.relative)]
+    entries.append({"target": target, "sources": sources, "size": item.size})
+  return entries
+
+def run_dedup_jobs(ssh : paramiko.SSHClient, host : str, jobs : list, store_entries : list = ()) -> list:
+  """
+  Places every job's content from its remote sources with one exec, and fills the hash store.
+  Returns the items that could not be placed, to be sent instead.
+  """
+  if not jobs and not store_entries:
+    return []
+
+  request = {
+    "mode": get_mode(host),
+    "verify": settings_util.get_host_setting(host, 'dedup_verify', True),
+    "store_root": (settings_util.get_host_setting(host, 'dedup_store') or "").rstrip('/'),
+    "copies": [{"target": job.item.remote_file_path, "sources": job.sources, "size": job.item.size,
+                "hash": job.file_hash, "algorithm": job.algorithm} for job in jobs],
+    "store": list(store_entries)
+  }
+  try:
+    command = " ".join(shlex.quote(arg) for arg in ["python3", "-c", REMOTE_DEDUP_SCRIPT])
+    stdin, stdout, stderr = ssh.exec_command(command)
+    stdin.write(json.dumps(request))
+    stdin.channel.shutdown_write()
+    output = stdout.read().decode()
+    if stdout.channel.recv_exit_status() != 0:
+      raise IOError(stderr.read().decode(errors='replace').strip())
+    result = json.loads(output)
+  except Exception as e:
+    print(f"Could not copy duplicate content on {host}, sending it instead: {e}")
+    return [job.item for job in jobs]
+
+  missed = []
+  saved = 0
+  for job, copied in zip(jobs, result["copied"]):
+    if copied:
+      saved += job.item.size
+    else:
+      missed.append(job.item)
+  transfer_stats.count("dedup_hits", len(jobs) - len(missed))
+  transfer_stats.count("dedup_bytes_saved", saved)
+  if result["stored"]:
+    transfer_stats.count("dedup_stored", result["stored"])
+  if jobs:
+    print(f"Copied {len(jobs) - len(missed)} of {len(jobs)} duplicate files on {host} instead of sending them, {saved / 1e6:.1f} MB saved")
+  return missed
+
+def print_summary():
+  """Prints the batch's dedup hit rate: files placed from remote content out of the files looked up."""
+  checked = transfer_stats.get("dedup_checked")
+  if checked:
+    hits = transfer_stats.get("dedup_hits")
+    saved = transfer_stats.get("dedup_bytes_saved")
+    print(f"Dedup hit rate: {hits} of {checked} files ({hits / checked:.0%}), {saved / 1e6:.1f} MB not sent")
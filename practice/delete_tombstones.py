@@ -0,0 +1,81 @@
+import hashlib
+import os
+import time
+from pathlib import Path
+
+# Directory in the inbox where a peer records the paths it is about to delete or rename
+TOMBSTONE_DIR = ".fs_deleted"
+# Seconds a tombstone keeps the deletion of its path (and of everything below it), or a rename, from being sent back
+DEFAULT_TOMBSTONE_TTL = 60
+
+def get_tombstone_dir(inbox_path) -> str:
+  return f"{str(inbox_path).rstrip('/')}/{TOMBSTONE_DIR}"
+
+def get_tombstone_name(path : str) -> str:
+  """Name of the tombstone of an absolute path, the same on both sides of a link."""
+  return hashlib.sha1(os.path.normpath(path).encode()).hexdigest()
+
+def get_rename_tombstone_name(old_path : str, new_path : str) -> str:
+  """Name of the tombstone of a rename from old_path to new_path, both absolute."""
+  return hashlib.sha1(f"{os.path.normpath(old_path)}\0{os.path.normpath(new_path)}".encode()).hexdigest()
+
+def is_tombstone(path : str, inbox_path) -> bool:
+  return path == get_tombstone_dir(inbox_path) or path.startswith(get_tombstone_dir(inbox_path) + "/")
+
+def is_applied_delete(path : Path, tracked_path : str, inbox_path, ttl : float = DEFAULT_TOMBSTONE_TTL) -> bool:
+  """
+  Checks whether a peer deleted the path, or a directory above it inside the tracked folder,
+  in the last ttl seconds. Such a delete event is the echo of the peer's own delete.
+  """
+  tombstone_dir = Path(get_tombstone_dir(inbox_path))
+  now = time.time()
+  for candidate in [path, *path.parents]:
+    try:
+      if now - (tombstone_dir / get_tombstone_name(str(candidate))).stat().st_mtime <= ttl:
+        return True
+    except OSError:
+      pass
+    if candidate == Path(tracked_path):
+      break
+  return False
+
+def is_applied_rename(old_path : Path, new_path : Path, inbox_path, ttl : float = DEFAULT_TOMBSTONE_TTL) -> bool:
+  """
+  Checks whether a peer renamed old_path to new_path in the last ttl seconds, which makes this move
+  the echo of the peer's own rename. The tombstone is used up, so a later move of the same paths is sent.
+  """
+  tombstone = Path(get_tombstone_dir(inbox_path)) / get_rename_tombstone_name(str(old_path), str(new_path))
+  try:
+    applied = time.time() - tombstone.stat().st_mtime <= ttl
+    os.remove(tombstone)
+    return applied
+  except OSError:
+    return False
+
+def clear_tombstones(path : Path, tracked_path : str, inbox_path):
+  """Drops the tombstones of a path created again and of the directories above it, so deleting it is sent as usual."""
+  tombstone_dir = Path(get_tombstone_dir(inbox_path))
+  if not tombstone_dir.is_dir():
+    return
+  for candidate in [path, *path.parents]:
+    try:
+      os.remove(tombstone_dir / get_tombstone_name(str(candidate)))
+    except OSError:
+      pass
+    if candidate == Path(tracked_path):
+      break
+
+def sweep_tombstones(inbox_path, ttl : float = DEFAULT_TOMBSTONE_TTL):
+  """Removes the tombstones that have expired."""
+  now = time.time()
+  try:
+    entries = os.scandir(get_tombstone_dir(inbox_path))
+  except OSError:
+    return
+  with entries:
+    for entry in entries:
+      try:
+        if now - entry.stat().st_mtime > ttl:
+          os.remove(entry.path)
+      except OSError:
+        pass
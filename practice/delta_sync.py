@@ -0,0 +1,244 @@
+import mmap
+import os
+import shlex
+import struct
+import zlib
+from pathlib import Path
+import paramiko
+import settings_util
+import transfer_stats
+from FileActions import PARTIAL_SUFFIX
+from file_indexer_hasher import generate_block_hash, get_pending_entry
+
+# Files smaller than this are always sent whole with sftp.put
+DEFAULT_DELTA_MIN_SIZE = 16 * 1024 * 1024
+DEFAULT_DELTA_BLOCK_SIZE = 256 * 1024
+# Give up on a delta (and send the whole file) once this share of the file would be sent as literal data
+DEFAULT_DELTA_MAX_LITERAL_RATIO = 0.5
+# Window positions the rolling search may slide over per file, beyond which only aligned blocks are matched
+DEFAULT_DELTA_ROLL_SEARCH_BUDGET = 4 * 1024 * 1024
+# Largest literal piece written to the patch stream at once
+LITERAL_CHUNK_SIZE = 1024 * 1024
+
+ADLER_MOD = 65521
+
+# Applies a patch read from stdin on the remote side.
+# Arguments: basis file, target file, expected hash, hash algorithm.
+# Copy ops read from the basis (the remote's current copy), literal ops carry new data.
+# The result is written to a partial file and only renamed into place when its hash matches.
+REMOTE_PATCH_SCRIPT = r'''
+import hashlib, os, struct, sys
+basis, target, expected, algorithm = sys.argv[1:5]
+inp = sys.stdin.buffer
+hasher = hashlib.new(algorithm)
+os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+partial = target + "''' + PARTIAL_SUFFIX + r'''"
+def copy(read, length, dst):
+  while length:
+    data = read(min(length, 1 << 20))
+    if not data:
+      raise EOFError("unexpected end of data")
+    dst.write(data)
+    hasher.update(data)
+    length -= len(data)
+try:
+  with open(basis, "rb") as src, open(partial, "wb") as dst:
+    while True:
+      op = inp.read(1)
+      if op == b"C":
+        offset, length = struct.unpack(">QQ", inp.read(16))
+        src.seek(offset)
+        copy(src.read, length, dst)
+      elif op == b"L":
+        (length,) = struct.unpack(">Q", inp.read(8))
+        copy(inp.read, length, dst)
+      elif op == b"E":
+        break
+      else:
+        raise ValueError("truncated or corrupt patch")
+  if hasher.hexdigest() != expected:
+    raise ValueError("hash mismatch after patching")
+  os.replace(partial, target)
+except Exception as e:
+  if os.path.exists(partial):
+    os.remove(partial)
+  sys.exit("delta patch failed: %s" % e)
+'''
+
+class DeltaNotWorthwhile(Exception):
+  """Raised when a delta would not save enough to be worth applying remotely."""
+
+def get_min_size(host : str) -> int:
+  return settings_util.get_host_setting(host, 'delta_min_size', DEFAULT_DELTA_MIN_SIZE)
+
+def get_block_size() -> int:
+  # Global rather than per host: the signatures in the index are shared by every destination
+  return settings_util.get_setting('delta_block_size', DEFAULT_DELTA_BLOCK_SIZE)
+
+def can_send_delta(local_file : Path, entry : dict, host : str) -> bool:
+  """Checks whether the file is large enough and has signatures from its last delivery."""
+  if not entry or not entry.get("blocks") or entry.get("block_size") != get_block_size():
+    return False
+  return local_file.stat().st_size >= get_min_size(host)
+
+def compute_delta_ops(data, old_entry : dict, max_literal : int) -> list:
+  """
+  Matches the new file contents against the block signatures of the old file.
+
+  Returns a list of ('C', offset, length) ops that copy from the old file and
+  ('L', start, end) ops that send bytes start..end of the new file.
+  Aligned blocks are tried first. When one does not match, a rolling Adler-32
+  checksum is slid forward byte by byte to find blocks that moved. The slide runs
+  in Python, so it is capped at 'delta_roll_search_budget' positions per file to keep
+  large, heavily changed files from taking longer to diff than to send.
+  Raises DeltaNotWorthwhile once more than max_literal bytes would be sent.
+  """
+  block_size = old_entry["block_size"]
+  old_blocks = old_entry["blocks"]
+  old_size = old_entry["size"]
+  roll_budget = 0
+  if settings_util.get_setting('delta_rolling_search', True):
+    roll_budget = settings_util.get_setting('delta_roll_search_budget', DEFAULT_DELTA_ROLL_SEARCH_BUDGET)
+
+  by_weak = {}
+  for index, (weak, _) in enumerate(old_blocks):
+    by_weak.setdefault(weak, []).append(index)
+
+  def old_block_length(index):
+    return min(block_size, old_size - index * block_size)
+
+  def find_block(offset, length, weak):
+    candidates = by_weak.get(weak)
+    if not candidates:
+      return None
+    strong = generate_block_hash(data[offset:offset + length])
+    # Prefer the block at the same position, which is the common case for in-place edits
+    aligned = offset // block_size
+    for index in sorted(candidates, key=lambda i: i != aligned):
+      if old_blocks[index][1] == strong and old_block_length(index) == length:
+        return index
+    return None
+
+  ops = []
+  size = len(data)
+  pos = 0
+  literal_start = 0
+  literal_total = 0
+
+  def add_literal(end):
+    nonlocal literal_total
+    if end > literal_start:
+      literal_total += end - literal_start
+      if literal_total > max_literal:
+        raise DeltaNotWorthwhile(f"more than {max_literal} literal bytes")
+      ops.append(('L', literal_start, end))
+
+  def add_copy(index):
+    offset = index * block_size
+    length = old_block_length(index)
+    if ops and ops[-1][0] == 'C' and ops[-1][1] + ops[-1][2] == offset:
+      ops[-1] = ('C', ops[-1][1], ops[-1][2] + length)
+    else:
+      ops.append(('C', offset, length))
+
+  while pos < size:
+    length = min(block_size, size - pos)
+    weak = zlib.adler32(data[pos:pos + length])
+    index = find_block(pos, length, weak)
+    next_pos = pos + length
+
+    if index is None and roll_budget > 0 and length == block_size:
+      # Slide the window one byte at a time looking for any old block
+      a = weak & 0xffff
+      b = weak >> 16
+      bound = min(block_size - 1, size - block_size - pos)
+      limit = min(bound, roll_budget)
+      # One copy of the bytes leaving and entering the window, which iterates much faster than the mmap
+      region = data[pos:pos + block_size + limit]
+      step = 0
+      for step, (out_byte, in_byte) in enumerate(zip(region[:limit], region[block_size:]), 1):
+        a = (a - out_byte + in_byte) % ADLER_MOD
+        b = (b - block_size * out_byte + a - 1) % ADLER_MOD
+        if (b << 16 | a) in by_weak:
+          index = find_block(pos + step, block_size, b << 16 | a)
+          if index is not None:
+            break
+      roll_budget -= step
+      if index is not None:
+        pos += step
+        next_pos = pos + block_size
+      elif limit == bound:
+        # No window starting before the next aligned block matched
+        next_pos = pos + limit + 1
+      # Otherwise the budget ran out mid-slide: stay on the aligned grid so later in-place edits still match
+
+    if index is None:
+      pos = next_pos
+      continue
+
+    add_literal(pos)
+    add_copy(index)
+    pos = next_pos
+    literal_start = pos
+
+  add_literal(size)
+  return ops
+
+def write_patch(stream, data, ops : list):
+  """Writes the ops to the remote patch script's stdin."""
+  for op in ops:
+    if op[0] == 'C':
+      stream.write(b"C" + struct.pack(">QQ", op[1], op[2]))
+    else:
+      _, start, end = op
+      stream.write(b"L" + struct.pack(">Q", end - start))
+      for chunk_start in range(start, end, LITERAL_CHUNK_SIZE):
+        stream.write(data[chunk_start:min(chunk_start + LITERAL_CHUNK_SIZE, end)])
+  stream.write(b"E")
+  stream.flush()
+
+def send_file_delta(ssh : paramiko.SSHClient, local_file : Path, basis_file : str, remote_file : str, old_entry : dict) -> int:
+  """
+  Sends only the changed blocks of local_file. The remote rebuilds it from basis_file
+  (its current copy) and writes the result to remote_file.
+
+  Returns the number of literal bytes sent. Raises on any failure so the caller can
+  fall back to a full upload.
+  """
+  new_entry = get_pending_entry(local_file, get_block_size())
+  max_literal = int(new_entry["size"] * settings_util.get_setting('delta_max_literal_ratio', DEFAULT_DELTA_MAX_LITERAL_RATIO))
+
+  with open(local_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+    ops = compute_delta_ops(data, old_entry, max_literal)
+    literal_bytes = sum(op[2] - op[1] for op in ops if op[0] == 'L')
+
+    command = " ".join(shlex.quote(arg) for arg in [
+      "python3", "-c", REMOTE_PATCH_SCRIPT, basis_file, remote_file, new_entry["hash"], new_entry["algorithm"]
+    ])
+    stdin, stdout, stderr = ssh.exec_command(command)
+    try:
+      write_patch(stdin, data, ops)
+    finally:
+      stdin.channel.shutdown_write()
+
+  exit_status = stdout.channel.recv_exit_status()
+  if exit_status != 0:
+    raise IOError(f"Remote patch of {remote_file} failed: {stderr.read().decode(errors='replace').strip()}")
+
+  print(f"Sent delta of {local_file} to {remote_file}: {literal_bytes} of {new_entry['size']} bytes ({len(ops)} ops)")
+  transfer_stats.count("delta_files_sent")
+  transfer_stats.count("delta_bytes_saved", new_entry["size"] - literal_bytes)
+  return literal_bytes
+
+def get_basis_path(remote_path : str, relative : str) -> str:
+  """Path of the remote's current copy of a file, outside of its inbox."""
+  return f"{remote_path.rstrip('/')}/{relative}"
+
+def get_signature_block_size(local_file : Path):
+  """Block size to keep signatures at in the file's index entry, or None when the file is too small for deltas."""
+  try:
+    if os.path.getsize(local_file) >= settings_util.get_setting('delta_min_size', DEFAULT_DELTA_MIN_SIZE):
+      return get_block_size()
+  except OSError:
+    pass
+  return None
@@ -1,43 +1,141 @@
 from pathlib import Path
 import hashlib
+import hash_engine
 import json
 from datetime import datetime
 import re
+import threading
+import zlib
+from LiveIndex import LiveIndex
+from tree_walker import walk_files
 
-def generate_file_hash(filepath):
-    hasher = hashlib.sha256()
+# Live indexes shared by the observer and sender threads: [index key] -> LiveIndex
+_live_indexes = {}
+_index_lock = threading.Lock()
+
+# Entries computed while sending a batch, reused until the file changes: [filepath] -> entry
+_pending_entries = {}
+_pending_lock = threading.Lock()
+
+def generate_file_hash(filepath, algorithm: str = None):
+    return hash_engine.hash_file(filepath, algorithm)
+
+def get_entry_algorithm(entry: dict) -> str:
+    """The algorithm an index entry's hash was made with. Older entries did not record it and are SHA-256."""
+    return entry.get("algorithm", hash_engine.DEFAULT_HASH_ALGORITHM)
+
+def generate_block_hash(block) -> str:
+    """Strong hash of a single block, used to confirm weak checksum matches."""
+    return hashlib.blake2b(block, digest_size=16).hexdigest()
+
+def generate_block_signatures(filepath, block_size: int) -> tuple:
+    """
+    Hashes the file in fixed size blocks.
+
+    Returns the whole file hash (same as generate_file_hash with the configured algorithm) and a list of
+    [weak, strong] signatures per block, where weak is the Adler-32 checksum
+    that can be rolled one byte at a time and strong is generate_block_hash.
+    """
+    hasher = hash_engine.new_hasher()
+    blocks = []
     with open(filepath, 'rb') as f:
-        while chunk := f.read(8192):
-            hasher.update(chunk)
-    return hasher.hexdigest()
+        while block := f.read(block_size):
+            hasher.update(block)
+            blocks.append([zlib.adler32(block), generate_block_hash(block)])
+    return hasher.hexdigest(), blocks
+
+def build_file_entry(filepath, block_size: int = None, file_hash: str = None, stat=None) -> dict:
+    """
+    Builds the index entry of one file. With a block size, block signatures for delta transfers are included.
+    A hash computed beforehand with the configured algorithm, and a stat result from a directory walk,
+    can be passed in to skip reading and stat-ing the file again.
+    """
+    if stat is None:
+        stat = Path(filepath).stat()
+    if block_size:
+        file_hash, blocks = generate_block_signatures(filepath, block_size)
+    elif file_hash is None:
+        file_hash = generate_file_hash(filepath)
+
+    entry = {
+        "hash": file_hash,
+        "algorithm": hash_engine.get_algorithm(),
+        "size": stat.st_size,
+        "modified_time": datetime.fromtimestamp(stat.st_mtime).isoformat()
+    }
+    if block_size:
+        entry["block_size"] = block_size
+        entry["blocks"] = blocks
+    return entry
 
 def build_file_index(folder_path):
     """Builds an index of files in the specified folder, including their hashes, sizes, and modification times."""
     index = {}
     folder_path = Path(folder_path).resolve()
-    
-    for filepath in folder_path.rglob("*"):
-        if filepath.is_file():
-            try:
-                stat = filepath.stat()
-                file_hash = generate_file_hash(filepath)
-                relative_path = filepath.relative_to(folder_path).as_posix()
-                index[relative_path] = {
-                    "hash": file_hash,
-                    "size": stat.st_size,
-                    "modified_time": datetime.fromtimestamp(stat.st_mtime).isoformat()
-                }
-            except (OSError, FileNotFoundError) as e:
-                print(f"Error processing file {filepath}: {e}")
+    files = list(walk_files(folder_path))
+
+    # Hash everything across the process pool, then record each file with the stat from the walk
+    hashes = hash_engine.hash_files([filepath for filepath, _, _ in files])
+
+    for filepath, relative_path, stat in files:
+        file_hash = hashes.get(filepath)
+        if file_hash is None:
+            continue
+        index[relative_path] = build_file_entry(filepath, file_hash=file_hash, stat=stat)
     
     return index
 
+def matches_stat(entry: dict, stat) -> bool:
+    """Whether an index entry has the same size and modification time as the stat result."""
+    return (entry.get("size") == stat.st_size and
+            entry.get("modified_time") == datetime.fromtimestamp(stat.st_mtime).isoformat())
+
+def format_destination(user: str, host: str, remote_path: str) -> str:
+    """How index entries name a destination they were delivered to."""
+    return f"{user}@{host}:{remote_path}"
+
+def is_delivered_to(entry: dict, destination: str) -> bool:
+    """
+    Whether the remote at destination holds the entry's content. Entries record the destinations
+    they reached under "remotes"; ones without it were recorded as delivered to every destination.
+    """
+    remotes = entry.get("remotes")
+    return remotes is None or destination in remotes
+
+def get_pending_entry(filepath, block_size: int = None) -> dict:
+    """Returns the file's entry computed earlier in this batch if the file is unchanged, otherwise builds it."""
+    key = Path(filepath).as_posix()
+    with _pending_lock:
+        entry = _pending_entries.get(key)
+    if entry and matches_stat(entry, Path(filepath).stat()) and (not block_size or entry.get("block_size") == block_size):
+        return entry
+
+    entry = build_file_entry(filepath, block_size)
+    with _pending_lock:
+        _pending_entries[key] = entry
+    return entry
+
+def pop_pending_entry(filepath) -> dict:
+    """Removes and returns the entry computed for the file during this batch, if any."""
+    with _pending_lock:
+        return _pending_entries.pop(Path(filepath).as_posix(), None)
+
 def get_index_filename(folder_name: str) -> Path:
     output_dir = Path("file_indexes")
     output_dir.mkdir(exist_ok=True)
 
     sanitized_name = re.sub(r'[^\w\-_.]', '_', folder_name)
-    return output_dir / f"{sanitized_name}_file_index.json"
+    # Sanitizing can map different paths to the same name (/a/b_c and /a_b/c), the digest keeps them apart
+    digest = hashlib.sha1(folder_name.encode()).hexdigest()[:8]
+    return output_dir / f"{sanitized_name}_{digest}_file_index.json"
+
+def get_index_log_filename(folder_name: str) -> Path:
+    """Change log of the folder's live index, folded into the index file on compaction."""
+    return get_index_filename(folder_name).with_suffix(".log")
+
+def get_index_tree_filename(folder_name: str) -> Path:
+    """Merkle tree of the folder's index, saved with every index snapshot."""
+    return get_index_filename(folder_name).with_suffix(".tree.json")
 
 def load_index_from_file(folder_name: str) -> dict:
     index_file = get_index_filename(folder_name)
@@ -54,6 +152,30 @@ def save_index_to_file(index, folder_name : str):
     with open(output_file, "w") as f:
         json.dump(index, f, indent=2)
 
+def get_index_key(tracked_path) -> str:
+    """Indexes are stored per full tracked path, so folders sharing a name (/a/src, /b/src) keep their own."""
+    return Path(tracked_path).as_posix()
+
+def get_live_index(folder_name: str) -> LiveIndex:
+    """Returns the live index for the folder, loading it from disk on first use."""
+    with _index_lock:
+        if folder_name not in _live_indexes:
+            _live_indexes[folder_name] = LiveIndex(get_index_filename(folder_name), get_index_log_filename(folder_name),
+                                                   get_index_tree_filename(folder_name))
+        return _live_indexes[folder_name]
+
+def update_index_entries(folder_name: str, entries: dict, removed: list = ()):
+    """Updates entries ([relative_path] -> entry) of the folder's live index and drops the removed paths."""
+    get_live_index(folder_name).update(entries, removed)
+
+def delete_index(folder_name: str):
+    """Removes the folder's index files and forgets its live index."""
+    with _index_lock:
+        _live_indexes.pop(folder_name, None)
+    get_index_filename(folder_name).unlink(missing_ok=True)
+    get_index_log_filename(folder_name).unlink(missing_ok=True)
+    get_index_tree_filename(folder_name).unlink(missing_ok=True)
+
 if __name__ == "__main__":
     base_folder_path = input("Enter the folder path to index: ").strip()
     folder_path = Path(base_folder_path).resolve()
@@ -62,5 +184,5 @@ if __name__ == "__main__":
         print("Invalid folder path.")
     else:
         index = build_file_index(folder_path)
-        save_index_to_file(index, folder_path.name)
+        get_live_index(get_index_key(folder_path)).replace_all(index)
         print(f"File index created with {len(index)} entries.")
\ No newline at end of file
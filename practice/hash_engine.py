@@ -0,0 +1,79 @@
+import hashlib
+import mmap
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import settings_util
+
+# Algorithm assumed for index entries written before the algorithm was recorded
+DEFAULT_HASH_ALGORITHM = "sha256"
+# Files at least this big are hashed through a memory map instead of buffered reads
+MMAP_MIN_SIZE = 4 * 1024 * 1024
+READ_BUFFER_SIZE = 1024 * 1024
+# Hash small files in the calling process; a process pool only pays off for larger batches
+PARALLEL_MIN_FILES = 16
+
+def get_algorithm() -> str:
+  """The configured hash algorithm ('hash_algorithm' in config.yaml), e.g. sha256 or blake2b."""
+  return settings_util.get_setting('hash_algorithm', DEFAULT_HASH_ALGORITHM)
+
+def new_hasher(algorithm : str = None):
+  return hashlib.new(algorithm or get_algorithm())
+
+def hash_file(filepath, algorithm : str = None) -> str:
+  """Hashes one file. Large files are read through mmap, smaller ones with large buffered reads."""
+  hasher = new_hasher(algorithm)
+  with open(filepath, 'rb') as f:
+    size = os.fstat(f.fileno()).st_size
+    if size >= MMAP_MIN_SIZE:
+      with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data, memoryview(data) as view:
+        # Slices of the view are not copied, and hashlib releases the GIL on large updates
+        for start in range(0, size, 64 * READ_BUFFER_SIZE):
+          hasher.update(view[start:start + 64 * READ_BUFFER_SIZE])
+    else:
+      while chunk := f.read(READ_BUFFER_SIZE):
+        hasher.update(chunk)
+  return hasher.hexdigest()
+
+def _hash_file_job(job : tuple) -> tuple:
+  """Process pool entry point. Returns (filepath, hash or None, size, error)."""
+  filepath, algorithm = job
+  try:
+    return filepath, hash_file(filepath, algorithm), os.path.getsize(filepath), None
+  except OSError as e:
+    return filepath, None, 0, str(e)
+
+def hash_files(filepaths : list, algorithm : str = None, workers : int = None) -> dict:
+  """
+  Hashes many files across a process pool and reports the throughput.
+
+  Returns [filepath] -> hash. Files that could not be read are left out.
+  The worker count comes from 'hash_workers' in config.yaml, defaulting to one per core.
+  """
+  algorithm = algorithm or get_algorithm()
+  workers = workers or settings_util.get_setting('hash_workers', os.cpu_count() or 1)
+  jobs = [(str(filepath), algorithm) for filepath in filepaths]
+
+  start = time.monotonic()
+  if workers > 1 and len(jobs) >= PARALLEL_MIN_FILES:
+    # Spawned rather than forked: the caller runs next to observer, sender and SSH threads whose
+    # locks a forked child could inherit mid-use, and a fork would also copy the in-memory indexes
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+      results = list(executor.map(_hash_file_job, jobs, chunksize=max(1, len(jobs) // (workers * 8))))
+  else:
+    results = [_hash_file_job(job) for job in jobs]
+  elapsed = max(time.monotonic() - start, 1e-6)
+
+  hashes = {}
+  total_bytes = 0
+  for filepath, file_hash, size, error in results:
+    if error:
+      print(f"Error hashing file {filepath}: {error}")
+      continue
+    hashes[filepath] = file_hash
+    total_bytes += size
+
+  print(f"Hashed {len(hashes)} files ({total_bytes / 1e6:.1f} MB) with {algorithm} in {elapsed:.2f}s: "
+        f"{total_bytes / 1e6 / elapsed:.1f} MB/s, {len(hashes) / elapsed:.0f} files/s")
+  return hashes
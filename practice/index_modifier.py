@@ -1,6 +1,11 @@
 from pathlib import Path
+import os
 import file_indexer_hasher
 import tracker_utils
+import hash_engine
+import delta_sync
+import remote_manifest
+import ssh_utils
 
 def get_user_selected_paths() -> dict:
   print("Please enter the file paths you want to track.")
@@ -80,15 +85,18 @@ def handle_add_paths():
   # now we index and hash the files in the tracked paths
   print("\nIndexing files in the tracked paths. This may take a minute...")
 
+  indexed_paths = {} # Folders tracked for the first time, whose remotes are seeded below
   for path, metadata in all_paths.items():
     folder_path = Path(path).resolve()
     if folder_path.is_dir():
       print(f"\tIndexing files in: {folder_path.as_posix()}...", end="    ")
 
-      new_hash = tracker_utils.compute_folder_hash(folder_path)
+      # One metadata scan feeds both the folder's Merkle root and its size
+      entries = tracker_utils.scan_folder(folder_path)
+      new_hash = tracker_utils.build_folder_tree(folder_path, entries).root_hash()
       stored_hash = metadata.get('hash')
 
-      if(stored_hash == new_hash):
+      if stored_hash == new_hash:
         print("No changes detected, skipping indexing...")
         continue
 
@@ -99,13 +107,113 @@ def handle_add_paths():
 
       print(f"\nUpdating folder tracking information for {folder_path}...")
       all_paths[path]['hash'] = new_hash
-      all_paths[path]['size'] = tracker_utils.get_folder_size(folder_path)
+      all_paths[path]['size'] = tracker_utils.get_folder_size(folder_path, entries)
       all_paths[path]['tracked_on'] = tracker_utils.datetime.now().isoformat(timespec='seconds')
       tracker_utils.save_tracked_paths(all_paths)
+      if stored_hash is None:
+        indexed_paths[path] = all_paths[path]
 
     else:
       print(f"Skipping {folder_path.as_posix()} as it is not a valid directory.")
 
+  if indexed_paths:
+    seed_linked_paths(indexed_paths)
+
+def seed_linked_paths(new_paths : dict):
+  """
+  Brings the remotes of newly tracked folders in line with them before the watcher takes over.
+
+  Every folder is indexed with hashes, then each host is asked once for the manifests of all
+  its linked folders. Remote files that only moved are renamed, remote-only files are deleted
+  if confirmed, and the files already identical on every remote are recorded in the index as
+  delivered, so the catch-up at startup only uploads the rest.
+  """
+  algorithm = hash_engine.get_algorithm()
+  local_indexes = {}
+  targets = {} # [(user, host)] -> {[remote root] -> sizes of the local files}
+  for path, metadata in new_paths.items():
+    linked_paths = metadata.get('linked_paths') or {}
+    if not linked_paths:
+      continue
+    print(f"\tHashing files in: {path}...")
+    local_indexes[path] = file_indexer_hasher.build_file_index(path)
+    sizes = {entry["size"] for entry in local_indexes[path].values()}
+    for remote_info in linked_paths.values():
+      host_roots = targets.setdefault((remote_info["user"], remote_info["host_url"]), {})
+      host_roots.setdefault(remote_manifest.get_remote_root(remote_info), set()).update(sizes)
+
+  manifests = {} # [(user, host)] -> {[remote root] -> entries}
+  for (user, host), roots in targets.items():
+    checkout = lambda: ssh_utils.ssh_pool.checkout(user, host, ssh_utils.SSH_KEY_PATH.as_posix())
+    checkin = lambda ssh: ssh_utils.ssh_pool.checkin(user, host, ssh)
+    try:
+      manifests[(user, host)] = remote_manifest.get_remote_manifests(checkout, checkin, user, host, list(roots), algorithm, set().union(*roots.values()))
+    except Exception as e:
+      print(f"Could not list the files on {host} as {user}: {e}")
+
+  for path, local_entries in local_indexes.items():
+    delivered = set(local_entries)
+    for remote_url, remote_info in new_paths[path]['linked_paths'].items():
+      user, host = remote_info["user"], remote_info["host_url"]
+      remote_root = remote_manifest.get_remote_root(remote_info)
+      if (user, host) not in manifests:
+        delivered.clear() # Nothing is known about this remote, so everything is sent
+        continue
+
+      plan = remote_manifest.plan_sync(local_entries, manifests[(user, host)][remote_root])
+      print(f"{remote_url}: {len(plan.matched)} files up to date, {len(plan.rename)} to rename, "
+            f"{len(plan.upload)} to upload, {len(plan.delete)} only on the remote.")
+      renamed = apply_sync_plan(user, host, remote_root, plan)
+      delivered &= set(plan.matched) | renamed
+
+    file_indexer_hasher.get_live_index(file_indexer_hasher.get_index_key(path)).replace_all(
+      {relative: local_entries[relative] for relative in delivered}
+    )
+    print(f"{len(delivered)} of {len(local_entries)} files in {path} are already on every remote, the rest is sent once monitoring starts.")
+
+def apply_sync_plan(user : str, host : str, remote_root : str, plan) -> set:
+  """Renames the remote files that only moved and deletes the remote-only ones if confirmed. Returns the renamed local paths."""
+  if not plan.rename and not plan.delete:
+    return set()
+
+  ssh = ssh_utils.ssh_pool.checkout(user, host, ssh_utils.SSH_KEY_PATH.as_posix())
+  if ssh is None:
+    print(f"Could not connect to {host} as {user}, its files are sent once monitoring starts.")
+    return set()
+
+  renamed = set()
+  try:
+    if plan.rename:
+      sftp = ssh.open_sftp()
+      try:
+        known_dirs = set()
+        for old_relative, relative in plan.rename:
+          remote_file = delta_sync.get_basis_path(remote_root, relative)
+          try:
+            ssh_utils.ensure_remote_dir(sftp, os.path.dirname(remote_file), known_dirs)
+            ssh_utils.rename_file(sftp, delta_sync.get_basis_path(remote_root, old_relative), remote_file)
+            renamed.add(relative)
+          except IOError as e:
+            print(f"Could not rename {old_relative} to {relative} on {host}: {e}")
+      finally:
+        sftp.close()
+
+    if plan.delete:
+      confirm = input(f"Delete the {len(plan.delete)} files in {remote_root} on {host} that are not in the local folder? (Y/N): ").strip().lower()
+      if confirm in ['y', 'yes']:
+        targets = [(relative, remote_root, delta_sync.get_basis_path(remote_root, relative)) for relative in plan.delete]
+        for batch in ssh_utils.batch_delete_targets(targets):
+          try:
+            ssh_utils.remove_remote_paths(ssh, [target for _, _, target in batch])
+          except Exception as e:
+            print(f"Failed to delete {len(batch)} files on {host}: {e}")
+
+    # The remote tree changed, so its manifest has to be fetched again next time
+    remote_manifest.forget_cached_manifests(user, host, [remote_root])
+  finally:
+    ssh_utils.ssh_pool.checkin(user, host, ssh)
+  return renamed
+
     
 def handle_remove_paths():
   """Handles removing paths from the tracked paths."""
@@ -159,11 +267,11 @@ def handle_remove_paths():
     del paths[path]
     
     # delete the corresponding file index
-    folder_name = Path(path).name
+    folder_name = file_indexer_hasher.get_index_key(path)
     json_filename = file_indexer_hasher.get_index_filename(folder_name)
 
-    if json_filename.exists():
-      json_filename.unlink()
+    if json_filename.exists() or file_indexer_hasher.get_index_log_filename(folder_name).exists():
+      file_indexer_hasher.delete_index(folder_name)
       print(f"Removed file index for {path} at {json_filename.as_posix()}")
     else:
       print(f"No file index found for {path} at {json_filename.as_posix()}")
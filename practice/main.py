@@ -1,6 +1,6 @@
 from tracker_utils import load_tracked_paths, display_tracked_paths
 from FileObserver import start_monitoring
-from ssh_utils import ssh_sender_worker
+from ssh_utils import ssh_sender_worker, replay_journal, warm_up_connections
 import threading
 import settings_util
 from pathlib import Path
@@ -35,11 +35,14 @@ def main():
   print(f"\nInbox Path: {inbox_folder}")
 
   display_tracked_paths()
+  # Pick up the transfers that were still pending when the last run stopped
+  replay_journal()
   # Start the SSH sender worker thread
   sender_thread = threading.Thread(target=ssh_sender_worker, daemon=True)
   sender_thread.start()
 
   tracked_paths = load_tracked_paths()
+  warm_up_connections(tracked_paths)
 
   start_monitoring(tracked_paths)
 
@@ -0,0 +1,225 @@
+import json
+import re
+import shlex
+import time
+import zlib
+from collections import namedtuple
+from datetime import datetime
+from pathlib import Path
+import paramiko
+import settings_util
+from FileActions import PARTIAL_SUFFIX
+from MerkleTree import MerkleTree, CONTENT_LEAF_KEYS
+
+# Cached manifests younger than this many seconds are used instead of asking the host again
+DEFAULT_MANIFEST_CACHE_TTL = 300
+MANIFEST_CACHE_DIR = Path("file_indexes/remote_manifests")
+READ_SIZE = 64 * 1024
+
+# Walks every root of a JSON request read from stdin ({"roots", "algorithm", "sizes"}) and streams
+# one zlib-compressed line per file: [root number, relative path, size, mtime(, hash)].
+# Only files whose size is in "sizes" are hashed, since no other file can match a local one.
+REMOTE_MANIFEST_SCRIPT = r'''
+import hashlib, json, os, sys, zlib
+request = json.load(sys.stdin)
+algorithm = request.get("algorithm")
+sizes = set(request.get("sizes") or ())
+out = sys.stdout.buffer
+compressor = zlib.compressobj()
+
+def file_hash(path):
+  hasher = hashlib.new(algorithm)
+  with open(path, "rb") as f:
+    for chunk in iter(lambda: f.read(1 << 20), b""):
+      hasher.update(chunk)
+  return hasher.hexdigest()
+
+for number, root in enumerate(request["roots"]):
+  pending = [""]
+  while pending:
+    relative = pending.pop()
+    try:
+      entries = os.scandir(os.path.join(root, relative) if relative else root)
+    except OSError:
+      continue
+    with entries:
+      for entry in entries:
+        child = relative + "/" + entry.name if relative else entry.name
+        try:
+          if entry.is_dir(follow_symlinks=False):
+            pending.append(child)
+          elif entry.is_file():
+            stat = entry.stat()
+            record = [number, child, stat.st_size, stat.st_mtime]
+            if algorithm and stat.st_size in sizes:
+              record.append(file_hash(entry.path))
+            out.write(compressor.compress(json.dumps(record, separators=(",", ":")).encode() + b"\n"))
+        except OSError:
+          pass
+out.write(compressor.flush())
+'''
+
+# Prints the hash of the file named by the first argument, with the algorithm named by the second.
+REMOTE_HASH_SCRIPT = r'''
+import hashlib, sys
+hasher = hashlib.new(sys.argv[2])
+with open(sys.argv[1], "rb") as f:
+  for chunk in iter(lambda: f.read(1 << 20), b""):
+    hasher.update(chunk)
+print(hasher.hexdigest())
+'''
+
+# What it takes to make a remote tree match the local one. Paths are relative to the tracked folder.
+# matched: already identical, upload: missing or different, delete: only on the remote,
+# rename: (remote path, local path) pairs of remote files that only need to move.
+SyncPlan = namedtuple("SyncPlan", ["matched", "upload", "delete", "rename"])
+
+def get_remote_root(remote_info : dict) -> str:
+  return f"{remote_info['base_path']}/{remote_info['remote_path']}"
+
+def fetch_remote_manifests(ssh : paramiko.SSHClient, roots : list, algorithm : str = None, sizes = ()) -> dict:
+  """
+  Lists every file below the remote roots with a single exec.
+
+  Returns [root] -> {[relative path] -> {"size", "modified_time"(, "hash", "algorithm")}}.
+  With an algorithm, files whose size is in sizes are hashed on the remote as well.
+  Missing roots come back empty.
+  """
+  request = {"roots": list(roots), "algorithm": algorithm, "sizes": sorted(sizes) if algorithm else []}
+  command = " ".join(shlex.quote(arg) for arg in ["python3", "-c", REMOTE_MANIFEST_SCRIPT])
+  stdin, stdout, stderr = ssh.exec_command(command)
+  stdin.write(json.dumps(request))
+  stdin.channel.shutdown_write()
+
+  manifests = {root: {} for root in roots}
+  decompressor = zlib.decompressobj()
+  buffer = b""
+  while chunk := stdout.read(READ_SIZE):
+    buffer += decompressor.decompress(chunk)
+    *lines, buffer = buffer.split(b"\n")
+    for line in lines:
+      number, relative, size, mtime, *file_hash = json.loads(line)
+      entry = {"size": size, "modified_time": datetime.fromtimestamp(mtime).isoformat()}
+      if file_hash:
+        entry["hash"] = file_hash[0]
+        entry["algorithm"] = algorithm
+      manifests[request["roots"][number]][relative] = entry
+
+  if stdout.channel.recv_exit_status() != 0:
+    raise IOError(f"Could not list {', '.join(roots)}: {stderr.read().decode(errors='replace').strip()}")
+  return manifests
+
+def hash_remote_file(ssh : paramiko.SSHClient, remote_file : str, algorithm : str) -> str:
+  """Hashes one remote file on the remote, so it can be compared to a local file without downloading it."""
+  command = " ".join(shlex.quote(arg) for arg in ["python3", "-c", REMOTE_HASH_SCRIPT, remote_file, algorithm])
+  _, stdout, stderr = ssh.exec_command(command)
+  output = stdout.read().decode().strip()
+  if stdout.channel.recv_exit_status() != 0:
+    raise IOError(f"Could not hash {remote_file}: {stderr.read().decode(errors='replace').strip()}")
+  return output
+
+def get_cache_filename(user : str, host : str) -> Path:
+  sanitized_name = re.sub(r'[^\w\-_.]', '_', f"{user}@{host}")
+  return MANIFEST_CACHE_DIR / f"{sanitized_name}_manifest.json"
+
+def load_cached_manifests(user : str, host : str) -> dict:
+  """Returns the host's cached manifests ([root] -> {"fetched_at", "algorithm", "entries"}), or an empty dict."""
+  try:
+    with open(get_cache_filename(user, host), 'r') as f:
+      return json.load(f)
+  except (FileNotFoundError, json.JSONDecodeError):
+    return {}
+
+def save_cached_manifests(user : str, host : str, cached : dict):
+  MANIFEST_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+  with open(get_cache_filename(user, host), 'w') as f:
+    json.dump(cached, f)
+
+def forget_cached_manifests(user : str, host : str, roots : list):
+  """Drops the cached manifests of roots that were just changed."""
+  cached = load_cached_manifests(user, host)
+  if any(cached.pop(root, None) is not None for root in roots):
+    save_cached_manifests(user, host, cached)
+
+def is_cache_usable(cached_root : dict, algorithm : str, sizes : set, max_age : float) -> bool:
+  """Whether a cached manifest is recent enough and has a hash for every file that might match a local one."""
+  if cached_root is None or time.time() - cached_root["fetched_at"] > max_age:
+    return False
+  if not algorithm:
+    return True
+  return cached_root["algorithm"] == algorithm and all(
+    "hash" in entry for entry in cached_root["entries"].values() if entry["size"] in sizes
+  )
+
+def get_remote_manifests(ssh_checkout, ssh_checkin, user : str, host : str, roots : list, algorithm : str = None, sizes = ()) -> dict:
+  """
+  Returns the manifests of the host's roots ([root] -> entries), from the local cache when it is recent,
+  otherwise with one exec for all the roots that were not cached. ssh_checkout() checks a connection out
+  only when it is needed and returns it, or None when the host cannot be reached; ssh_checkin(ssh) hands it back.
+  """
+  sizes = set(sizes)
+  max_age = settings_util.get_host_setting(host, 'manifest_cache_ttl', DEFAULT_MANIFEST_CACHE_TTL)
+  cached = load_cached_manifests(user, host)
+
+  manifests = {}
+  missing = []
+  for root in roots:
+    if is_cache_usable(cached.get(root), algorithm, sizes, max_age):
+      manifests[root] = cached[root]["entries"]
+    else:
+      missing.append(root)
+  if not missing:
+    print(f"Using cached manifests of {len(roots)} folders on {host}.")
+    return manifests
+
+  ssh = ssh_checkout()
+  if ssh is None:
+    raise IOError(f"Could not connect to {host} as {user}")
+  start = time.monotonic()
+  try:
+    fetched = fetch_remote_manifests(ssh, missing, algorithm, sizes)
+  finally:
+    ssh_checkin(ssh)
+  print(f"Fetched manifests of {len(missing)} folders on {host} ({sum(len(entries) for entries in fetched.values())} files) "
+        f"in {time.monotonic() - start:.2f}s")
+
+  fetched_at = time.time()
+  for root, entries in fetched.items():
+    cached[root] = {"fetched_at": fetched_at, "algorithm": algorithm, "entries": entries}
+  save_cached_manifests(user, host, cached)
+  manifests.update(fetched)
+  return manifests
+
+def plan_sync(local_entries : dict, remote_entries : dict) -> SyncPlan:
+  """
+  Diffs a local index against a remote manifest by size and hash, since modification times
+  do not carry over between machines. Only directories whose hashes differ are compared file by file.
+  A remote-only file with the same size and hash as a file the remote lacks is renamed instead of
+  uploading the file and deleting the other.
+  """
+  remote_entries = {relative: entry for relative, entry in remote_entries.items() if not relative.endswith(PARTIAL_SUFFIX)}
+  local_tree = MerkleTree.from_entries(local_entries, CONTENT_LEAF_KEYS)
+  changed = set(local_tree.diff(MerkleTree.from_entries(remote_entries, CONTENT_LEAF_KEYS)))
+
+  extras = {} # [(size, hash)] -> remote-only paths with that content
+  for relative in sorted(changed):
+    entry = remote_entries.get(relative)
+    if relative not in local_entries and entry.get("hash"):
+      extras.setdefault((entry["size"], entry["hash"]), []).append(relative)
+
+  upload = []
+  rename = []
+  for relative in sorted(changed):
+    entry = local_entries.get(relative)
+    if entry is None:
+      continue
+    candidates = extras.get((entry["size"], entry.get("hash")))
+    if candidates and relative not in remote_entries:
+      rename.append((candidates.pop(0), relative))
+    else:
+      upload.append(relative)
+
+  renamed = {old for old, _ in rename}
+  delete = [relative for relative in sorted(changed) if relative not in local_entries and relative not in renamed]
+  matched = [relative for relative in local_entries if relative not in changed]
+  return SyncPlan(matched, upload, delete, rename)
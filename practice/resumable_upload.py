@@ -0,0 +1,134 @@
+import shlex
+import time
+from pathlib import Path
+import paramiko
+import hash_engine
+import settings_util
+import transfer_stats
+import transfer_tuning
+from FileActions import PARTIAL_SUFFIX
+
+# Files at least this big are uploaded through a resumable partial file instead of sftp.put
+DEFAULT_RESUME_MIN_SIZE = 64 * 1024 * 1024
+# Checkpoint size; an interrupted upload resumes from the last complete chunk that verifies
+DEFAULT_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+WRITE_BLOCK_SIZE = 32 * 1024
+
+# Prints the hash of every complete chunk of a remote partial file, one per line.
+# Arguments: partial file, chunk size, hash algorithm.
+REMOTE_CHUNK_HASH_SCRIPT = r'''
+import hashlib, sys
+path, chunk_size, algorithm = sys.argv[1], int(sys.argv[2]), sys.argv[3]
+try:
+  f = open(path, "rb")
+except FileNotFoundError:
+  sys.exit(0)
+with f:
+  while True:
+    data = f.read(chunk_size)
+    if len(data) < chunk_size:
+      break
+    print(hashlib.new(algorithm, data).hexdigest())
+'''
+
+def should_resume(size : int, host : str) -> bool:
+  return size >= settings_util.get_host_setting(host, 'resume_min_size', DEFAULT_RESUME_MIN_SIZE)
+
+def get_partial_path(remote_file : str) -> str:
+  """Remote name of an upload in progress. Different from the delta patch's partial so neither clobbers the other."""
+  return f"{remote_file}.upload{PARTIAL_SUFFIX}"
+
+def get_chunk_size(host : str) -> int:
+  return settings_util.get_host_setting(host, 'upload_chunk_size', DEFAULT_UPLOAD_CHUNK_SIZE)
+
+def get_remote_chunk_hashes(ssh : paramiko.SSHClient, partial_file : str, chunk_size : int, algorithm : str) -> list:
+  command = " ".join(shlex.quote(arg) for arg in ["python3", "-c", REMOTE_CHUNK_HASH_SCRIPT, partial_file, str(chunk_size), algorithm])
+  _, stdout, stderr = ssh.exec_command(command)
+  output = stdout.read().decode()
+  if stdout.channel.recv_exit_status() != 0:
+    raise IOError(f"Could not hash {partial_file}: {stderr.read().decode(errors='replace').strip()}")
+  return output.split()
+
+def find_resume_offset(ssh : paramiko.SSHClient, sftp : paramiko.SFTPClient, local_file : Path, partial_file : str, chunk_size : int) -> int:
+  """
+  Returns how many bytes of the remote partial file can be kept.
+
+  The partial file's complete chunks are hashed remotely and compared to the same chunks
+  of the local file; the upload resumes after the last chunk of the matching prefix.
+  """
+  try:
+    remote_size = sftp.stat(partial_file).st_size
+  except FileNotFoundError:
+    return 0
+  if remote_size < chunk_size:
+    return 0
+
+  algorithm = hash_engine.get_algorithm()
+  remote_hashes = get_remote_chunk_hashes(ssh, partial_file, chunk_size, algorithm)
+  offset = 0
+  with open(local_file, 'rb') as f:
+    for remote_hash in remote_hashes:
+      data = f.read(chunk_size)
+      if len(data) < chunk_size:
+        break
+      hasher = hash_engine.new_hasher(algorithm)
+      hasher.update(data)
+      if hasher.hexdigest() != remote_hash:
+        break
+      offset += chunk_size
+  return offset
+
+def upload_file_resumable(ssh : paramiko.SSHClient, sftp : paramiko.SFTPClient, host : str, local_file : Path, remote_file : str):
+  """
+  Uploads a large file to a partial name in checkpointed chunks, then renames it into place.
+
+  If an earlier attempt was cut off (e.g. the connection dropped), its partial file is
+  kept up to the last chunk whose hash matches the local file and the upload continues from there.
+  """
+  chunk_size = get_chunk_size(host)
+  partial_file = get_partial_path(remote_file)
+  size = local_file.stat().st_size
+  start = time.monotonic()
+
+  offset = find_resume_offset(ssh, sftp, local_file, partial_file, chunk_size)
+  sent_from = offset
+  if offset:
+    print(f"Resuming upload of {local_file} to {remote_file} at {offset} of {size} bytes")
+    sftp.truncate(partial_file, offset)
+    transfer_stats.count("uploads_resumed")
+    transfer_stats.count("resume_bytes_saved", offset)
+    mode = 'r+b'
+  else:
+    print(f"Sending {local_file} to {remote_file} in {chunk_size // (1024 * 1024)} MiB chunks...")
+    mode = 'wb'
+
+  with open(local_file, 'rb') as src, sftp.open(partial_file, mode) as dst:
+    dst.set_pipelined(True)
+    src.seek(offset)
+    dst.seek(offset)
+    while offset < size:
+      chunk = src.read(min(chunk_size, size - offset))
+      if not chunk:
+        break
+      for block_start in range(0, len(chunk), WRITE_BLOCK_SIZE):
+        dst.write(chunk[block_start:block_start + WRITE_BLOCK_SIZE])
+      # Push the chunk out before reading the next one; whatever arrived is verified on resume
+      dst.flush()
+      offset += len(chunk)
+
+  remote_size = sftp.stat(partial_file).st_size
+  if remote_size != size:
+    raise IOError(f"Size mismatch after upload of {local_file}: {remote_size} != {size}")
+
+  try:
+    sftp.posix_rename(partial_file, remote_file)
+  except IOError:
+    # Server without the posix-rename extension; plain rename fails if the target exists
+    try:
+      sftp.remove(remote_file)
+    except FileNotFoundError:
+      pass
+    sftp.rename(partial_file, remote_file)
+
+  transfer_tuning.report_transfer(local_file, remote_file, size - sent_from, time.monotonic() - start)
+  transfer_stats.count("bytes_sent", size - sent_from)
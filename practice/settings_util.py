@@ -19,5 +19,42 @@ def save_settings():
 def get_settings():
   return settings
 
-
-  
\ No newline at end of file
+def get_setting(key, default=None):
+  """Returns a top level setting, falling back to the default when it is missing."""
+  value = settings.get(key) if settings else None
+  return default if value is None else value
+
+
+  
+
+def get_host_setting(host, key, default=None):
+  """
+  Returns a per host setting from the 'hosts' section of the config, e.g.
+
+  hosts:
+    192.168.1.20:
+      sftp_channels: 8
+
+  Falls back to the top level setting of the same name, then to the default.
+  """
+  host_settings = (settings.get('hosts') or {}).get(host) or {} if settings else {}
+  value = host_settings.get(key)
+  if value is None:
+    return get_setting(key, default)
+  return value
+
+def get_folder_setting(tracked_path, key, default=None):
+  """
+  Returns a per tracked folder setting from the 'folders' section of the config, e.g.
+
+  folders:
+    /home/user/datasets:
+      lane: bulk
+
+  Falls back to the top level setting of the same name, then to the default.
+  """
+  folder_settings = (settings.get('folders') or {}).get(tracked_path) or {} if settings else {}
+  value = folder_settings.get(key)
+  if value is None:
+    return get_setting(key, default)
+  return value
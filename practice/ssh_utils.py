@@ -2,117 +2,931 @@ import paramiko
 from pathlib import Path
 import os
 import traceback
+import socket
+import shlex
 from SSHConnectionPool import SSHConnectionPool
 import queue
+import threading
+import contextvars
+import time
+from collections import namedtuple
+from stat import S_ISDIR
+from tree_walker import walk_files
 from FileActions import FileAction
+from HostWorkerPool import HostWorkerPool
+import settings_util
+import file_indexer_hasher
+import delta_sync
+import transfer_stats
+import tar_bundler
+import resumable_upload
+import transfer_tuning
+import content_dedup
+import delete_tombstones
+import remote_manifest
+from OutboundJournal import OutboundJournal
+from RetryScheduler import RetryScheduler
+from HostCircuitBreaker import HostCircuitBreaker
+from SendLanes import SendLanes, INTERACTIVE, BULK
 
-ssh_pool = SSHConnectionPool(timeout=180)
+# Seconds the event queue must stay quiet before a batch is sent
+DEFAULT_BATCH_DEBOUNCE = 0.5
+# Upper bound on how long a batch keeps collecting events during a continuous storm
+DEFAULT_BATCH_MAX_WAIT = 5
+# Number of host groups that may transfer at the same time
+DEFAULT_MAX_CONCURRENT_HOSTS = 4
+# SFTP channels opened per host connection (override per host under 'hosts' in config.yaml)
+DEFAULT_SFTP_CHANNELS = 4
+# Times a batch reconnects to a host whose connection dropped mid-transfer to resume the failed files
+DEFAULT_RECONNECT_ATTEMPTS = 3
+# Backoff of failed transfers: base * 2^(attempt - 1) seconds with jitter, capped at the max
+DEFAULT_RETRY_BASE_DELAY = 2
+DEFAULT_RETRY_MAX_DELAY = 300
+# Consecutive connection failures before a host's work is parked, and how often it is probed then
+DEFAULT_BREAKER_FAILURE_THRESHOLD = 3
+DEFAULT_BREAKER_PROBE_INTERVAL = 5
+DEFAULT_BREAKER_MAX_PROBE_INTERVAL = 300
+DEFAULT_CONNECT_TIMEOUT = 15
+# Connection pool limits: total connections, connections per host and seconds between health checks
+DEFAULT_MAX_CONNECTIONS = 10
+DEFAULT_MAX_CONNECTIONS_PER_HOST = 2
+DEFAULT_HEALTH_CHECK_INTERVAL = 30
+
+# Files up to this size are always sent in the interactive lane, and recently edited ones up to the
+# larger size; everything else goes to the bulk lane (override per tracked folder under 'folders')
+DEFAULT_INTERACTIVE_MAX_SIZE = 1024 * 1024
+DEFAULT_RECENT_MAX_SIZE = 32 * 1024 * 1024
+DEFAULT_RECENT_SECONDS = 300
+# Relative shares of a host's SFTP channels while both lanes send to it
+DEFAULT_INTERACTIVE_LANE_WEIGHT = 3
+DEFAULT_BULK_LANE_WEIGHT = 1
+
+# Longest argument list handed to one remote rm command
+MAX_DELETE_COMMAND_LENGTH = 64 * 1024
+
+SSH_KEY_PATH = Path.home() / ".ssh" / "id_ed25519"
+
+ssh_pool = SSHConnectionPool(timeout=180, connect_options=transfer_tuning.get_connect_options)
 file_event_queue = queue.Queue()
+host_workers = HostWorkerPool(max_concurrency=DEFAULT_MAX_CONCURRENT_HOSTS)
+# Queued actions per destination, replayed at startup so pending transfers survive a restart
+journal = OutboundJournal(Path("file_indexes/outbound_journal.log"))
+# Failed destinations wait here for their retry; hosts that are down are parked until a probe reaches them
+host_breakers = HostCircuitBreaker(probe=lambda key: probe_host(key), on_recover=lambda key: retry_scheduler.release_host(key))
+retry_scheduler = RetryScheduler(on_due=lambda *retry: queue_retry(*retry), is_parked=host_breakers.is_open)
+# Large files go out on a background lane so they do not delay small edits
+send_lanes = SendLanes()
+# Actions held back until the bulk lane has sent their paths, as event tuples, and the paths they touch.
+# Only used by the sender thread.
+deferred_events = []
+deferred_paths = set()
+
+# One file to send to one destination
+SendItem = namedtuple("SendItem", ["file", "remote_path", "tracked_path", "inbox_path", "local_file", "relative", "remote_file_path", "size", "destination"])
 
 file_send_queue = dict()
 file_rename_queue = dict()
 file_delete_queue = dict()
 
-def send_files_over_ssh():
+def send_files_over_ssh(file_queue : dict = None, lane : str = INTERACTIVE):
   global file_send_queue
-  """Sends the files in the queue to the remote host using SSH."""
-  ssh_key_path = Path.home() / ".ssh" / "id_ed25519"
-  failed_queue = {}
+  """
+  Sends the files in the queue to the remote host using SSH. Each host group is sent concurrently.
+  The interactive lane (the sender's batch) hands its bulk files to the bulk lane first.
+  """
+  if file_queue is None:
+    file_queue = file_send_queue
+  # Each lane counts for itself, so a batch of one never resets or reports the other's
+  transfer_stats.set_lane(lane)
+  transfer_stats.reset()
+
+  if lane == INTERACTIVE:
+    # Sent after the held back renames and deletes of the same paths, never before them
+    defer_events(FileAction.SEND_FILE, file_queue, wait_for_bulk_lane=False)
+
+  # Expand the queued paths into files once, shared by every destination
+  expanded = expand_send_queue(file_queue)
+  held = skip_unchanged_files(expanded, file_queue)
+  if lane == INTERACTIVE and settings_util.get_setting('bulk_lane', True):
+    hand_off_bulk_files(expanded, file_queue)
+  captured = capture_sent_entries(expanded)
 
   # Group files by SSH destination
-  ssh_groups = group_files_by_ssh(file_send_queue)
+  ssh_groups = group_files_by_ssh(file_queue)
+  failed_queue, parked_queue = run_host_groups(ssh_groups, send_group_over_ssh, expanded, held, SSH_KEY_PATH, lane, lane=lane)
 
-  # For each SSH Group, open a connection and send files
-  for (user, host), file_list in ssh_groups.items():
-    # print(f"Connecting to {host} as {user}...")
-
-    ssh = ssh_pool.get_connection(user, host, ssh_key_path.as_posix())
-    if ssh is None or ssh.get_transport() is None or not ssh.get_transport().is_active():
-      print("Connection is unusable. Skipping.")
-    if ssh is None:
-      print(f"Could not establish SSH connection to {host} as {user}. Skipping this group.")
-      for file, remote_path, _, _ in file_list:
-          failed_queue.setdefault(file, []).append(remote_path)
-      continue  # Skip to next group
+  print(f"Files sent ({lane} lane). Failed transfers:", failed_queue)
+  transfer_stats.print_stats()
+  content_dedup.print_summary()
+  record_delivered_files(expanded, failed_queue, file_queue, captured)
+  settle_queue(FileAction.SEND_FILE, file_queue, failed_queue, parked_queue)
+  return failed_queue
+
+def get_lane_policy(tracked_path : str) -> dict:
+  """The lane thresholds of a tracked folder. A 'lane' setting sends all of its files through one lane."""
+  return {
+    "lane": settings_util.get_folder_setting(tracked_path, 'lane'),
+    "interactive_max_size": settings_util.get_folder_setting(tracked_path, 'interactive_max_size', DEFAULT_INTERACTIVE_MAX_SIZE),
+    "recent_max_size": settings_util.get_folder_setting(tracked_path, 'recent_max_size', DEFAULT_RECENT_MAX_SIZE),
+    "recent_seconds": settings_util.get_folder_setting(tracked_path, 'recent_seconds', DEFAULT_RECENT_SECONDS)
+  }
 
-    print("Connected. Sending files...")
+def get_lane_weights(host : str) -> dict:
+  return {
+    INTERACTIVE: settings_util.get_host_setting(host, 'interactive_lane_weight', DEFAULT_INTERACTIVE_LANE_WEIGHT),
+    BULK: settings_util.get_host_setting(host, 'bulk_lane_weight', DEFAULT_BULK_LANE_WEIGHT)
+  }
 
+def hand_off_bulk_files(expanded : dict, file_queue : dict):
+  """
+  Moves the files picked for the bulk lane out of the batch.
+
+  A queued file goes over with its queue entry, still pending in the journal. Bulk files found
+  in a queued directory become queue entries of their own, journaled before the directory is acked.
+  A file belongs to one lane at a time: one the bulk lane is sending goes to it again, to be sent
+  after that upload, and one still waiting there is taken back into the batch.
+  """
+  now = time.time()
+  handed_over = 0
+  for file in list(expanded):
+    info = file_queue[file]
+    policy = get_lane_policy(info["tracked_path"])
+    interactive_files = []
+    bulk_files = []
+    for local_file, relative, stat in expanded[file]:
+      lane = SendLanes.classify(stat.st_size, now - stat.st_mtime, policy)
+      if lane == INTERACTIVE and not claim_bulk_file(file, info, local_file):
+        lane = BULK
+      (bulk_files if lane == BULK else interactive_files).append((local_file, relative, stat))
+    if not bulk_files:
+      continue
+
+    handed_over += len(bulk_files)
+    if not interactive_files and len(bulk_files) == 1 and bulk_files[0][0] == Path(file):
+      send_lanes.hand_off(file, info)
+      del expanded[file]
+      del file_queue[file]
+      continue
+
+    for local_file, _, _ in bulk_files:
+      journal.record_queued(FileAction.SEND_FILE.value, local_file.as_posix(), info["remote_dirs"], info["tracked_path"])
+      send_lanes.hand_off(local_file.as_posix(), info)
+    expanded[file] = interactive_files
+
+  if handed_over:
+    journal.flush()
+    print(f"Handed {handed_over} large files to the bulk lane.")
+
+def claim_bulk_file(file : str, info : dict, local_file : Path) -> bool:
+  """
+  Takes a file for the interactive lane's batch from the bulk lane, where an earlier batch may have put it.
+  Returns False when it has to stay with the bulk lane: while it is being sent there, or when its
+  waiting bulk item has destinations that its queued directory does not cover.
+  """
+  claimed, replaced = send_lanes.claim(local_file.as_posix())
+  if not claimed or replaced is None:
+    return claimed
+  if local_file == Path(file):
+    # Same queue entry and journal record, which now covers the bulk item's destinations too
+    info["remote_dirs"] = {**replaced["remote_dirs"], **info["remote_dirs"]}
+  elif replaced["remote_dirs"].keys() <= info["remote_dirs"].keys():
+    # The queued directory's journal record covers the file from now on
+    journal.record_delivered(FileAction.SEND_FILE.value, local_file.as_posix(), replaced["remote_dirs"].keys())
+  else:
+    send_lanes.hand_off(local_file.as_posix(), replaced)
+    return False
+  return True
+
+def bulk_sender_worker():
+  """Sends the files handed to the bulk lane, one batch at a time, alongside the interactive batches."""
+  while True:
+    bulk_queue = send_lanes.take()
+    files = list(bulk_queue)
+    print(f"\nBulk lane: sending {len(bulk_queue)} files in the background.")
     try:
-      sftp = ssh.open_sftp()
-      for file, remote_path, tracked_path, inbox_path in file_list:
-        path = Path(file)
-        folder_path = Path(tracked_path)
-        try:
-          if path.is_file():
-            relative = path.relative_to(folder_path)
-            remote_file_path = f"{inbox_path}/{remote_path.lstrip('/')}/{relative.as_posix()}"
-            remote_subdir = os.path.dirname(remote_file_path)
-            ensure_remote_dir(sftp, remote_subdir)
-            print(remote_file_path)
-            send_file(sftp, str(path), str(remote_file_path))
-          elif path.is_dir():
-            for subpath in path.rglob('*'):
-              if subpath.is_file():
-                relative = subpath.relative_to(path)
-                remote_file_path = f"{inbox_path}/{remote_path.lstrip('/')}/{relative.as_posix()}"
-                remote_subdir = os.path.dirname(remote_file_path)
-                ensure_remote_dir(sftp, remote_subdir)
-                send_file(sftp, str(subpath), str(remote_file_path))
-        except Exception as e:
-          print(f"Failed to send {file} to {remote_path}: {e}")
-          traceback.print_exc()
-          failed_queue.setdefault(file, []).append(remote_path)
-      sftp.close()
+      send_files_over_ssh(bulk_queue, BULK)
     except Exception as e:
-      print(f"Failed to connect to {host} as {user}: {e}")
+      print(f"Bulk lane batch failed: {e}")
       traceback.print_exc()
-      # Mark all files for this host/user as failed
-      for file, remote_path, _, _ in file_list:
+    finally:
+      send_lanes.finish(files)
+
+def clear_bulk_lane(paths : set):
+  """Drops the bulk lane's pending files at or below paths, which were deleted or moved."""
+  cancelled = send_lanes.cancel(paths)
+  for file, info in cancelled.items():
+    journal.record_delivered(FileAction.SEND_FILE.value, file, info["remote_dirs"].keys())
+  if cancelled:
+    journal.flush()
+    print(f"Dropped {len(cancelled)} files from the bulk lane that were deleted or moved.")
+
+def get_event_paths(info : dict, file : str) -> set:
+  """The local paths a queued action touches: a rename's old path as well as its new one."""
+  return {file} if info.get("old_path") is None else {file, str(info["old_path"])}
+
+def defer_events(action : FileAction, file_queue : dict, wait_for_bulk_lane : bool = True):
+  """
+  Holds back queued actions that must not reach the remote before the bulk lane's uploads, so the
+  sender goes on with everything else instead of waiting. With wait_for_bulk_lane, actions on paths
+  the bulk lane is sending are held, since those uploads could land after a delete or rename and
+  bring the old file back. Actions on paths overlapping ones already held are always held, to keep
+  their order. They stay pending in the journal until release_deferred_events queues them again.
+  """
+  for file in list(file_queue):
+    info = file_queue[file]
+    paths = get_event_paths(info, file)
+    overlaps = any(SendLanes.is_below(path, deferred_paths) for path in paths) or \
+               any(SendLanes.is_below(path, paths) for path in deferred_paths)
+    if overlaps or (wait_for_bulk_lane and send_lanes.is_sending(paths)):
+      deferred_events.append((file, info["remote_dirs"], info["tracked_path"], action, info.get("old_path")))
+      deferred_paths.update(paths)
+      del file_queue[file]
+      print(f"Holding back {action.value} of {file} until the bulk lane is done with its paths.")
+
+def release_deferred_events():
+  """Queues the held back actions again, in order, once the bulk lane sends none of their paths."""
+  if not deferred_events or send_lanes.is_sending(deferred_paths):
+    return
+  for event in deferred_events:
+    file_event_queue.put(event)
+  print(f"Queued {len(deferred_events)} held back actions again.")
+  deferred_events.clear()
+  deferred_paths.clear()
+
+def run_host_groups(ssh_groups : dict, group_fn, *args, lane : str = None) -> tuple:
+  """
+  Runs group_fn(user, host, file_list, *args) for every SSH group on its host's worker,
+  so one slow host does not hold up the others. Groups of hosts whose circuit breaker
+  is open are parked without connecting. Each lane has its own worker per host and its own
+  concurrency cap, so the bulk lane's long transfers do not queue up the interactive lane's.
+
+  group_fn returns its failed files as [file] -> [remote_path]. Returns the failed and the parked
+  destinations, both [file] -> [(user, host, remote_path)], since two hosts can share a remote path.
+  """
+  failed_queue = {}
+  parked_queue = {} # Destinations on hosts whose circuit breaker is open, not attempted
+
+  futures = {}
+  for (user, host), file_list in ssh_groups.items():
+    if host_breakers.is_open((user, host)):
+      print(f"{user}@{host} is down, parking {len(file_list)} queued paths.")
+      for file, remote_path, *_ in file_list:
+        parked_queue.setdefault(file, []).append((user, host, remote_path))
+        failed_queue.setdefault(file, []).append((user, host, remote_path))
+      continue
+    worker_key = (user, host) if lane is None else (user, host, lane)
+    # Renames and deletes run on the sender, between the interactive lane's batches, and share its slots
+    futures[(user, host)] = host_workers.submit(worker_key, group_fn, user, host, file_list, *args, group=lane or INTERACTIVE)
+
+  for (user, host), future in futures.items():
+    try:
+      group_failed = future.result()
+    except Exception as e:
+      print(f"Transfer worker for {user}@{host} failed: {e}")
+      traceback.print_exc()
+      group_failed = {}
+      for file, remote_path, *_ in ssh_groups[(user, host)]:
+        group_failed.setdefault(file, []).append(remote_path)
+
+    for file, remote_paths in group_failed.items():
+      failed_queue.setdefault(file, []).extend((user, host, remote_path) for remote_path in remote_paths)
+
+  return failed_queue, parked_queue
+
+def get_destination(remote_info : dict) -> tuple:
+  """The (user, host, remote path) a linked path's files are sent to, as failures are reported."""
+  return (remote_info["user"], remote_info["host_url"], f"{remote_info['base_path']}/{remote_info['remote_path']}")
+
+def get_index_destinations(remote_dirs : dict) -> dict:
+  """[destination as index entries record it] -> (user, host, remote path) of every linked path in remote_dirs."""
+  destinations = {}
+  for remote_info in remote_dirs.values():
+    destination = get_destination(remote_info)
+    destinations[file_indexer_hasher.format_destination(*destination)] = destination
+  return destinations
+
+def expand_send_queue(file_queue : dict) -> dict:
+  """
+  Expands every queued path into the files to send.
+
+  Returns [queued file] -> [(local file, path relative to the tracked folder, stat result)].
+  Directories are expanded with one scandir walk whose stat results are reused by the later checks;
+  paths removed since they were queued expand to nothing.
+  """
+  expanded = {}
+  for file, info in file_queue.items():
+    path = Path(file)
+    folder_path = Path(info["tracked_path"])
+    try:
+      stat = path.stat()
+    except OSError:
+      expanded[file] = []
+      continue
+
+    if S_ISDIR(stat.st_mode):
+      prefix = path.relative_to(folder_path).as_posix()
+      prefix = "" if prefix == "." else prefix + "/"
+      expanded[file] = [(Path(local_file), prefix + relative, file_stat) for local_file, relative, file_stat in walk_files(path)]
+    else:
+      expanded[file] = [(path, path.relative_to(folder_path).as_posix(), stat)]
+  return expanded
+
+def skip_unchanged_files(expanded : dict, file_queue : dict) -> dict:
+  """
+  Drops files whose content matches their index entry, which records what was last delivered and where.
+
+  A file with the same size and modification time is unchanged without hashing. If only the
+  modification time changed, the file is hashed and unchanged when the content is identical;
+  its entry then gets the new time so the next check is cheap again. An unchanged file is only
+  dropped once every queued destination holds it.
+  Returns the destinations that already hold the kept files ([local file] -> {destination}).
+  """
+  held = {}
+  touched = {} # [index key] -> {[relative path] -> entry}
+  for file, local_files in expanded.items():
+    index_key = file_indexer_hasher.get_index_key(file_queue[file]["tracked_path"])
+    index = file_indexer_hasher.get_live_index(index_key)
+    destinations = set(get_index_destinations(file_queue[file]["remote_dirs"]))
+    changed_files = []
+    for local_file, relative, stat in local_files:
+      entry = index.get(relative)
+      try:
+        if entry and entry.get("size") == stat.st_size:
+          unchanged = file_indexer_hasher.matches_stat(entry, stat)
+          if not unchanged:
+            new_entry = file_indexer_hasher.get_pending_entry(local_file, delta_sync.get_signature_block_size(local_file))
+            algorithm = file_indexer_hasher.get_entry_algorithm(entry)
+            if algorithm == new_entry["algorithm"]:
+              new_hash = new_entry["hash"]
+            else:
+              new_hash = file_indexer_hasher.generate_file_hash(local_file, algorithm)
+            if new_hash == entry.get("hash"):
+              unchanged = True
+              entry = {**entry, "modified_time": new_entry["modified_time"]}
+              touched.setdefault(index_key, {})[relative] = entry
+
+          if unchanged:
+            holders = {destination for destination in destinations if file_indexer_hasher.is_delivered_to(entry, destination)}
+            if holders == destinations:
+              transfer_stats.count("files_skipped_unchanged")
+              file_indexer_hasher.pop_pending_entry(local_file)
+              continue
+            if holders:
+              held[local_file.as_posix()] = holders
+      except OSError as e:
+        print(f"Could not check {local_file} for changes: {e}")
+      changed_files.append((local_file, relative, stat))
+    expanded[file] = changed_files
+
+  for index_key, entries in touched.items():
+    file_indexer_hasher.update_index_entries(index_key, entries)
+  return held
+
+def capture_sent_entries(expanded : dict) -> dict:
+  """
+  Builds the index entries of the files about to be sent, before they are read for the transfer,
+  so what is recorded afterwards is never newer than what was sent. Returns [local file] -> entry.
+  """
+  captured = {}
+  for local_files in expanded.values():
+    for local_file, _, _ in local_files:
+      try:
+        captured[local_file.as_posix()] = file_indexer_hasher.get_pending_entry(local_file, delta_sync.get_signature_block_size(local_file))
+      except OSError as e:
+        print(f"Could not hash {local_file} before sending it: {e}")
+  return captured
+
+def record_delivered_files(expanded : dict, failed_queue : dict, file_queue : dict, captured : dict):
+  """
+  Records the size, modification time and hash of every delivered file, with block signatures
+  for large files, and the destinations that hold it under "remotes".
+
+  The entry captured before the transfer is only recorded if the file is unchanged since; a file
+  edited during its upload loses its entry, since what its destinations hold is not known.
+  A file that reached no destination keeps its entry, which still describes the remote copies.
+  """
+  updates = {} # [index key] -> {[relative path] -> entry}
+  removed = {} # [index key] -> [relative path]
+  for file, local_files in expanded.items():
+    index_key = file_indexer_hasher.get_index_key(file_queue[file]["tracked_path"])
+    index = file_indexer_hasher.get_live_index(index_key)
+    failed = set(failed_queue.get(file, []))
+    delivered = {name for name, destination in get_index_destinations(file_queue[file]["remote_dirs"]).items() if destination not in failed}
+    for local_file, relative, _ in local_files:
+      entry = captured.get(local_file.as_posix())
+      file_indexer_hasher.pop_pending_entry(local_file)
+      if entry is None:
+        continue
+      try:
+        unchanged = file_indexer_hasher.matches_stat(entry, local_file.stat())
+      except OSError:
+        unchanged = False
+      if not unchanged:
+        removed.setdefault(index_key, []).append(relative)
+        continue
+
+      previous = index.get(relative)
+      if previous and previous.get("hash") == entry["hash"] and file_indexer_hasher.get_entry_algorithm(previous) == entry["algorithm"]:
+        # Same content as before, so its earlier destinations still hold it
+        entry = {**entry, "remotes": sorted(set(previous["remotes"]) | delivered)} if "remotes" in previous else dict(entry)
+      elif delivered:
+        entry = {**entry, "remotes": sorted(delivered)}
+      else:
+        continue
+      updates.setdefault(index_key, {})[relative] = entry
+
+  for index_key in updates.keys() | removed.keys():
+    file_indexer_hasher.update_index_entries(index_key, updates.get(index_key, {}), removed.get(index_key, []))
+
+def settle_queue(action : FileAction, file_queue : dict, failed_queue : dict, parked_queue : dict) -> dict:
+  """
+  Empties an action's queue after a batch.
+
+  Delivered destinations are acked in the journal. Failed destinations are handed to the
+  retry scheduler, so only they are retried, after a backoff, without repeating the action
+  on the hosts that succeeded. Parked destinations wait there until their host is reachable.
+  Returns the delivered destinations ([file] -> {[remote_url] -> remote_info}).
+  """
+  delivered_queue = {}
+  for file, info in file_queue.items():
+    failed_remotes = failed_queue.get(file, [])
+    parked_remotes = parked_queue.get(file, [])
+    delivered = {}
+    for remote_url, remote_info in info["remote_dirs"].items():
+      destination = get_destination(remote_info)
+      if destination in failed_remotes:
+        host_key = (remote_info["user"], remote_info["host_url"])
+        retry_scheduler.schedule(action, file, info["tracked_path"], remote_url, remote_info, host_key,
+                                 old_path=info.get("old_path"), count_attempt=destination not in parked_remotes)
+      else:
+        delivered[remote_url] = remote_info
+    journal.record_delivered(action.value, file, delivered.keys())
+    retry_scheduler.forget(action, file, delivered.keys())
+    delivered_queue[file] = delivered
+  file_queue.clear()
+  journal.flush()
+  return delivered_queue
+
+def queue_retry(action : FileAction, file : str, tracked_path : str, remote_dirs : dict, old_path : str):
+  """Puts a due retry back on the event queue, limited to the destinations that failed."""
+  file_event_queue.put((file, remote_dirs, tracked_path, action, old_path))
+
+def probe_host(key : tuple) -> bool:
+  """Checks whether a parked host accepts connections again, without holding up the connection pool."""
+  _, host = key
+  try:
+    socket.create_connection(ssh_pool.parse_host_port(host), timeout=ssh_pool.connect_timeout).close()
+    return True
+  except OSError:
+    return False
+
+def send_group_over_ssh(user : str, host : str, file_list : list, expanded : dict, held : dict, ssh_key_path : Path, lane : str = INTERACTIVE) -> dict:
+  """
+  Sends one SSH group's files to its host, except the ones held says it already holds.
+  Returns the failed files ([file] -> [remote_path]).
+  """
+  failed_queue = {}
+
+  ssh = ssh_pool.checkout(user, host, ssh_key_path.as_posix())
+  if ssh is None:
+    print(f"Could not establish SSH connection to {host} as {user}. Skipping this group.")
+    host_breakers.record_failure((user, host))
+    for file, remote_path, _, _ in file_list:
         failed_queue.setdefault(file, []).append(remote_path)
+    return failed_queue
+
+  host_breakers.record_success((user, host))
+  transfer_tuning.tune_transport(ssh.get_transport(), host)
+  print(f"Connected to {host} as {user}. Sending files...")
+
+  try:
+    group_items = expand_group_files(user, host, file_list, expanded, held)
+
+    # Content the host already holds is copied there instead of sent again
+    dedup_jobs, items, followers = content_dedup.plan_dedup(user, host, group_items)
+    items += content_dedup.run_dedup_jobs(ssh, host, dedup_jobs)
+
+    # Many small files go out as tar bundles, the rest (and any failed bundle) over SFTP
+    bundle_items, items = tar_bundler.split_bundle_items(host, items)
+    if bundle_items:
+      items += tar_bundler.send_bundles(ssh, host, bundle_items)
+
+    reconnect_attempts = settings_util.get_host_setting(host, 'reconnect_attempts', DEFAULT_RECONNECT_ATTEMPTS)
+    while items:
+      channel_count = SendLanes.share_channels(settings_util.get_host_setting(host, 'sftp_channels', DEFAULT_SFTP_CHANNELS), lane, get_lane_weights(host))
+      channel_count = min(channel_count, len(items))
+      known_dirs = ssh_pool.get_remote_dir_cache(user, host)
+      items = send_items_over_channels(ssh, host, items, channel_count, known_dirs)
+
+      # Failures on a live connection are retried with the next batch. A dropped connection
+      # is re-established right away so large uploads resume from their partial files.
+      if not items or is_connection_active(ssh) or reconnect_attempts <= 0:
+        break
+      reconnect_attempts -= 1
+      print(f"Connection to {host} dropped, reconnecting to resume {len(items)} files...")
+      ssh_pool.checkin(user, host, ssh)
+      ssh = ssh_pool.checkout(user, host, ssh_key_path.as_posix())
+      if ssh is None:
+        host_breakers.record_failure((user, host))
+        break
+      transfer_tuning.tune_transport(ssh.get_transport(), host)
+
+    # Duplicates within the batch are copied from the copy that was just sent
+    if ssh is not None and is_connection_active(ssh):
+      failed_items = set(items)
+      store_entries = content_dedup.get_store_entries(host, [item for item in group_items if item not in failed_items])
+      items += content_dedup.run_dedup_jobs(ssh, host, followers, store_entries)
+    else:
+      items += [job.item for job in followers]
+
+    for item in items:
+      remote_paths = failed_queue.setdefault(item.file, [])
+      if item.remote_path not in remote_paths:
+        remote_paths.append(item.remote_path)
+  except Exception as e:
+    print(f"Failed to connect to {host} as {user}: {e}")
+    traceback.print_exc()
+    # Mark all files for this host/user as failed
+    for file, remote_path, _, _ in file_list:
+      failed_queue.setdefault(file, []).append(remote_path)
+  finally:
+    if ssh is not None:
+      ssh_pool.checkin(user, host, ssh)
 
-  print("Files sent. Failed transfers:", failed_queue)
   return failed_queue
 
+def is_connection_active(ssh : paramiko.SSHClient) -> bool:
+  transport = ssh.get_transport()
+  return transport is not None and transport.is_active()
+
+def expand_group_files(user : str, host : str, file_list : list, expanded : dict, held : dict = None) -> list:
+  """
+  Turns the queued paths of an SSH group into one item per file to send.
+
+  Each SendItem places the remote file in the remote inbox relative to the tracked folder.
+  Files that held ([local file] -> {destination}) lists for their destination are left out.
+  """
+  items = []
+  for file, remote_path, tracked_path, inbox_path in file_list:
+    destination = file_indexer_hasher.format_destination(user, host, remote_path)
+    for local_file, relative, stat in expanded.get(file, []):
+      if held and destination in held.get(local_file.as_posix(), ()):
+        continue
+      remote_file_path = f"{inbox_path}/{remote_path.lstrip('/')}/{relative}"
+      items.append(SendItem(file, remote_path, tracked_path, inbox_path, local_file, relative, remote_file_path, stat.st_size, destination))
+  return items
+
+def send_items_over_channels(ssh : paramiko.SSHClient, host : str, items : list, channel_count : int, known_dirs : set) -> dict:
+  """
+  Sends the expanded items over several SFTP channels of the same connection.
+
+  All remote directories of the batch are created up front. Then every channel pulls the
+  next item from a shared queue, so the per-file round trips of one channel overlap with
+  the transfers of the others.
+  Returns the items that failed.
+  """
+  failed_items = []
+  failed_lock = threading.Lock()
+  work_queue = queue.Queue()
+  # Smallest first, so short transfers are not stuck behind long ones on the same channels
+  for item in sorted(items, key=lambda item: item.size):
+    work_queue.put(item)
+
+  def channel_worker(sftp : paramiko.SFTPClient):
+    while True:
+      try:
+        item = work_queue.get_nowait()
+      except queue.Empty:
+        return
+      try:
+        ensure_remote_dir(sftp, os.path.dirname(item.remote_file_path), known_dirs)
+        send_item(ssh, sftp, host, item)
+        transfer_stats.count("files_sent")
+      except Exception as e:
+        print(f"Failed to send {item.local_file} to {item.remote_file_path}: {e}")
+        traceback.print_exc()
+        transfer_stats.count("files_failed")
+        # The directory may have been removed remotely, check it again next time
+        known_dirs.discard(os.path.dirname(item.remote_file_path))
+        with failed_lock:
+          failed_items.append(item)
+
+  start = time.monotonic()
+  sftp_clients = ssh_pool.open_sftp_channels(ssh, channel_count)
+  try:
+    create_remote_dirs(sftp_clients[0], [item.remote_file_path for item in items], known_dirs)
+
+    if len(sftp_clients) == 1:
+      channel_worker(sftp_clients[0])
+    else:
+      # Each channel counts its transfers for the batch's lane
+      threads = [threading.Thread(target=contextvars.copy_context().run, args=(channel_worker, sftp), daemon=True) for sftp in sftp_clients]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+  finally:
+    for sftp in sftp_clients:
+      sftp.close()
+
+  elapsed = max(time.monotonic() - start, 1e-6)
+  print(f"Sent {len(items)} files one by one to {host} over {len(sftp_clients)} channels in {elapsed:.2f}s: "
+        f"{len(items) / elapsed:.0f} files/s")
+  return failed_items
+
+def send_item(ssh : paramiko.SSHClient, sftp : paramiko.SFTPClient, host : str, item):
+  """
+  Sends one file, as a delta against the remote's current copy when it was delivered before and is large.
+  Other large files go through a resumable upload, the rest through sftp.put.
+  """
+  entry = file_indexer_hasher.get_live_index(file_indexer_hasher.get_index_key(item.tracked_path)).get(item.relative)
+  # The signatures only describe the remote's copy if this destination received that content
+  if entry and file_indexer_hasher.is_delivered_to(entry, item.destination) and delta_sync.can_send_delta(item.local_file, entry, host):
+    try:
+      basis_file = delta_sync.get_basis_path(item.remote_path, item.relative)
+      delta_sync.send_file_delta(ssh, item.local_file, basis_file, item.remote_file_path, entry)
+      return
+    except Exception as e:
+      print(f"Delta transfer of {item.local_file} failed, sending the whole file instead: {e}")
+
+  if resumable_upload.should_resume(item.size, host):
+    resumable_upload.upload_file_resumable(ssh, sftp, host, item.local_file, item.remote_file_path)
+  else:
+    send_file(sftp, str(item.local_file), item.remote_file_path, transfer_tuning.get_transfer_settings(host)["read_buffer_size"])
+
 def rename_files_over_ssh():
   global file_rename_queue
-  """Renames a file remotely using the queue"""
+  """
+  Propagates the queued moves as remote renames, batched per host.
 
-  ssh_key_path = Path.home() / ".ssh" / "id_ed25519"
-  failed_queue = {}
+  Every moved path is then queued for sending as well. Its index entries moved with it,
+  so unchanged files are skipped and only content edited along with the move is sent.
+  Moved files without an entry whose remote source turned out identical get one here.
+  """
+  # The moved paths are queued for sending after the rename, so bulk uploads of their old paths are dropped
+  clear_bulk_lane({str(info["old_path"]) for info in file_rename_queue.values()})
+  defer_events(FileAction.RENAME_FILE, file_rename_queue)
 
-  # Group files by SSH destination
+  verified = {} # [file] -> {destination} whose remote source was compared with the file itself
   ssh_groups = group_files_by_ssh(file_rename_queue, extra_keys=["old_path"])
+  failed_queue, parked_queue = run_host_groups(ssh_groups, rename_group_over_ssh, verified, SSH_KEY_PATH)
+  if failed_queue:
+    print("Failed renames:", failed_queue)
 
-  # For each SSH Group, open a connection and send files
-  for (user, host), file_list in ssh_groups.items():
-    # print(f"Connecting to {host} as {user}...")
-
-    ssh = ssh_pool.get_connection(user, host, ssh_key_path.as_posix())
-    if ssh is None or ssh.get_transport() is None or not ssh.get_transport().is_active():
-      print("Connection is unusable. Skipping.")
-    if ssh is None:
-      print(f"Could not establish SSH connection to {host} as {user}. Skipping this group.")
-      for file, remote_path, _, _ in file_list:
-          failed_queue.setdefault(file, []).append(remote_path)
-      continue  # Skip to next group
+  tracked_paths = {file: info["tracked_path"] for file, info in file_rename_queue.items()}
+  record_verified_files(verified, tracked_paths)
+  delivered_queue = settle_queue(FileAction.RENAME_FILE, file_rename_queue, failed_queue, parked_queue)
+  for file, delivered in delivered_queue.items():
+    if delivered:
+      add_file_to_queue(file, delivered, tracked_paths[file], FileAction.SEND_FILE)
+
+def record_verified_files(verified : dict, tracked_paths : dict):
+  """Records index entries for moved files that had none, naming the destinations found to hold them already."""
+  for file, destinations in verified.items():
+    index_key = file_indexer_hasher.get_index_key(tracked_paths[file])
+    try:
+      entry = file_indexer_hasher.get_pending_entry(file, delta_sync.get_signature_block_size(file))
+    except OSError:
+      continue
+    file_indexer_hasher.pop_pending_entry(file)
+    relative = Path(file).relative_to(tracked_paths[file]).as_posix()
+    file_indexer_hasher.update_index_entries(index_key, {relative: {**entry, "remotes": sorted(destinations)}})
+
+def rename_group_over_ssh(user : str, host : str, file_list : list, verified : dict, ssh_key_path : Path) -> dict:
+  """
+  Renames one SSH group's moved paths on its host. Paths whose remote source is missing
+  or holds different content are uploaded instead. Files without an index entry whose
+  remote source is identical are added to verified ([file] -> {destination}).
+  Returns the failed files ([file] -> [remote_path]).
+  """
+  failed_queue = {}
 
-    print("Connected. Renaming files...")
+  ssh = ssh_pool.checkout(user, host, ssh_key_path.as_posix())
+  if ssh is None:
+    print(f"Could not establish SSH connection to {host} as {user}. Skipping this group.")
+    host_breakers.record_failure((user, host))
+    for file, remote_path, *_ in file_list:
+      failed_queue.setdefault(file, []).append(remote_path)
+    return failed_queue
+
+  host_breakers.record_success((user, host))
+  transfer_tuning.tune_transport(ssh.get_transport(), host)
+  print(f"Connected to {host} as {user}. Renaming files...")
 
   try:
+    known_dirs = ssh_pool.get_remote_dir_cache(user, host)
+    upload_list = []
     sftp = ssh.open_sftp()
-    for file, remote_path, tracked_path, old_path in file_list:
-      new_path = Path(file)
-      old_path = Path(old_path)
-      folder_path = Path(tracked_path)
+    try:
+      for file, remote_path, tracked_path, inbox_path, old_path in file_list:
+        try:
+          destination = file_indexer_hasher.format_destination(user, host, remote_path)
+          if not rename_remote_path(ssh, sftp, file, old_path, remote_path, tracked_path, inbox_path, known_dirs, destination, verified):
+            upload_list.append((file, remote_path, tracked_path, inbox_path))
+        except Exception as e:
+          print(f"Failed to rename {old_path} to {file} on {host}: {e}")
+          failed_queue.setdefault(file, []).append(remote_path)
+    finally:
+      sftp.close()
+
+    if upload_list:
+      file_queue = {file: {"tracked_path": tracked_path} for file, _, tracked_path, _ in upload_list}
+      items = expand_group_files(user, host, upload_list, expand_send_queue(file_queue))
+      if items:
+        channel_count = min(settings_util.get_host_setting(host, 'sftp_channels', DEFAULT_SFTP_CHANNELS), len(items))
+        for item in send_items_over_channels(ssh, host, items, channel_count, known_dirs):
+          remote_paths = failed_queue.setdefault(item.file, [])
+          if item.remote_path not in remote_paths:
+            remote_paths.append(item.remote_path)
+  except Exception as e:
+    print(f"Failed to rename files on {host} as {user}: {e}")
+    traceback.print_exc()
+    for file, remote_path, *_ in file_list:
+      failed_queue.setdefault(file, []).append(remote_path)
+  finally:
+    ssh_pool.checkin(user, host, ssh)
+
+  return failed_queue
+
+def rename_remote_path(ssh : paramiko.SSHClient, sftp : paramiko.SFTPClient, file : str, old_file : str, remote_path : str,
+                       tracked_path : str, inbox_path : str, known_dirs : set, destination : str, verified : dict) -> bool:
+  """
+  Renames the remote copy of a moved file or directory, after leaving a tombstone in the
+  remote inbox so the remote's watcher does not send the rename back.
+
+  Returns False when it has to be uploaded instead: the remote source is missing, or it is a
+  file whose size differs from what was last delivered. A file without an index entry is
+  compared by hash with the remote source, and added to verified ([file] -> {destination})
+  when they match. A missing source with the destination already in place is taken as done,
+  e.g. the echo of a rename the remote made itself.
+  """
+  relative = Path(file).relative_to(tracked_path).as_posix()
+  remote_old = delta_sync.get_basis_path(remote_path, Path(old_file).relative_to(tracked_path).as_posix())
+  remote_new = delta_sync.get_basis_path(remote_path, relative)
+  is_dir = Path(file).is_dir()
+
+  try:
+    old_stat = sftp.stat(remote_old)
+  except FileNotFoundError:
+    try:
+      new_stat = sftp.stat(remote_new)
+      if S_ISDIR(new_stat.st_mode) == is_dir and (is_dir or new_stat.st_size == Path(file).stat().st_size):
+        transfer_stats.count("renames_already_applied")
+        return True
+    except FileNotFoundError:
+      pass
+    print(f"{remote_old} is missing remotely, uploading {file} instead.")
+    transfer_stats.count("renames_uploaded")
+    return False
+
+  if not is_dir:
+    entry = file_indexer_hasher.get_live_index(file_indexer_hasher.get_index_key(tracked_path)).get(relative)
+    if entry is None:
+      # Nothing was recorded for it, so the remote source itself is compared
+      if old_stat.st_size != Path(file).stat().st_size or not matches_remote_file(ssh, remote_old, Path(file)):
+        print(f"{remote_old} differs from {file}, uploading it instead.")
+        transfer_stats.count("renames_uploaded")
+        return False
+      verified.setdefault(file, set()).add(destination)
+    elif entry.get("size") != old_stat.st_size:
+      print(f"{remote_old} differs from what was last sent, uploading {file} instead.")
+      transfer_stats.count("renames_uploaded")
+      return False
+
+  tombstone_dir = delete_tombstones.get_tombstone_dir(inbox_path)
+  ensure_remote_dir(sftp, tombstone_dir, known_dirs)
+  sftp.open(f"{tombstone_dir}/{delete_tombstones.get_rename_tombstone_name(remote_old, remote_new)}", "w").close()
+  ensure_remote_dir(sftp, os.path.dirname(remote_new), known_dirs)
+  rename_file(sftp, remote_old, remote_new)
+  if is_dir:
+    # Directories cached below the old path no longer exist
+    for known_dir in [d for d in known_dirs if d == remote_old or d.startswith(remote_old + "/")]:
+      known_dirs.discard(known_dir)
+  transfer_stats.count("renames_sent")
+  return True
+
+def matches_remote_file(ssh : paramiko.SSHClient, remote_file : str, local_file : Path) -> bool:
+  """Whether the remote file has the local file's content, hashed on the remote with the local entry's algorithm."""
+  entry = file_indexer_hasher.get_pending_entry(local_file, delta_sync.get_signature_block_size(local_file))
+  try:
+    return remote_manifest.hash_remote_file(ssh, remote_file, entry["algorithm"]) == entry["hash"]
+  except IOError as e:
+    print(f"Could not compare {remote_file} with {local_file}: {e}")
+    return False
+
+def delete_files_over_ssh():
+  global file_delete_queue
+  """
+  Propagates the queued deletions, batched per host.
+
+  A deleted directory's own delete covers the deletes of everything inside it, so those
+  are dropped, and each host removes all of its paths with as few rm -rf commands as fit.
+  A path that exists again is not deleted: its delete is stale, or the echo of a peer's delete.
+  """
+  queued_paths = set(file_delete_queue)
+  for file in list(file_delete_queue):
+    # Covered by a deleted parent, or recreated and sent with its new content instead
+    covered = any(str(parent) in queued_paths for parent in Path(file).parents)
+    if covered or Path(file).exists():
+      journal.record_delivered(FileAction.DELETE_FILE.value, file)
+      del file_delete_queue[file]
+  clear_bulk_lane(set(file_delete_queue))
+  defer_events(FileAction.DELETE_FILE, file_delete_queue)
+
+  ssh_groups = group_files_by_ssh(file_delete_queue)
+  failed_queue, parked_queue = run_host_groups(ssh_groups, delete_group_over_ssh, SSH_KEY_PATH)
+  if failed_queue:
+    print("Failed deletions:", failed_queue)
+  settle_queue(FileAction.DELETE_FILE, file_delete_queue, failed_queue, parked_queue)
+
+def delete_group_over_ssh(user : str, host : str, file_list : list, ssh_key_path : Path) -> dict:
+  """
+  Deletes one SSH group's paths on its host. Each path gets a tombstone in the remote inbox first,
+  so the remote's watcher does not send the deletion back. Returns the failed files ([file] -> [remote_path]).
+  """
+  failed_queue = {}
+
+  ssh = ssh_pool.checkout(user, host, ssh_key_path.as_posix())
+  if ssh is None:
+    print(f"Could not establish SSH connection to {host} as {user}. Skipping this group.")
+    host_breakers.record_failure((user, host))
+    for file, remote_path, *_ in file_list:
+      failed_queue.setdefault(file, []).append(remote_path)
+    return failed_queue
+
+  host_breakers.record_success((user, host))
+  print(f"Connected to {host} as {user}. Deleting files...")
+
+  try:
+    targets = [] # (file, remote_path, remote target, remote tombstone)
+    for file, remote_path, tracked_path, inbox_path in file_list:
+      relative = Path(file).relative_to(tracked_path).as_posix()
+      if relative == ".":
+        continue # Never delete the remote copy of a whole tracked folder
+      target = delta_sync.get_basis_path(remote_path, relative)
+      tombstone = f"{delete_tombstones.get_tombstone_dir(inbox_path)}/{delete_tombstones.get_tombstone_name(target)}"
+      targets.append((file, remote_path, target, tombstone))
+
+    start = time.monotonic()
+    for batch in batch_delete_targets(targets):
       try:
-        if new_path.is_file():
-          relative = new_path.relative_to()
+        remove_remote_paths(ssh, [target for _, _, target, _ in batch], [tombstone for *_, tombstone in batch])
+        transfer_stats.count("paths_deleted", len(batch))
       except Exception as e:
-        print(f"Error occurred: {e}")
+        print(f"Failed to delete {len(batch)} paths on {host}: {e}")
+        for file, remote_path, *_ in batch:
+          failed_queue.setdefault(file, []).append(remote_path)
+
+    # Cached directories below the deleted paths are gone
+    known_dirs = ssh_pool.get_remote_dir_cache(user, host)
+    deleted = {target for _, _, target, _ in targets}
+    for known_dir in list(known_dirs):
+      directory = known_dir
+      while directory not in deleted and os.path.dirname(directory) != directory:
+        directory = os.path.dirname(directory)
+      if directory in deleted:
+        known_dirs.discard(known_dir)
 
+    print(f"Deleted {len(targets)} paths on {host} in {time.monotonic() - start:.2f}s")
   except Exception as e:
-    print(f"Error occurred: {e}")
+    print(f"Failed to delete files on {host} as {user}: {e}")
+    traceback.print_exc()
+    for file, remote_path, *_ in file_list:
+      failed_queue.setdefault(file, []).append(remote_path)
+  finally:
+    ssh_pool.checkin(user, host, ssh)
 
+  return failed_queue
+
+def batch_delete_targets(targets : list):
+  """Splits the targets into batches whose quoted paths and tombstones fit in one command line."""
+  batch = []
+  length = 0
+  for target in targets:
+    target_length = len(shlex.quote(target[2])) + len(shlex.quote(target[3])) + 2
+    if batch and length + target_length > MAX_DELETE_COMMAND_LENGTH:
+      yield batch
+      batch = []
+      length = 0
+    batch.append(target)
+    length += target_length
+  if batch:
+    yield batch
+
+def remove_remote_paths(ssh : paramiko.SSHClient, remote_paths : list, tombstones : list = ()):
+  """
+  Removes files and whole directory trees with one remote command. Paths that are already gone are fine.
+  The tombstones are touched before anything is removed.
+  """
+  command = "rm -rf -- " + " ".join(shlex.quote(remote_path) for remote_path in remote_paths)
+  if tombstones:
+    tombstone_dirs = sorted({os.path.dirname(tombstone) for tombstone in tombstones})
+    command = (f"mkdir -p -- {' '.join(shlex.quote(d) for d in tombstone_dirs)} && "
+               f"touch -- {' '.join(shlex.quote(tombstone) for tombstone in tombstones)} && {command}")
+  _, stdout, stderr = ssh.exec_command(command)
+  exit_status = stdout.channel.recv_exit_status()
+  if exit_status != 0:
+    raise IOError(stderr.read().decode(errors='replace').strip())
 
 def group_files_by_ssh(file_queue : dict, extra_keys : list = []) -> dict:
   """
@@ -146,69 +960,216 @@ def group_files_by_ssh(file_queue : dict, extra_keys : list = []) -> dict:
 
 def ssh_sender_worker():
   global file_event_queue
-  """Worker thread to send files over SSH."""
+  """Worker thread to send files over SSH. Events are coalesced into batches before sending."""
+  # Settings are loaded by now, so apply the configured concurrency cap
+  host_workers.set_max_concurrency(settings_util.get_setting('max_concurrent_hosts', DEFAULT_MAX_CONCURRENT_HOSTS))
+  ssh_pool.connect_timeout = settings_util.get_setting('connect_timeout', DEFAULT_CONNECT_TIMEOUT)
+  ssh_pool.max_connections = settings_util.get_setting('max_connections', DEFAULT_MAX_CONNECTIONS)
+  ssh_pool.max_per_host = settings_util.get_setting('max_connections_per_host', DEFAULT_MAX_CONNECTIONS_PER_HOST)
+  ssh_pool.health_check_interval = settings_util.get_setting('health_check_interval', DEFAULT_HEALTH_CHECK_INTERVAL)
+  ssh_pool.start()
+  retry_scheduler.configure(
+    settings_util.get_setting('retry_base_delay', DEFAULT_RETRY_BASE_DELAY),
+    settings_util.get_setting('retry_max_delay', DEFAULT_RETRY_MAX_DELAY)
+  )
+  host_breakers.configure(
+    settings_util.get_setting('breaker_failure_threshold', DEFAULT_BREAKER_FAILURE_THRESHOLD),
+    settings_util.get_setting('breaker_probe_interval', DEFAULT_BREAKER_PROBE_INTERVAL),
+    settings_util.get_setting('breaker_max_probe_interval', DEFAULT_BREAKER_MAX_PROBE_INTERVAL)
+  )
+  retry_scheduler.start()
+  if settings_util.get_setting('bulk_lane', True):
+    threading.Thread(target=bulk_sender_worker, daemon=True).start()
+
   while True:
+    release_deferred_events()
     try:
       path, linked_paths, tracked_path, action, old_path = file_event_queue.get(timeout=1)
-      print(f"Dequeued for sending: {path} -> {', '.join(linked_paths.keys())} (tracked: {tracked_path}), action: {action}")
-      add_file_to_queue(path, linked_paths, tracked_path, action, old_path)
-      send_files_over_ssh()
     except queue.Empty:
       continue  # No file to send, keep waiting
-  
 
-def send_file(sftp : paramiko.SFTPClient, local_file : Path, remote_file : str):
+    print(f"Dequeued for sending: {path} -> {', '.join(linked_paths.keys())} (tracked: {tracked_path}), action: {action}")
+    add_file_to_queue(path, linked_paths, tracked_path, action, old_path)
+    event_count = 1 + drain_file_events()
+    # One journal write for the whole batch, before anything is sent
+    journal.flush()
+
+    print(f"\nCollected {event_count} events into {len(file_send_queue) + len(file_rename_queue) + len(file_delete_queue)} queued paths.")
+    # Renames first: they queue sends for the moved paths, which then go out in the same batch.
+    # Deletes before sends, so a path deleted and created again ends up with the new content.
+    if file_rename_queue:
+      rename_files_over_ssh()
+    if file_delete_queue:
+      delete_files_over_ssh()
+    print_files_in_queue()
+    send_files_over_ssh()
+
+def warm_up_connections(tracked_paths : dict):
+  """Opens a connection to every host linked to a tracked folder in the background."""
+  targets = set()
+  for info in tracked_paths.values():
+    for remote_info in info.get("linked_paths", {}).values():
+      targets.add((remote_info["user"], remote_info["host_url"]))
+  if targets:
+    print(f"Warming up connections to {len(targets)} hosts...")
+    ssh_pool.warm_up(targets, SSH_KEY_PATH.as_posix())
+
+def replay_journal():
+  """Queues the actions left pending in the journal by the last run. Call before starting the sender."""
+  journal.load()
+  pending = journal.pending_actions()
+  for path, remote_dirs, tracked_path, action, old_path in pending:
+    file_event_queue.put((path, remote_dirs, tracked_path, FileAction(action), old_path))
+  if pending:
+    print(f"Replaying {len(pending)} pending actions from the outbound journal.")
+  journal.start_compactor()
+
+def drain_file_events() -> int:
+  """
+  Drains the event queue into the send queues until it has been quiet for the debounce window.
+
+  Repeated events for the same path collapse into one queue entry. Collection stops early
+  once the max wait has passed so a continuous event storm still gets sent.
+  Returns the number of events drained.
+  """
+  debounce = settings_util.get_setting('batch_debounce_seconds', DEFAULT_BATCH_DEBOUNCE)
+  max_wait = settings_util.get_setting('batch_max_wait_seconds', DEFAULT_BATCH_MAX_WAIT)
+  deadline = time.monotonic() + max_wait
+  event_count = 0
+
+  while True:
+    # Take everything that is already waiting without blocking
+    try:
+      while True:
+        add_file_to_queue(*file_event_queue.get_nowait())
+        event_count += 1
+    except queue.Empty:
+      pass
+
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+      break
+
+    try:
+      event = file_event_queue.get(timeout=min(debounce, remaining))
+    except queue.Empty:
+      break  # Quiet for a full debounce window, the batch is complete
+    add_file_to_queue(*event)
+    event_count += 1
+
+  return event_count
+
+
+def send_file(sftp : paramiko.SFTPClient, local_file : Path, remote_file : str, read_buffer_size : int = transfer_tuning.DEFAULT_READ_BUFFER_SIZE):
+  """
+  Uploads a file with pipelined writes: requests are sent without waiting for each reply,
+  so the link stays busy for the whole window instead of one round trip per write.
+  """
   print(f"Sending {local_file} to {remote_file}...")
-  sftp.put(str(local_file), remote_file)
+  start = time.monotonic()
+  with open(local_file, 'rb', buffering=0) as src, sftp.open(remote_file, 'wb') as dst:
+    dst.set_pipelined(True)
+    while chunk := src.read(read_buffer_size):
+      dst.write(chunk)
+    size = src.tell()
+
+  # Closing waited for every pipelined reply, so the remote size is final
+  remote_size = sftp.stat(remote_file).st_size
+  if remote_size != size:
+    raise IOError(f"Size mismatch after upload of {local_file}: {remote_size} != {size}")
+  transfer_tuning.report_transfer(local_file, remote_file, size, time.monotonic() - start)
+  transfer_stats.count("bytes_sent", size)
 
 def rename_file(sftp : paramiko.SFTPClient, remote_old : str, remote_new : str):
   print(f"Renaming file {remote_old} to match {remote_new}")
-  sftp.rename(remote_old, remote_new)
-
-def ensure_remote_dir(sftp : paramiko.SFTPClient, remote_path):
-  """Creates the remote directory if it does not exist."""
   try:
-    sftp.stat(remote_path)
-  except FileNotFoundError:
-    parent = os.path.dirname(remote_path)
+    # posix_rename replaces an existing destination the way a local move does
+    sftp.posix_rename(remote_old, remote_new)
+  except IOError:
+    # Server without the posix-rename extension
+    sftp.rename(remote_old, remote_new)
+
+def ensure_remote_dir(sftp : paramiko.SFTPClient, remote_path, known_dirs : set = None, created_dirs : set = None):
+  """
+  Creates the remote directory if it does not exist.
+
+  Directories in known_dirs are assumed to exist and cost no round trip; every directory
+  found or created is added to it. A directory whose parent is in created_dirs cannot exist yet,
+  so it is created without a stat first.
+  """
+  if known_dirs is not None and remote_path in known_dirs:
+    return
+
+  parent = os.path.dirname(remote_path)
+  exists = False
+  if created_dirs is None or parent not in created_dirs:
+    try:
+      sftp.stat(remote_path)
+      exists = True
+    except FileNotFoundError:
+      pass
+
+  if not exists:
     if parent and parent != remote_path:
-      ensure_remote_dir(sftp, parent)
+      ensure_remote_dir(sftp, parent, known_dirs, created_dirs)
     try:
       sftp.mkdir(remote_path)
       print(f"Created remote directory: {remote_path}")
+      if created_dirs is not None:
+        created_dirs.add(remote_path)
     except IOError:
-      pass  # Already exists (race condition or parallel ops)
+      sftp.stat(remote_path)  # Already exists (race condition or parallel ops), anything else raises
+
+  if known_dirs is not None:
+    known_dirs.add(remote_path)
+
+def create_remote_dirs(sftp : paramiko.SFTPClient, remote_files : list, known_dirs : set):
+  """Creates the distinct parent directories of a batch of remote files, shallowest first."""
+  remote_dirs = {os.path.dirname(remote_file) for remote_file in remote_files}
+  created_dirs = set()
+  for remote_dir in sorted(remote_dirs, key=lambda d: (d.count("/"), d)):
+    try:
+      ensure_remote_dir(sftp, remote_dir, known_dirs, created_dirs)
+    except IOError as e:
+      # The files inside will fail on their own and be retried
+      print(f"Could not create remote directory {remote_dir}: {e}")
 
 def add_file_to_queue(file : str, remote_dirs : dict, tracked_path: str, action: FileAction = FileAction.SEND_FILE, old_path = None):
   global file_send_queue, file_delete_queue, file_rename_queue
   """Adds a file or directory to the correct queue for sending."""
   path = Path(file).resolve()
-  if not path.exists():
+  # A deleted path is expected to be gone
+  if action != FileAction.DELETE_FILE and not path.exists():
     print(f"File or directory {file} does not exist. Skipping...")
+    journal.record_delivered(action.value, path.as_posix())
+    retry_scheduler.forget(action, path.as_posix(), remote_dirs.keys())
     return
   
   match action:
     case FileAction.SEND_FILE:
+      # A retry for some destinations must not drop the others of an event in the same batch
+      queued = file_send_queue.get(path.as_posix())
       file_send_queue[path.as_posix()] = {
-          "remote_dirs": remote_dirs,
+          "remote_dirs": {**queued["remote_dirs"], **remote_dirs} if queued else remote_dirs,
           "tracked_path": tracked_path
         }
     case FileAction.RENAME_FILE:
       if old_path is None:
         print("No old filepath is specified!")
         return
+      queued = file_rename_queue.get(path.as_posix())
       file_rename_queue[path.as_posix()] = {
-          "remote_dirs": remote_dirs,
+          "remote_dirs": {**queued["remote_dirs"], **remote_dirs} if queued else remote_dirs,
           "tracked_path": tracked_path,
           "old_path": old_path
         }
     case FileAction.DELETE_FILE:
+      queued = file_delete_queue.get(path.as_posix())
       file_delete_queue[path.as_posix()] = {
-          "remote_dirs": remote_dirs,
+          "remote_dirs": {**queued["remote_dirs"], **remote_dirs} if queued else remote_dirs,
           "tracked_path": tracked_path
         }
-
-  print_files_in_queue()
+  journal.record_queued(action.value, path.as_posix(), remote_dirs, tracked_path, old_path)
 
 def parse_remote_path(remote_path: str) -> tuple:
   """Parses a remote path into host, username, and directory."""
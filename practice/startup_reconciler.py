@@ -0,0 +1,123 @@
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+import hash_engine
+import remote_manifest
+import settings_util
+from FileActions import FileAction, PARTIAL_SUFFIX
+from file_indexer_hasher import get_live_index, get_index_key, build_file_index
+from ssh_utils import file_event_queue, ssh_pool, SSH_KEY_PATH
+from tracker_utils import scan_folder, build_folder_tree
+
+def seed_index(tracked_path : str, folder_info : dict, index):
+  """
+  Builds the index of a folder that never had one, e.g. tracked before indexes were kept.
+
+  The folder is hashed and each linked path's manifest fetched, and the files already identical
+  on every one of them are recorded as delivered, so the catch-up only sends the rest instead of
+  the whole tree. When a remote cannot be listed nothing is recorded and everything is sent.
+  """
+  local_entries = build_file_index(tracked_path)
+  sizes = {entry["size"] for entry in local_entries.values()}
+  algorithm = hash_engine.get_algorithm()
+  delivered = set(local_entries)
+  for remote_info in folder_info['linked_paths'].values():
+    user, host = remote_info["user"], remote_info["host_url"]
+    remote_root = remote_manifest.get_remote_root(remote_info)
+    checkout = lambda: ssh_pool.checkout(user, host, SSH_KEY_PATH.as_posix())
+    checkin = lambda ssh: ssh_pool.checkin(user, host, ssh)
+    try:
+      manifest = remote_manifest.get_remote_manifests(checkout, checkin, user, host, [remote_root], algorithm, sizes)[remote_root]
+    except Exception as e:
+      print(f"Could not list {remote_root} on {host}, the files of {tracked_path} are all sent: {e}")
+      delivered.clear()
+      break
+    delivered &= set(remote_manifest.plan_sync(local_entries, manifest).matched)
+
+  index.replace_all({relative: local_entries[relative] for relative in delivered})
+  print(f"Indexed {tracked_path}: {len(delivered)} of {len(local_entries)} files are already on every remote.")
+
+def reconcile_tracked_path(tracked_path : str, folder_info : dict) -> dict:
+  """
+  Queues what changed in a tracked folder while nothing was watching it.
+
+  The folder is scanned for metadata only and its tree is compared to the index's, descending
+  only into directories whose hashes differ. Of the files that differ, new ones and ones with a
+  different size are sent without reading them. Ones that only changed modification time are
+  hashed, and sent only if their content changed. Indexed files that are gone are deleted remotely.
+  A folder without any index is seeded from its remotes' manifests first.
+  Returns counts of what was scanned, hashed and queued.
+  """
+  folder = Path(tracked_path)
+  index = get_live_index(get_index_key(tracked_path))
+  if not index.snapshot_file.exists() and not index.log_file.exists():
+    seed_index(tracked_path, folder_info, index)
+  scan = {relative: entry for relative, entry in scan_folder(folder).items() if not relative.endswith(PARTIAL_SUFFIX)}
+  changed = index.diff(build_folder_tree(folder, scan))
+
+  send = []
+  removed = []
+  suspects = defaultdict(list) # [algorithm] -> relative paths with an unchanged size but a new modification time
+  for relative in changed:
+    scanned = scan.get(relative)
+    indexed = index.get(relative)
+    if scanned is None:
+      if indexed is not None:
+        removed.append(relative)
+    elif indexed is None or indexed.get("size") != scanned["size"] or not indexed.get("hash"):
+      send.append(relative)
+    elif indexed.get("modified_time") != scanned["modified_time"]:
+      suspects[indexed.get("algorithm", hash_engine.DEFAULT_HASH_ALGORITHM)].append(relative)
+
+  touched = {}
+  hashed = 0
+  for algorithm, relatives in suspects.items():
+    hashes = hash_engine.hash_files([folder / relative for relative in relatives], algorithm)
+    hashed += len(relatives)
+    for relative in relatives:
+      indexed = index.get(relative)
+      if indexed is not None and hashes.get(str(folder / relative)) == indexed.get("hash"):
+        # Touched but not changed, so only the index needs the new time
+        touched[relative] = {**indexed, "modified_time": scan[relative]["modified_time"]}
+      else:
+        send.append(relative)
+
+  if touched or removed:
+    index.update(touched, removed)
+
+  linked_paths = folder_info['linked_paths']
+  for relative in send:
+    file_event_queue.put((folder / relative, linked_paths, tracked_path, FileAction.SEND_FILE, None))
+  for relative in removed:
+    file_event_queue.put((folder / relative, linked_paths, tracked_path, FileAction.DELETE_FILE, None))
+
+  return {"scanned": len(scan), "changed": len(changed), "hashed": hashed, "touched": len(touched), "sent": len(send), "deleted": len(removed)}
+
+def reconcile_tracked_paths(tracked_paths : dict):
+  """Catches up on every tracked folder in turn and reports what was found."""
+  for tracked_path, folder_info in list(tracked_paths.items()):
+    if not folder_info.get('linked_paths') or not Path(tracked_path).is_dir():
+      continue
+    start = time.monotonic()
+    try:
+      counts = reconcile_tracked_path(tracked_path, folder_info)
+    except Exception as e:
+      print(f"Error catching up on {tracked_path}: {e}")
+      continue
+    print(f"Caught up on {tracked_path} in {time.monotonic() - start:.2f}s: {counts['scanned']} files scanned, "
+          f"{counts['changed']} differ from the index, {counts['hashed']} hashed, {counts['touched']} only touched, "
+          f"{counts['sent']} queued to send, {counts['deleted']} queued to delete.")
+
+def start_reconciliation(tracked_paths : dict):
+  """
+  Catches up on changes made while the program was not running, on a background thread.
+
+  Call it once the folders are being watched, so a change is either seen by the scan or
+  by the watcher. Disabled with 'startup_reconcile: false' in config.yaml.
+  """
+  if not settings_util.get_setting('startup_reconcile', True):
+    return None
+  thread = threading.Thread(target=reconcile_tracked_paths, args=(tracked_paths,), daemon=True)
+  thread.start()
+  return thread
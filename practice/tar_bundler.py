@@ -0,0 +1,93 @@
+import shlex
+import tarfile
+import time
+import paramiko
+import settings_util
+import transfer_stats
+from FileActions import PARTIAL_SUFFIX
+
+# Files below this size are candidates for a bundle
+DEFAULT_BUNDLE_MAX_FILE_SIZE = 256 * 1024
+# Bundle only when a host's batch has at least this many small files
+DEFAULT_BUNDLE_MIN_FILES = 32
+# "none" or "gz"
+DEFAULT_BUNDLE_COMPRESSION = "none"
+
+# Unpacks a tar stream from stdin into the inbox given as the only argument.
+# Every member is written to a partial file and renamed into place, so the remote
+# inbox watcher only ever sees complete files. Prints the number of files unpacked.
+REMOTE_UNPACK_SCRIPT = r'''
+import os, shutil, sys, tarfile
+root = os.path.normpath(sys.argv[1])
+count = 0
+with tarfile.open(fileobj=sys.stdin.buffer, mode="r|*") as archive:
+  for member in archive:
+    if not member.isfile():
+      continue
+    target = os.path.normpath(os.path.join(root, member.name))
+    if not target.startswith(root + os.sep):
+      sys.exit("unsafe path in bundle: " + member.name)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    partial = target + "''' + PARTIAL_SUFFIX + r'''"
+    with archive.extractfile(member) as src, open(partial, "wb") as dst:
+      shutil.copyfileobj(src, dst, 1 << 20)
+    os.replace(partial, target)
+    count += 1
+print(count)
+'''
+
+def split_bundle_items(host : str, items : list) -> tuple:
+  """Splits a host's items into (items to bundle, items to send one by one)."""
+  max_file_size = settings_util.get_host_setting(host, 'bundle_max_file_size', DEFAULT_BUNDLE_MAX_FILE_SIZE)
+  min_files = settings_util.get_host_setting(host, 'bundle_min_files', DEFAULT_BUNDLE_MIN_FILES)
+
+  small_items = [item for item in items if item.size < max_file_size]
+  if len(small_items) < min_files:
+    return [], items
+  return small_items, [item for item in items if item.size >= max_file_size]
+
+def send_bundles(ssh : paramiko.SSHClient, host : str, items : list) -> list:
+  """
+  Streams the items as one tar archive per remote inbox.
+  Returns the items of bundles that failed, to be sent one by one instead.
+  """
+  by_inbox = {}
+  for item in items:
+    by_inbox.setdefault(item.inbox_path, []).append(item)
+
+  fallback_items = []
+  for inbox_path, inbox_items in by_inbox.items():
+    try:
+      send_bundle(ssh, host, inbox_path, inbox_items)
+    except Exception as e:
+      print(f"Bundle of {len(inbox_items)} files to {host}:{inbox_path} failed, sending them one by one: {e}")
+      fallback_items.extend(inbox_items)
+  return fallback_items
+
+def send_bundle(ssh : paramiko.SSHClient, host : str, inbox_path : str, items : list):
+  """Streams the items as a tar archive over an exec channel and unpacks it in the remote inbox."""
+  compression = settings_util.get_host_setting(host, 'bundle_compression', DEFAULT_BUNDLE_COMPRESSION)
+  mode = "w|gz" if compression == "gz" else "w|"
+  start = time.monotonic()
+
+  command = " ".join(shlex.quote(arg) for arg in ["python3", "-c", REMOTE_UNPACK_SCRIPT, inbox_path])
+  stdin, stdout, stderr = ssh.exec_command(command)
+  total_bytes = 0
+  try:
+    with tarfile.open(fileobj=stdin, mode=mode, bufsize=1024 * 1024) as archive:
+      for item in items:
+        # Member names are relative to the inbox, like the remote paths of single file sends
+        archive.add(str(item.local_file), arcname=item.remote_file_path[len(inbox_path):].lstrip("/"), recursive=False)
+        total_bytes += item.size
+  finally:
+    stdin.channel.shutdown_write()
+
+  exit_status = stdout.channel.recv_exit_status()
+  if exit_status != 0:
+    raise IOError(stderr.read().decode(errors='replace').strip())
+
+  elapsed = max(time.monotonic() - start, 1e-6)
+  transfer_stats.count("bundle_files_sent", len(items))
+  transfer_stats.count("bundles_sent")
+  print(f"Bundled {len(items)} files ({total_bytes / 1e6:.1f} MB) to {host}:{inbox_path} in {elapsed:.2f}s: "
+        f"{len(items) / elapsed:.0f} files/s")
@@ -0,0 +1,92 @@
+import io
+import random
+import subprocess
+import sys
+import pytest
+import delta_sync
+import settings_util
+from file_indexer_hasher import build_file_entry
+
+BLOCK_SIZE = 1024
+
+@pytest.fixture(autouse=True)
+def default_settings(monkeypatch):
+  monkeypatch.setattr(settings_util, "settings", {})
+
+def random_bytes(size, seed):
+  return random.Random(seed).randbytes(size)
+
+def encode(tmp_path, old, new, max_literal=None):
+  """Computes the delta ops of new against old's signatures and returns (ops, patch stream)."""
+  old_file = tmp_path / "old"
+  old_file.write_bytes(old)
+  old_entry = build_file_entry(old_file, BLOCK_SIZE)
+  ops = delta_sync.compute_delta_ops(new, old_entry, len(new) if max_literal is None else max_literal)
+  stream = io.BytesIO()
+  delta_sync.write_patch(stream, new, ops)
+  return ops, stream.getvalue()
+
+def apply_patch(tmp_path, patch, new):
+  """Runs the remote patch script against the old file and returns the rebuilt file."""
+  target = tmp_path / "rebuilt"
+  new_file = tmp_path / "new"
+  new_file.write_bytes(new)
+  entry = build_file_entry(new_file)
+  result = subprocess.run(
+    [sys.executable, "-c", delta_sync.REMOTE_PATCH_SCRIPT, str(tmp_path / "old"), str(target), entry["hash"], entry["algorithm"]],
+    input=patch, capture_output=True
+  )
+  assert result.returncode == 0, result.stderr.decode()
+  return target.read_bytes()
+
+def literal_bytes(ops):
+  return sum(op[2] - op[1] for op in ops if op[0] == 'L')
+
+def test_identical_file_is_all_copies(tmp_path):
+  old = random_bytes(10 * BLOCK_SIZE + 100, 1)
+  ops, patch = encode(tmp_path, old, old)
+  assert ops == [('C', 0, len(old))]
+  assert apply_patch(tmp_path, patch, old) == old
+
+def test_in_place_edit_sends_only_the_changed_block(tmp_path):
+  old = random_bytes(10 * BLOCK_SIZE, 2)
+  new = old[:3 * BLOCK_SIZE + 10] + b"edited" + old[3 * BLOCK_SIZE + 16:]
+  ops, patch = encode(tmp_path, old, new)
+  assert literal_bytes(ops) == BLOCK_SIZE
+  assert apply_patch(tmp_path, patch, new) == new
+
+def test_insertion_is_found_by_the_rolling_search(tmp_path):
+  old = random_bytes(10 * BLOCK_SIZE, 3)
+  new = old[:2 * BLOCK_SIZE + 7] + b"inserted bytes" + old[2 * BLOCK_SIZE + 7:]
+  ops, patch = encode(tmp_path, old, new)
+  # Only the block around the insertion is sent, the shifted blocks after it are copied
+  assert literal_bytes(ops) < 2 * BLOCK_SIZE
+  assert apply_patch(tmp_path, patch, new) == new
+
+def test_exhausted_roll_budget_still_round_trips(tmp_path, monkeypatch):
+  monkeypatch.setattr(settings_util, "settings", {"delta_roll_search_budget": 10})
+  old = random_bytes(10 * BLOCK_SIZE, 4)
+  # The shift is further than the budget lets the window slide, so nothing lines up again
+  new = b"x" * 100 + old
+  ops, patch = encode(tmp_path, old, new)
+  assert literal_bytes(ops) == len(new)
+  assert apply_patch(tmp_path, patch, new) == new
+
+def test_unrelated_content_is_not_worth_a_delta(tmp_path):
+  old = random_bytes(10 * BLOCK_SIZE, 5)
+  new = random_bytes(10 * BLOCK_SIZE, 6)
+  with pytest.raises(delta_sync.DeltaNotWorthwhile):
+    encode(tmp_path, old, new, max_literal=len(new) // 2)
+
+def test_in_place_edits_after_the_roll_budget_stay_aligned(tmp_path, monkeypatch):
+  # Enough for the first edited block's slide and part of the second's
+  monkeypatch.setattr(settings_util, "settings", {"delta_roll_search_budget": BLOCK_SIZE + BLOCK_SIZE // 2})
+  old = random_bytes(100 * BLOCK_SIZE, 7)
+  new = bytearray(old)
+  edited = range(5, 100, 5)
+  for block in edited:
+    new[block * BLOCK_SIZE + 10:block * BLOCK_SIZE + 16] = b"edited"
+  new = bytes(new)
+  ops, patch = encode(tmp_path, old, new)
+  assert literal_bytes(ops) == len(edited) * BLOCK_SIZE
+  assert apply_patch(tmp_path, patch, new) == new
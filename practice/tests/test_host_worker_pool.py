@@ -0,0 +1,30 @@
+import threading
+from HostWorkerPool import HostWorkerPool
+
+def test_jobs_of_one_key_run_in_order():
+  pool = HostWorkerPool(max_concurrency=2)
+  order = []
+  futures = [pool.submit(("user", "host"), order.append, i) for i in range(5)]
+  for future in futures:
+    future.result(timeout=5)
+  assert order == list(range(5))
+
+def test_a_full_group_does_not_block_another_group():
+  pool = HostWorkerPool(max_concurrency=2)
+  release = threading.Event()
+  started = threading.Semaphore(0)
+  def hold_slot():
+    started.release()
+    release.wait(5)
+  busy = [pool.submit(("user", f"host{i}", "bulk"), hold_slot, group="bulk") for i in range(2)]
+  for _ in busy:
+    assert started.acquire(timeout=5)
+  # The bulk group's slots are all taken, yet an interactive job runs right away
+  assert pool.submit(("user", "host0", "interactive"), lambda: "done", group="interactive").result(timeout=2) == "done"
+  # A third bulk job has to wait for a slot
+  waiting = pool.submit(("user", "host2", "bulk"), lambda: "done", group="bulk")
+  assert not waiting.done()
+  release.set()
+  assert waiting.result(timeout=5) == "done"
+  for future in busy:
+    future.result(timeout=5)
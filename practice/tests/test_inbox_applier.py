@@ -0,0 +1,54 @@
+import time
+from InboxApplier import InboxApplier
+
+STABLE_WAIT = 0.05
+
+def make_applier(tmp_path):
+  return InboxApplier(tmp_path / "inbox", stable_wait=STABLE_WAIT, workers=2)
+
+def received(tmp_path, relative, data=b"data"):
+  """Writes a file into the inbox where a peer would upload the destination tmp_path/dest/relative."""
+  dest = tmp_path / "dest" / relative
+  src = tmp_path / "inbox" / dest.relative_to("/")
+  src.parent.mkdir(parents=True, exist_ok=True)
+  src.write_bytes(data)
+  return src, dest
+
+def wait_and_take(applier):
+  time.sleep(STABLE_WAIT * 2)
+  return applier.take_stable()
+
+def test_file_is_stable_after_two_matching_checks(tmp_path):
+  applier = make_applier(tmp_path)
+  src, _ = received(tmp_path, "a.txt")
+  applier.add(src, time.time())
+  assert wait_and_take(applier) == []
+  assert wait_and_take(applier) == [src]
+  assert not applier.queued
+
+def test_file_still_being_written_is_requeued(tmp_path):
+  applier = make_applier(tmp_path)
+  src, _ = received(tmp_path, "a.txt")
+  applier.add(src, time.time())
+  assert wait_and_take(applier) == []
+  src.write_bytes(b"more data")
+  assert wait_and_take(applier) == []
+  assert wait_and_take(applier) == [src]
+
+def test_directories_are_never_applied(tmp_path):
+  applier = make_applier(tmp_path)
+  src, _ = received(tmp_path, "dir/big.bin.upload.fspart")
+  applier.add(src.parent, time.time())
+  assert wait_and_take(applier) == []
+  assert wait_and_take(applier) == []
+  assert not applier.queued
+  assert src.exists()
+
+def test_apply_moves_files_to_their_destinations(tmp_path):
+  applier = make_applier(tmp_path)
+  files = [received(tmp_path, f"sub/{i}.txt", str(i).encode()) for i in range(4)]
+  applied = applier.apply([src for src, _ in files])
+  assert sorted(applied) == sorted(dest for _, dest in files)
+  for i, (src, dest) in enumerate(files):
+    assert not src.exists()
+    assert dest.read_bytes() == str(i).encode()
@@ -0,0 +1,43 @@
+from LiveIndex import LiveIndex
+from MerkleTree import MerkleTree
+
+def entry(size, file_hash="h"):
+  return {"size": size, "modified_time": "2024-01-01T00:00:00", "hash": file_hash}
+
+def open_index(tmp_path):
+  return LiveIndex(tmp_path / "index.json", tmp_path / "index.log", tmp_path / "index.tree.json")
+
+def test_changes_are_replayed_from_the_log(tmp_path):
+  index = open_index(tmp_path)
+  index.replace_all({"a.txt": entry(1), "docs/b.txt": entry(2)})
+  index.update({"c.txt": entry(3)}, ["a.txt"])
+  assert (tmp_path / "index.log").exists()
+
+  reloaded = open_index(tmp_path)
+  assert dict(reloaded.items()) == {"docs/b.txt": entry(2), "c.txt": entry(3)}
+  assert reloaded.root_hash() == index.root_hash()
+
+def test_a_torn_last_log_line_is_ignored(tmp_path):
+  index = open_index(tmp_path)
+  index.update({"a.txt": entry(1)})
+  with open(tmp_path / "index.log", "a") as f:
+    f.write('{"op": "set", "pa')
+  assert dict(open_index(tmp_path).items()) == {"a.txt": entry(1)}
+
+def test_move_carries_a_directory_and_its_tree(tmp_path):
+  index = open_index(tmp_path)
+  index.replace_all({"old/a.txt": entry(1), "old/sub/b.txt": entry(2), "other.txt": entry(3)})
+  index.move("old", "new")
+  expected = {"new/a.txt": entry(1), "new/sub/b.txt": entry(2), "other.txt": entry(3)}
+  assert dict(index.items()) == expected
+  assert index.diff(MerkleTree.from_entries(expected)) == []
+  assert dict(open_index(tmp_path).items()) == expected
+
+def test_remove_tree_and_find_by_hash(tmp_path):
+  index = open_index(tmp_path)
+  index.replace_all({"dir/a.txt": entry(1, "x"), "dir/b.txt": entry(1, "y"), "c.txt": entry(1, "x")})
+  assert sorted(index.find_by_hash("x")) == ["c.txt", "dir/a.txt"]
+  index.remove_tree("dir")
+  assert dict(index.items()) == {"c.txt": entry(1, "x")}
+  assert index.find_by_hash("x") == ["c.txt"]
+  assert index.find_by_hash("y") == []
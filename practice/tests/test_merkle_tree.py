@@ -0,0 +1,53 @@
+from MerkleTree import MerkleTree, CONTENT_LEAF_KEYS
+
+def entry(size, modified_time="2024-01-01T00:00:00", file_hash="h"):
+  return {"size": size, "modified_time": modified_time, "hash": file_hash}
+
+ENTRIES = {
+  "a.txt": entry(1),
+  "docs/b.txt": entry(2),
+  "docs/deep/c.txt": entry(3),
+  "src/d.py": entry(4),
+}
+
+def test_identical_trees_have_no_diff():
+  assert MerkleTree.from_entries(ENTRIES).diff(MerkleTree.from_entries(dict(ENTRIES))) == []
+
+def test_diff_finds_changed_added_and_removed_files():
+  other = dict(ENTRIES)
+  other["docs/deep/c.txt"] = entry(30)
+  other["docs/new.txt"] = entry(5)
+  del other["src/d.py"]
+  changed = MerkleTree.from_entries(ENTRIES).diff(MerkleTree.from_entries(other))
+  assert sorted(changed) == ["docs/deep/c.txt", "docs/new.txt", "src/d.py"]
+
+def test_diff_lists_every_file_of_a_directory_replaced_by_a_file():
+  other = {relative: e for relative, e in ENTRIES.items() if not relative.startswith("docs/")}
+  other["docs"] = entry(6)
+  changed = MerkleTree.from_entries(ENTRIES).diff(MerkleTree.from_entries(other))
+  assert sorted(changed) == ["docs", "docs/b.txt", "docs/deep/c.txt"]
+
+def test_incremental_updates_match_a_rebuilt_tree():
+  tree = MerkleTree.from_entries(ENTRIES)
+  tree.update_file("docs/deep/c.txt", entry(30))
+  tree.update_file("new/dir/e.txt", entry(7))
+  tree.remove("src")
+
+  expected = dict(ENTRIES)
+  expected["docs/deep/c.txt"] = entry(30)
+  expected["new/dir/e.txt"] = entry(7)
+  del expected["src/d.py"]
+  rebuilt = MerkleTree.from_entries(expected)
+  assert tree.root_hash() == rebuilt.root_hash()
+  assert tree.diff(rebuilt) == []
+
+def test_leaf_keys_choose_what_counts_as_a_change():
+  touched = {relative: {**e, "modified_time": "2025-01-01T00:00:00"} for relative, e in ENTRIES.items()}
+  assert MerkleTree.from_entries(ENTRIES).diff(MerkleTree.from_entries(touched)) != []
+  assert MerkleTree.from_entries(ENTRIES, CONTENT_LEAF_KEYS).diff(MerkleTree.from_entries(touched, CONTENT_LEAF_KEYS)) == []
+
+def test_round_trips_through_a_dict():
+  tree = MerkleTree.from_entries(ENTRIES)
+  restored = MerkleTree.from_dict(tree.to_dict())
+  assert restored.root_hash() == tree.root_hash()
+  assert sorted(restored.list_files()) == sorted(ENTRIES)
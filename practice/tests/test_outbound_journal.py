@@ -0,0 +1,49 @@
+from OutboundJournal import OutboundJournal
+
+REMOTES = {"a@host1:/data": {"host_url": "host1"}, "b@host2:/data": {"host_url": "host2"}}
+
+def reopen(log_file):
+  journal = OutboundJournal(log_file)
+  journal.load()
+  return journal
+
+def test_pending_actions_survive_a_restart(tmp_path):
+  journal = OutboundJournal(tmp_path / "journal.log")
+  journal.record_queued("send_file", "/src/a.txt", REMOTES, "/src")
+  journal.record_queued("rename_file", "/src/new", REMOTES, "/src", "/src/old")
+  journal.flush()
+  assert sorted(reopen(tmp_path / "journal.log").pending_actions()) == sorted([
+    ("/src/a.txt", REMOTES, "/src", "send_file", None),
+    ("/src/new", REMOTES, "/src", "rename_file", "/src/old"),
+  ])
+
+def test_acks_remove_only_the_delivered_destinations(tmp_path):
+  journal = OutboundJournal(tmp_path / "journal.log")
+  journal.record_queued("send_file", "/src/a.txt", REMOTES, "/src")
+  journal.record_queued("delete_file", "/src/b.txt", REMOTES, "/src")
+  journal.record_delivered("send_file", "/src/a.txt", ["a@host1:/data"])
+  journal.record_delivered("delete_file", "/src/b.txt")
+  journal.flush()
+  pending = reopen(tmp_path / "journal.log").pending_actions()
+  assert pending == [("/src/a.txt", {"b@host2:/data": REMOTES["b@host2:/data"]}, "/src", "send_file", None)]
+
+def test_unflushed_records_are_lost_and_a_torn_last_line_is_ignored(tmp_path):
+  log_file = tmp_path / "journal.log"
+  journal = OutboundJournal(log_file)
+  journal.record_queued("send_file", "/src/a.txt", REMOTES, "/src")
+  journal.flush()
+  journal.record_queued("send_file", "/src/b.txt", REMOTES, "/src")
+  with open(log_file, "a") as f:
+    f.write('{"op": "queue", "action": "send_')
+  assert [action[0] for action in reopen(log_file).pending_actions()] == ["/src/a.txt"]
+
+def test_compact_keeps_only_pending_actions(tmp_path):
+  log_file = tmp_path / "journal.log"
+  journal = OutboundJournal(log_file)
+  for i in range(10):
+    journal.record_queued("send_file", f"/src/{i}", REMOTES, "/src")
+    if i:
+      journal.record_delivered("send_file", f"/src/{i}")
+  journal.compact()
+  assert len(log_file.read_text().splitlines()) == 1
+  assert reopen(log_file).pending_actions() == [("/src/0", REMOTES, "/src", "send_file", None)]
@@ -0,0 +1,28 @@
+from PathTrie import PathTrie
+
+def make_trie():
+  trie = PathTrie({"/home/user/projects": "projects", "/home/user/projects/big": "big"})
+  trie.insert("/srv/inbox", "inbox")
+  return trie
+
+def test_finds_the_deepest_containing_path():
+  trie = make_trie()
+  assert trie.find("/home/user/projects/app/main.py") == "projects"
+  assert trie.find("/home/user/projects/big/data.bin") == "big"
+  assert trie.find("/srv/inbox/home/user/file") == "inbox"
+
+def test_a_stored_path_contains_itself():
+  assert make_trie().find("/home/user/projects") == "projects"
+
+def test_paths_outside_every_stored_path_get_the_default():
+  trie = make_trie()
+  assert trie.find("/home/user") is None
+  assert trie.find("/etc/passwd", "none") == "none"
+
+def test_matches_whole_components_only():
+  trie = make_trie()
+  assert trie.find("/home/user/projects-old/file") is None
+  assert trie.find("/home/user/projects/bigger/file") == "projects"
+
+def test_ignores_repeated_and_trailing_slashes():
+  assert make_trie().find("/home//user/projects/big/") == "big"
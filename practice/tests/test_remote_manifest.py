@@ -0,0 +1,47 @@
+from FileActions import PARTIAL_SUFFIX
+from remote_manifest import plan_sync
+
+def entry(size, file_hash):
+  return {"size": size, "hash": file_hash, "modified_time": "2024-01-01T00:00:00"}
+
+def test_identical_trees_are_all_matched():
+  local = {"a": entry(1, "ha"), "dir/b": entry(2, "hb")}
+  plan = plan_sync(local, dict(local))
+  assert sorted(plan.matched) == ["a", "dir/b"]
+  assert (plan.upload, plan.delete, plan.rename) == ([], [], [])
+
+def test_modification_times_do_not_count():
+  local = {"a": entry(1, "ha")}
+  remote = {"a": {**entry(1, "ha"), "modified_time": "2025-06-01T12:00:00"}}
+  assert plan_sync(local, remote).matched == ["a"]
+
+def test_changed_missing_and_remote_only_files():
+  local = {"same": entry(1, "h1"), "changed": entry(2, "new"), "missing": entry(3, "h3")}
+  remote = {"same": entry(1, "h1"), "changed": entry(2, "old"), "extra": entry(4, "h4")}
+  plan = plan_sync(local, remote)
+  assert plan.matched == ["same"]
+  assert plan.upload == ["changed", "missing"]
+  assert plan.delete == ["extra"]
+  assert plan.rename == []
+
+def test_moved_file_is_renamed_instead_of_uploaded():
+  local = {"new/place": entry(5, "moved"), "other": entry(6, "h6")}
+  remote = {"old/place": entry(5, "moved"), "other": entry(6, "h6")}
+  plan = plan_sync(local, remote)
+  assert plan.rename == [("old/place", "new/place")]
+  assert plan.upload == []
+  assert plan.delete == []
+
+def test_each_remote_copy_is_renamed_once():
+  local = {"x": entry(5, "same"), "y": entry(5, "same")}
+  remote = {"z": entry(5, "same")}
+  plan = plan_sync(local, remote)
+  assert plan.rename == [("z", "x")]
+  assert plan.upload == ["y"]
+
+def test_partial_uploads_on_the_remote_are_ignored():
+  local = {"a": entry(1, "ha")}
+  remote = {"a": entry(1, "ha"), "b" + PARTIAL_SUFFIX: entry(9, "hb")}
+  plan = plan_sync(local, remote)
+  assert plan.matched == ["a"]
+  assert plan.delete == []
@@ -0,0 +1,83 @@
+import threading
+import time
+from HostCircuitBreaker import HostCircuitBreaker
+from RetryScheduler import RetryScheduler
+
+HOST = ("user", "host")
+
+class Collector:
+  """Collects due retries and lets a test wait for them."""
+  def __init__(self):
+    self.due = []
+    self.event = threading.Event()
+
+  def __call__(self, *retry):
+    self.due.append(retry)
+    self.event.set()
+
+  def wait(self, timeout=2):
+    assert self.event.wait(timeout)
+    self.event.clear()
+
+def make_scheduler(is_parked=lambda key: False):
+  collector = Collector()
+  scheduler = RetryScheduler(collector, is_parked, base_delay=0.01, max_delay=0.05)
+  scheduler.start()
+  return scheduler, collector
+
+def test_failed_destinations_of_a_file_come_back_together():
+  scheduler, collector = make_scheduler()
+  scheduler.schedule("send_file", "/src/a", "/src", "u@h1:/d", {"n": 1}, HOST)
+  scheduler.schedule("send_file", "/src/a", "/src", "u@h2:/d", {"n": 2}, HOST)
+  collector.wait()
+  time.sleep(0.1)
+  remote_dirs = {}
+  for action, file, tracked_path, dirs, old_path in collector.due:
+    assert (action, file, tracked_path, old_path) == ("send_file", "/src/a", "/src", None)
+    remote_dirs.update(dirs)
+  assert remote_dirs == {"u@h1:/d": {"n": 1}, "u@h2:/d": {"n": 2}}
+
+def test_backoff_grows_with_counted_attempts_only():
+  scheduler = RetryScheduler(lambda *retry: None, lambda key: False, base_delay=10, max_delay=1000)
+  for _ in range(3):
+    scheduler.schedule("send_file", "/src/a", "/src", "u@h:/d", {}, HOST)
+  scheduler.schedule("send_file", "/src/a", "/src", "u@h:/d", {}, HOST, count_attempt=False)
+  entry = scheduler.entries[("send_file", "/src/a", "u@h:/d")]
+  assert entry["attempts"] == 3
+  # 10 * 2^2 with at most half of it taken off by the jitter
+  assert 20 <= entry["due"] - time.monotonic() <= 40
+
+def test_forget_drops_delivered_destinations():
+  scheduler = RetryScheduler(lambda *retry: None, lambda key: False)
+  scheduler.schedule("send_file", "/src/a", "/src", "u@h1:/d", {}, HOST)
+  scheduler.schedule("send_file", "/src/a", "/src", "u@h2:/d", {}, HOST)
+  scheduler.forget("send_file", "/src/a", ["u@h1:/d"])
+  assert list(scheduler.entries) == [("send_file", "/src/a", "u@h2:/d")]
+
+def test_parked_host_is_held_until_its_breaker_recovers():
+  reachable = threading.Event()
+  scheduler, collector = make_scheduler()
+  breakers = HostCircuitBreaker(probe=lambda key: reachable.is_set(), on_recover=scheduler.release_host,
+                                failure_threshold=2, probe_interval=0.01, max_probe_interval=0.02)
+  scheduler.is_parked = breakers.is_open
+
+  breakers.record_failure(HOST)
+  assert not breakers.is_open(HOST)
+  breakers.record_failure(HOST)
+  assert breakers.is_open(HOST)
+
+  scheduler.schedule("send_file", "/src/a", "/src", "u@h:/d", {}, HOST, count_attempt=False)
+  time.sleep(0.2)
+  assert collector.due == []
+
+  reachable.set()
+  collector.wait()
+  assert not breakers.is_open(HOST)
+  assert [retry[1] for retry in collector.due] == ["/src/a"]
+
+def test_a_success_resets_the_failure_count():
+  breakers = HostCircuitBreaker(probe=lambda key: True, on_recover=lambda key: None, failure_threshold=2)
+  breakers.record_failure(HOST)
+  breakers.record_success(HOST)
+  breakers.record_failure(HOST)
+  assert not breakers.is_open(HOST)
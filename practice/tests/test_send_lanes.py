@@ -0,0 +1,54 @@
+import threading
+from SendLanes import SendLanes, INTERACTIVE, BULK
+
+POLICY = {"lane": None, "interactive_max_size": 100, "recent_max_size": 1000, "recent_seconds": 60}
+
+def info(*remotes):
+  return {"remote_dirs": {remote: {} for remote in remotes}, "tracked_path": "/data"}
+
+def test_classify_by_size_and_age():
+  assert SendLanes.classify(10, 3600, POLICY) == INTERACTIVE
+  assert SendLanes.classify(500, 5, POLICY) == INTERACTIVE
+  assert SendLanes.classify(500, 3600, POLICY) == BULK
+  assert SendLanes.classify(5000, 5, POLICY) == BULK
+  assert SendLanes.classify(5000, 5, {**POLICY, "lane": INTERACTIVE}) == INTERACTIVE
+
+def test_hand_off_merges_destinations_until_taken():
+  lanes = SendLanes()
+  lanes.hand_off("/data/big", info("a"))
+  lanes.hand_off("/data/big", info("b"))
+  taken = lanes.take()
+  assert set(taken["/data/big"]["remote_dirs"]) == {"a", "b"}
+  assert lanes.is_sending({"/data"})
+
+def test_claim_takes_a_waiting_file_back():
+  lanes = SendLanes()
+  lanes.hand_off("/data/big", info("a"))
+  claimed, replaced = lanes.claim("/data/big")
+  assert claimed and set(replaced["remote_dirs"]) == {"a"}
+  assert lanes.claim("/data/big") == (True, None)
+
+def test_claim_leaves_a_file_being_sent_with_the_bulk_lane():
+  lanes = SendLanes()
+  lanes.hand_off("/data/big", info("a"))
+  lanes.take()
+  assert lanes.claim("/data/big") == (False, None)
+  lanes.finish(["/data/big"])
+  assert lanes.claim("/data/big") == (True, None)
+  assert not lanes.is_sending({"/data/big"})
+
+def test_cancel_drops_pending_files_below_the_paths():
+  lanes = SendLanes()
+  lanes.hand_off("/data/dir/a", info("a"))
+  lanes.hand_off("/data/dir2/b", info("a"))
+  assert set(lanes.cancel({"/data/dir"})) == {"/data/dir/a"}
+  assert set(lanes.take()) == {"/data/dir2/b"}
+
+def test_take_waits_for_a_hand_off():
+  lanes = SendLanes()
+  taken = []
+  thread = threading.Thread(target=lambda: taken.append(lanes.take()))
+  thread.start()
+  lanes.hand_off("/data/big", info("a"))
+  thread.join(timeout=5)
+  assert taken and set(taken[0]) == {"/data/big"}
@@ -1,22 +1,32 @@
-import hashlib
 from pathlib import Path
 import json
 from datetime import datetime
+from MerkleTree import MerkleTree
+from tree_walker import walk_files
 
 TRACKED_PATHS_FILE = Path("file_indexes/tracked_paths.json")
 
+def scan_folder(folder: Path) -> dict:
+    """Stats every file in the folder. Returns [relative_path] -> {"size", "modified_time"}."""
+    entries = {}
+    for _, relative_path, stat in walk_files(folder):
+        entries[relative_path] = {
+            "size": stat.st_size,
+            "modified_time": datetime.fromtimestamp(stat.st_mtime).isoformat()
+        }
+    return entries
+
+def build_folder_tree(folder: Path, entries: dict = None) -> MerkleTree:
+    """Builds the folder's Merkle tree from a metadata scan (or from entries already scanned)."""
+    return MerkleTree.from_entries(scan_folder(folder) if entries is None else entries)
+
 def compute_folder_hash(folder: Path) -> str:
-    hasher = hashlib.sha256()
-    for file in sorted(folder.rglob("*")):
-        if file.is_file():
-            stat = file.stat()
-            hasher.update(str(file.relative_to(folder)).encode())
-            hasher.update(str(stat.st_mtime).encode())
-            hasher.update(str(stat.st_size).encode())
-    return hasher.hexdigest()
+    return build_folder_tree(folder).root_hash()
 
-def get_folder_size(folder: Path) -> int:
-    return sum(f.stat().st_size for f in folder.rglob("*") if f.is_file())
+def get_folder_size(folder: Path, entries: dict = None) -> int:
+    if entries is None:
+        entries = scan_folder(folder)
+    return sum(entry["size"] for entry in entries.values())
 
 def save_tracked_paths(paths : dict):
   """Saves the list of tracked paths to a JSON file."""
@@ -0,0 +1,39 @@
+import contextvars
+import threading
+
+# Counters for the current batch of transfers of each lane: [lane] -> {[name] -> count}
+lane_stats = {}
+_stats_lock = threading.Lock()
+# Lane whose counters count() adds to. Set by the thread sending a batch; the threads it
+# starts for the batch run in a copy of its context, so they count for the same lane.
+current_lane = contextvars.ContextVar("transfer_stats_lane", default=None)
+
+def set_lane(lane : str):
+  current_lane.set(lane)
+
+def count(name : str, amount=1):
+  """Adds to a counter of the current lane. Safe to call from the transfer threads."""
+  with _stats_lock:
+    stats = lane_stats.setdefault(current_lane.get(), {})
+    stats[name] = stats.get(name, 0) + amount
+
+def get(name : str, default=0):
+  """Returns a counter of the current lane."""
+  with _stats_lock:
+    return lane_stats.get(current_lane.get(), {}).get(name, default)
+
+def reset():
+  """Clears the current lane's counters, leaving the other lanes' batches alone."""
+  with _stats_lock:
+    lane_stats.pop(current_lane.get(), None)
+
+def print_stats():
+  """Prints the current lane's counters collected since its last reset."""
+  lane = current_lane.get()
+  with _stats_lock:
+    stats = dict(lane_stats.get(lane, {}))
+  if not stats:
+    return
+  print(f"\nTransfer stats ({lane} lane):" if lane else "\nTransfer stats:")
+  for name, value in stats.items():
+    print(f"\t{name}: {value}")
@@ -0,0 +1,55 @@
+import settings_util
+
+# 'default' keeps paramiko's settings, 'throughput' is tuned for fast links with high latency
+DEFAULT_TRANSFER_MODE = "default"
+
+# paramiko's own defaults
+DEFAULT_WINDOW_SIZE = 2 * 1024 * 1024
+DEFAULT_MAX_PACKET_SIZE = 32 * 1024
+DEFAULT_READ_BUFFER_SIZE = 32 * 1024
+
+# A window this big keeps a 1 Gbit/s link with 200 ms round trips busy. OpenSSH servers announce
+# 32 KiB packets for uploads, so a bigger max packet size only helps servers that accept one.
+THROUGHPUT_WINDOW_SIZE = 64 * 1024 * 1024
+THROUGHPUT_MAX_PACKET_SIZE = 32 * 1024
+THROUGHPUT_READ_BUFFER_SIZE = 4 * 1024 * 1024
+
+def get_transfer_settings(host : str) -> dict:
+  """
+  Returns the window size, max packet size, local read buffer size and compression for a host.
+
+  The 'transfer_mode' setting picks the defaults, and each value can be overridden
+  per host in config.yaml, e.g.
+
+  hosts:
+    backup.example.com:
+      transfer_mode: throughput
+      window_size: 134217728
+      compression: true
+  """
+  if settings_util.get_host_setting(host, 'transfer_mode', DEFAULT_TRANSFER_MODE) == "throughput":
+    defaults = (THROUGHPUT_WINDOW_SIZE, THROUGHPUT_MAX_PACKET_SIZE, THROUGHPUT_READ_BUFFER_SIZE)
+  else:
+    defaults = (DEFAULT_WINDOW_SIZE, DEFAULT_MAX_PACKET_SIZE, DEFAULT_READ_BUFFER_SIZE)
+
+  return {
+    "window_size": settings_util.get_host_setting(host, 'window_size', defaults[0]),
+    "max_packet_size": settings_util.get_host_setting(host, 'max_packet_size', defaults[1]),
+    "read_buffer_size": settings_util.get_host_setting(host, 'read_buffer_size', defaults[2]),
+    # Only pays off for compressible data on slow links, so it is off unless asked for
+    "compression": settings_util.get_host_setting(host, 'compression', False)
+  }
+
+def get_connect_options(host : str) -> dict:
+  """Extra arguments for SSHClient.connect."""
+  return {"compress": bool(get_transfer_settings(host)["compression"])}
+
+def tune_transport(transport, host : str):
+  """Sets the window and packet sizes used by every channel (SFTP or exec) opened on the transport from now on."""
+  transfer_settings = get_transfer_settings(host)
+  transport.default_window_size = transfer_settings["window_size"]
+  transport.default_max_packet_size = transfer_settings["max_packet_size"]
+
+def report_transfer(local_file, remote_file : str, size : int, elapsed : float):
+  elapsed = max(elapsed, 1e-6)
+  print(f"Sent {local_file} to {remote_file}: {size / 1e6:.1f} MB in {elapsed:.2f}s, {size / 1e6 / elapsed:.1f} MB/s")
@@ -0,0 +1,54 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import settings_util
+
+def _scan_dir(directory : str, relative : str, files : list, subdirs : list):
+  """Scans one directory, appending (path, relative path, stat) for files and (path, relative path) for subdirectories."""
+  try:
+    with os.scandir(directory) as entries:
+      for entry in entries:
+        entry_relative = f"{relative}/{entry.name}" if relative else entry.name
+        try:
+          # Symlinked directories are not followed, the same as Path.rglob
+          if entry.is_dir(follow_symlinks=False):
+            subdirs.append((entry.path, entry_relative))
+          elif entry.is_file():
+            files.append((entry.path, entry_relative, entry.stat()))
+        except OSError as e:
+          print(f"Error reading {entry.path}: {e}")
+  except OSError as e:
+    print(f"Error scanning {directory}: {e}")
+
+def _walk_serial(directory : str, relative : str):
+  pending = [(directory, relative)]
+  while pending:
+    files = []
+    subdirs = []
+    current, current_relative = pending.pop()
+    _scan_dir(current, current_relative, files, subdirs)
+    yield from files
+    pending.extend(subdirs)
+
+def walk_files(root, workers : int = None):
+  """
+  Walks every file below root in a single os.scandir pass.
+
+  Yields (path, path relative to root in posix form, stat result), reusing the stat
+  from the directory entry, so callers need no extra stat per file.
+  With more than one worker (default 'scan_workers' in config.yaml), the top level
+  subdirectories are walked in parallel threads.
+  """
+  root = os.fspath(root)
+  workers = workers or settings_util.get_setting('scan_workers', 1)
+
+  if workers <= 1:
+    yield from _walk_serial(root, "")
+    return
+
+  files = []
+  subdirs = []
+  _scan_dir(root, "", files, subdirs)
+  yield from files
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    for subdir_files in executor.map(lambda subdir: list(_walk_serial(*subdir)), subdirs):
+      yield from subdir_files